@@ -0,0 +1,62 @@
+"""
+Benchmarks traversal and lookups on a large in-memory package.
+
+Usage:
+    python benchmarks/package_index.py [--entries 1000000] [--fanout 100]
+"""
+import argparse
+import random
+import time
+
+from t4.packages import Package, PackageEntry
+
+
+def make_package(entries, fanout):
+    """
+    Builds a package with `entries` entries spread over a tree of directories,
+    `fanout` children per directory, inserted in random order.
+    """
+    keys = []
+    for i in range(entries):
+        n, leaf = divmod(i, fanout)
+        parts = ['f%d' % leaf]
+        while n:
+            n, rem = divmod(n, fanout)
+            parts.append('d%d' % rem)
+        keys.append('/'.join(reversed(parts)))
+    random.shuffle(keys)
+
+    pkg = Package()
+    for i, key in enumerate(keys):
+        path = key.split('/')
+        subpkg = pkg._ensure_subpackage(path[:-1])
+        subpkg._children[path[-1]] = PackageEntry(
+            ['s3://bucket/%s' % key], i, dict(type='SHA256', value='%064x' % i), {})
+    return pkg, keys
+
+
+def timed(label, func):
+    start = time.time()
+    result = func()
+    print('%-30s %8.3fs' % (label, time.time() - start))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--fanout', type=int, default=100)
+    args = parser.parse_args()
+
+    pkg, keys = timed('build', lambda: make_package(args.entries, args.fanout))
+    timed('first walk', lambda: sum(1 for _ in pkg.walk()))
+    timed('second walk', lambda: sum(1 for _ in pkg.walk()))
+    timed('10k lookups (__contains__)', lambda: sum(key in pkg for key in keys[:10000]))
+    prefix = keys[0].rsplit('/', 1)[0] + '/'
+    timed('1k prefix queries', lambda: [sum(1 for _ in pkg.iter_prefix(prefix)) for _ in range(1000)])
+    timed('top_hash', lambda: pkg.top_hash)
+    timed('top_hash (cached)', lambda: pkg.top_hash)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import heapq
+import itertools
 import json
+import math
 import re
+from threading import Lock
+import time
 from six.moves import urllib
 from urllib.parse import urlparse, unquote
 import datetime
 import pytz
 
 from aws_requests_auth.boto_utils import BotoAWSRequestsAuth
+from botocore.exceptions import ClientError
 from elasticsearch import Elasticsearch, RequestsHttpConnection
 import requests
 import humanize
 
-from .data_transfer import (copy_file, get_bytes, put_bytes, delete_object, list_objects,
-                            list_object_versions, _update_credentials)
+from .data_transfer import (copy_file, get_bytes, put_bytes, delete_object, delete_objects,
+                            iter_lines, list_objects, list_object_versions, _list_objects,
+                            _list_object_versions,
+                            _update_credentials, DELETE_OBJECTS_MAX_KEYS)
 from .formats import FormatRegistry
-from .packages import get_package_registry, Package
+from . import search_util
+from .packages import (get_package_registry, Package, MANIFEST_SIDECAR_SUFFIXES, SUMMARY_SUFFIX,
+                       _evict_latest_hash)
 from .session import get_registry_url, get_session
 from .util import (T4Config, QuiltException, CONFIG_PATH,
-                   CONFIG_TEMPLATE, fix_url, parse_file_url, parse_s3_url, read_yaml, validate_url,
+                   CONFIG_TEMPLATE, fix_url, get_bucket_configs, get_catalog_config_url, make_s3_url,
+                   parse_file_url, parse_s3_url, read_yaml, validate_url,
                    write_yaml, yaml_has_comments, validate_package_name)
 
 # backports
@@ -25,6 +38,16 @@ try:
 except ImportError:
     import pathlib
 
+# Number of pointer and summary objects to read at once when listing packages.
+LIST_PACKAGES_THREADS = 16
+# Number of buckets to search at once.
+SEARCH_BUCKET_THREADS = 8
+# Number of manifests to read at once when collecting garbage.
+GC_MANIFEST_THREADS = 8
+# A manifest line is at least this long (the hash alone is 64 characters), which bounds
+# the number of entries in a manifest of a given size.
+MIN_MANIFEST_LINE_SIZE = 100
+
 
 def copy(src, dest):
     """
@@ -80,6 +103,60 @@ def get(src):
     return FormatRegistry.deserialize(data, meta, ext=ext), meta.get('user_meta')
 
 
+def search(query, buckets, limit=10, order_by='time', config_url=None, source_includes=None,
+           source_excludes=None):
+    """Searches several buckets at once.
+
+    Each bucket's search endpoint is queried in parallel, and the results are merged.
+
+    Parameters:
+        query (str or dict): query string, or Elasticsearch query, as for ``Bucket.search``
+        buckets (list): names or ``s3://`` URIs of the buckets to search
+        limit (int): maximum number of results to return
+        order_by (str): ``'time'`` for the newest results first, or ``'score'`` for the
+            most relevant first (scores from different endpoints are only roughly comparable)
+        config_url (str): URL of the catalog config listing the buckets; defaults to
+            the config of ``navigator_url``
+        source_includes, source_excludes (list): fields to return, or not, as for ``Bucket.search``
+
+    Returns:
+        list: results as returned by ``Bucket.search``, each with an extra ``bucket`` key.
+    """
+    if order_by == 'time':
+        sort, sort_key = search_util.DEFAULT_SORT, lambda result: result['time'] or ''
+    elif order_by == 'score':
+        sort, sort_key = search_util.SCORE_SORT, lambda result: result['score'] or 0
+    else:
+        raise QuiltException("`order_by` must be 'time' or 'score'")
+
+    bucket_names = [parse_s3_url(urlparse(bucket))[0] if bucket.startswith('s3://') else bucket
+                    for bucket in buckets]
+    bucket_configs = get_bucket_configs(config_url or get_catalog_config_url())
+    for name in bucket_names:
+        if name not in bucket_configs:
+            raise QuiltException(f"Failed to find a config for bucket {name}")
+
+    def search_bucket(name):
+        bucket_config = bucket_configs[name]
+        search_endpoint = bucket_config.get('searchEndpoint', bucket_config.get('search_endpoint'))
+        if not search_endpoint:
+            raise QuiltException(f"Bucket {name} has no search endpoint")
+        results = search_util.search(query, search_endpoint, limit,
+                                     aws_region=bucket_config.get('region', 'us-east-1'),
+                                     source_includes=source_includes, source_excludes=source_excludes,
+                                     sort=sort)
+        for result in results:
+            result['bucket'] = name
+        return results
+
+    with ThreadPoolExecutor(SEARCH_BUCKET_THREADS) as executor:
+        bucket_results = list(executor.map(search_bucket, bucket_names))
+
+    # Each bucket's results are already in order.
+    merged = heapq.merge(*bucket_results, key=sort_key, reverse=True)
+    return list(itertools.islice(merged, limit))
+
+
 def _tophashes_with_packages(registry=None):
     """Return a dictionary of tophashes and their corresponding packages
 
@@ -117,11 +194,16 @@ def _tophashes_with_packages(registry=None):
         bucket, path, version = parse_s3_url(registry_url)
 
         pkg_namespace_path = path + '/named_packages/'
+        pkg_entry_paths = [pkg_entry['Key'] for pkg_entry in list_objects(bucket, pkg_namespace_path)]
 
-        for pkg_entry in list_objects(bucket, pkg_namespace_path):
-            pkg_entry_path = pkg_entry['Key']
+        def read_pointer(pkg_entry_path):
             tophash, meta = get_bytes('s3://' + bucket + '/' + pkg_entry_path)
-            tophash = tophash.decode('utf-8')
+            return tophash.decode('utf-8')
+
+        with ThreadPoolExecutor(LIST_PACKAGES_THREADS) as executor:
+            tophashes = list(executor.map(read_pointer, pkg_entry_paths))
+
+        for pkg_entry_path, tophash in zip(pkg_entry_paths, tophashes):
             pkg_name = "/".join(pkg_entry_path.split("/")[-3:-1])
 
             if tophash in out:
@@ -168,6 +250,10 @@ def delete_package(name, registry=None):
 
             if timestamp != 'latest' and len(tophashes_with_packages[tophash]) == 1:
                 (packages_path / tophash).unlink()
+                for suffix in MANIFEST_SIDECAR_SUFFIXES:
+                    sidecar_path = packages_path / (tophash + suffix)
+                    if sidecar_path.exists():
+                        sidecar_path.unlink()
 
             tophash_file.unlink()
 
@@ -191,19 +277,94 @@ def delete_package(name, registry=None):
 
             if timestamp != 'latest' and len(tophashes_with_packages[tophash]) == 1:
                 delete_object(bucket, packages_path + tophash)
+                # Sidecars that weren't built for this version are no error.
+                delete_objects(bucket, [packages_path + tophash + suffix
+                                        for suffix in MANIFEST_SIDECAR_SUFFIXES])
 
             delete_object(bucket, tophash_file)
+            if timestamp == 'latest':
+                # Don't keep serving the deleted package from the cache.
+                _evict_latest_hash(tophash_path)
 
     else:
         raise NotImplementedError
 
 
+def _registry_root(registry):
+    """
+    Returns the URL of the directory containing a registry's `.quilt` directory,
+    with a trailing slash.
+    """
+    if registry is None or registry == 'local':
+        registry = get_package_registry(None)
+    else:
+        registry = get_package_registry(fix_url(registry))
+    # the get_package_registry path includes '/.quilt', which Package.browse does not expect
+    return registry[:registry.rindex('.quilt')]
+
+
+def _list_directories(url):
+    """
+    Returns the names of the subdirectories of a file or S3 directory URL.
+    """
+    dir_urlparse = urlparse(url)
+
+    if dir_urlparse.scheme == 'file':
+        dir_path = pathlib.Path(parse_file_url(dir_urlparse))
+        if not dir_path.is_dir():
+            return []
+        return sorted(path.name for path in dir_path.iterdir() if path.is_dir())
+    elif dir_urlparse.scheme == 's3':
+        bucket_name, dir_key, _ = parse_s3_url(dir_urlparse)
+        dir_key += '/'
+        prefixes, _ = list_objects(bucket_name, dir_key, recursive=False)
+        return sorted(prefix['Prefix'][len(dir_key):].rstrip('/') for prefix in prefixes)
+    else:
+        raise NotImplementedError
+
+
+def _list_package_namespaces(registry):
+    """
+    Returns the namespaces of the packages in a registry.
+    """
+    return _list_directories(f'{_registry_root(registry)}.quilt/named_packages')
+
+
+def _list_package_names(registry, namespace):
+    """
+    Returns the names of the packages in a namespace (without the namespace), from a listing
+    of the registry's pointer directories; no pointers or manifests are read.
+    """
+    return _list_directories(f'{_registry_root(registry)}.quilt/named_packages/{namespace}')
+
+
+def _get_package_summary(registry, top_hash):
+    """
+    Returns the summary of a package version, reading just its summary object
+    if it has one, and the whole manifest otherwise.
+    """
+    summary_url = f'{registry}.quilt/packages/{top_hash}{SUMMARY_SUFFIX}'
+    try:
+        summary_bytes, _ = get_bytes(summary_url)
+        return json.loads(summary_bytes.decode('utf-8'))
+    except (FileNotFoundError, ClientError):
+        # Built before summaries existed.
+        pkg = Package.browse(registry=registry, top_hash=top_hash)
+        return pkg._summary(top_hash, None)
+
+
 def list_packages(registry=None):
     """ Lists Packages in the registry.
 
     Returns a list of all named packages in a registry.
     If the registry is None, default to the local registry.
 
+    Sizes come from the per-version summaries written at build time, so this still
+    reads a pointer and a summary for every version (in parallel), rather than a
+    single registry-wide index; versions that share a top hash share one read.
+    Versions built before summaries existed fall back to reading their manifest;
+    see `backfill_package_summaries`.
+
     Args:
         registry(string): location of registry to load package from.
 
@@ -266,56 +427,24 @@ def list_packages(registry=None):
                         f"{self._fmt_str(size_str, 15).rstrip(' ')}\t\n")
             return out
 
-    if registry is None or registry == 'local':
-        registry = get_package_registry(None)
-    else:
-        registry = get_package_registry(fix_url(registry))
-    # the get_package_registry path includes '/.quilt', which Package.browse does not expect
-    registry = registry[:registry.rindex('.quilt')]
+    registry = _registry_root(registry)
     named_packages_urlparse = urlparse(registry + '.quilt/named_packages')
     registry_scheme = named_packages_urlparse.scheme
 
-    pkg_info = []
+    versions = []  # (package name, URL of its pointer file, ctime)
+    latest_pointers = {}  # package name -> URL of its latest pointer file
 
     if registry_scheme == 'file':
         named_packages_dir = pathlib.Path(parse_file_url(named_packages_urlparse))
 
         for named_path in named_packages_dir.glob('*/*'):
             pkg_name = named_path.relative_to(named_packages_dir).as_posix()
-
-            pkg_hashes = []
-            pkg_sizes = []
-            pkg_ctimes = []
-            pkg_display_names = []
-
-            with open(named_path / 'latest', 'r') as latest_hash_file:
-                latest_hash = latest_hash_file.read()
+            latest_pointers[pkg_name] = (named_path / 'latest').as_uri()
 
             for pkg_hash_path in named_path.rglob('*/'):
                 if pkg_hash_path.name == 'latest':
                     continue
-
-                with open(pkg_hash_path, 'r') as pkg_hash_file:
-                    pkg_hash = pkg_hash_file.read()
-                    pkg_hashes.append(pkg_hash)
-
-                if pkg_hash == latest_hash:
-                    pkg_display_name = f'{pkg_name}:latest'
-                else:
-                    pkg_display_name = pkg_name
-
-                pkg = Package.browse(pkg_name, registry=registry, top_hash=pkg_hash)
-                pkg_sizes.append(sum(pkg.map(lambda _, entry: entry.size)))
-                pkg_display_names.append(pkg_display_name)
-                pkg_ctimes.append(pkg_hash_path.stat().st_ctime)
-
-            for pkg_display_name, top_hash, ctime, size in zip(
-                    pkg_display_names, pkg_hashes, pkg_ctimes, pkg_sizes
-            ):
-                pkg_info.append(
-                    {'pkg_name': pkg_display_name, 'top_hash': top_hash,
-                     'ctime': ctime, 'size': size}
-                )
+                versions.append((pkg_name, pkg_hash_path.as_uri(), pkg_hash_path.stat().st_ctime))
 
     elif registry_scheme == 's3':
         bucket_name, bucket_registry_path, _ = parse_s3_url(named_packages_urlparse)
@@ -334,66 +463,48 @@ def list_packages(registry=None):
             raw_pkg_names = [pkg_name['Prefix'] for pkg_name in raw_pkg_names]
 
             # go through packages to get package hash files
-            for pkg_name in raw_pkg_names:
-                pkg_hashes = []
-                pkg_sizes = []
-                pkg_ctimes = []
-                pkg_display_names = []
-
+            for raw_pkg_name in raw_pkg_names:
+                pkg_name = raw_pkg_name[len(bucket_registry_path):].strip('/')
                 _, pkg_hashfiles = list_objects(
                     bucket_name,
-                    pkg_name,
+                    raw_pkg_name,
                     recursive=False
                 )
 
-                latest_hashfile = next(hf for hf in pkg_hashfiles if '/latest' in hf['Key'])['Key']
-                latest_hashfile_fullpath = f's3://{bucket_name}/{latest_hashfile}'
-                latest_hash, _ = get_bytes(latest_hashfile_fullpath)
-                latest_hash = latest_hash.decode()
-
-                # go through package hashfiles to get manifest files
-                pkg_hash_paths = []
                 for pkg_hashfile in pkg_hashfiles:
                     pkg_hashfile_key = pkg_hashfile['Key']
-
+                    pkg_hashfile_url = f's3://{bucket_name}/{pkg_hashfile_key}'
                     if pkg_hashfile_key.split('/')[-1] == 'latest':
-                        continue
-
-                    pkg_hash, _ = get_bytes(f's3://{bucket_name}/{pkg_hashfile_key}')
-                    pkg_hash = pkg_hash.decode()
-
-                    pkg_last_modified = pkg_hashfile['LastModified'].timestamp()
-                    pkg_hash_paths.append(pkg_hashfile_key)
-                    pkg_ctimes.append(pkg_last_modified)
-
-                # go through manifest files to get package info
-                for pkg_hash_path in pkg_hash_paths:
-                    pkg_display_name = pkg_name[len(bucket_registry_path):].strip('/')
-
-                    pkg_hash, _ = get_bytes('s3://' + bucket_name + '/' + pkg_hash_path)
-                    pkg_hash = pkg_hash.decode()
+                        latest_pointers[pkg_name] = pkg_hashfile_url
+                    else:
+                        versions.append(
+                            (pkg_name, pkg_hashfile_url, pkg_hashfile['LastModified'].timestamp()))
 
-                    if pkg_hash == latest_hash:
-                        pkg_display_name = pkg_display_name + ':latest'
+    else:
+        raise NotImplementedError
 
-                    pkg_hashes.append(pkg_hash)
-                    pkg_display_names.append(pkg_display_name)
+    def read_pointer(url):
+        pkg_hash, _ = get_bytes(url)
+        return pkg_hash.decode('utf-8').strip()
 
-                    pkg = Package.browse(
-                        pkg_name, top_hash=pkg_hash, registry='s3://' + bucket_name
-                    )
-                    pkg_sizes.append(sum(pkg.map(lambda _, entry: entry.size)))
+    def get_size(top_hash):
+        return _get_package_summary(registry, top_hash)['size']
 
-                for display_name, top_hash, ctime, size in zip(
-                        pkg_display_names, pkg_hashes, pkg_ctimes, pkg_sizes
-                ):
-                    pkg_info.append(
-                        {'pkg_name': display_name, 'top_hash': top_hash, 'ctime': ctime,
-                         'size': size}
-                    )
+    # Pointers and summaries are tiny objects, so fetching them is all latency.
+    with ThreadPoolExecutor(LIST_PACKAGES_THREADS) as executor:
+        latest_hashes = dict(zip(latest_pointers, executor.map(read_pointer, latest_pointers.values())))
+        pkg_hashes = list(executor.map(read_pointer, [url for _, url, _ in versions]))
+        unique_hashes = list(set(pkg_hashes))
+        sizes = dict(zip(unique_hashes, executor.map(get_size, unique_hashes)))
+    pkg_sizes = [sizes[top_hash] for top_hash in pkg_hashes]
 
-    else:
-        raise NotImplementedError
+    pkg_info = []
+    for (pkg_name, _, ctime), top_hash, size in zip(versions, pkg_hashes, pkg_sizes):
+        if top_hash == latest_hashes.get(pkg_name):
+            pkg_name = f'{pkg_name}:latest'
+        pkg_info.append(
+            {'pkg_name': pkg_name, 'top_hash': top_hash, 'ctime': ctime, 'size': size}
+        )
 
     def sorter(pkg_info):
         pkg_name, pkg_cdate = pkg_info['pkg_name'], pkg_info['ctime']
@@ -405,6 +516,237 @@ def list_packages(registry=None):
     return PackageList(pkg_info)
 
 
+def backfill_package_summaries(registry=None):
+    """
+    Writes summaries for the packages in a registry that don't have one (those built
+    by older versions of T4), so that `list_packages` doesn't need to read their manifests.
+
+    Args:
+        registry(string): location of the registry; defaults to the local registry
+
+    Returns:
+        A list of the top hashes of the packages that got a summary
+    """
+    registry = _registry_root(registry)
+    packages_url = registry + '.quilt/packages/'
+    packages_urlparse = urlparse(packages_url)
+
+    if packages_urlparse.scheme == 'file':
+        packages_dir = pathlib.Path(parse_file_url(packages_urlparse))
+        mtimes = {path.name: path.stat().st_mtime for path in packages_dir.iterdir() if path.is_file()}
+    elif packages_urlparse.scheme == 's3':
+        bucket_name, packages_path, _ = parse_s3_url(packages_urlparse)
+        _, objects = list_objects(bucket_name, packages_path, recursive=False)
+        mtimes = {obj['Key'][len(packages_path):]: obj['LastModified'].timestamp() for obj in objects}
+    else:
+        raise NotImplementedError
+
+    missing = [
+        name for name in mtimes
+        if not name.endswith(MANIFEST_SIDECAR_SUFFIXES) and name + SUMMARY_SUFFIX not in mtimes
+    ]
+
+    def backfill(top_hash):
+        pkg = Package.browse(registry=registry, top_hash=top_hash)
+        # The manifest was written when the package was built.
+        summary = pkg._summary(top_hash, mtimes[top_hash])
+        put_bytes(json.dumps(summary).encode('utf-8'), packages_url + top_hash + SUMMARY_SUFFIX)
+        return top_hash
+
+    with ThreadPoolExecutor(LIST_PACKAGES_THREADS) as executor:
+        return list(executor.map(backfill, missing))
+
+
+class _BloomFilter:
+    """
+    A compact set of strings: it never misses a string that was added, but may claim to
+    contain one that wasn't, with probability `error_rate` once `capacity` strings are in it.
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        self._size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self._hash_count = max(1, round(self._size / capacity * math.log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+        self._lock = Lock()
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self._size for i in range(self._hash_count)]
+
+    def update(self, items):
+        positions = [pos for item in items for pos in self._positions(item)]
+        with self._lock:
+            for pos in positions:
+                self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+def collect_garbage(registry, prefixes=None, dry_run=True, min_age=datetime.timedelta(days=1),
+                    max_deletes_per_second=None, versions=False):
+    """
+    Deletes what no package in an S3 registry refers to any more: manifests that no
+    package version points to, and objects under `prefixes` that aren't in any of the
+    remaining manifests.
+
+    The objects the remaining manifests refer to are collected by streaming the manifests
+    into a bloom filter, so memory use stays small however many there are. A false positive
+    only means an unreferenced object is kept until a later run.
+
+    By default, objects are compared by key: a reference to any version keeps the key,
+    and garbage keys are deleted without a version ID. In a versioned bucket that only
+    adds delete markers, which hides the objects but doesn't reclaim any storage. With
+    `versions`, object versions are swept instead: every version a live manifest's physical
+    key refers to is kept (a physical key without a version ID refers to the latest one),
+    and the rest, including older versions of live keys, are permanently deleted, as are
+    all versions of unreferenced manifests. Delete markers are left alone.
+
+    Only packages in `registry` count as references, so don't sweep prefixes that
+    packages in other registries refer to.
+
+    Args:
+        registry(string): the S3 registry, e.g. 's3://my-bucket'
+        prefixes(list): S3 URLs of the directories to sweep for unreferenced objects;
+            defaults to those `push` copies data to, '<registry>/<package name>/',
+            for each package in the registry. Pass the directories of deleted
+            packages explicitly.
+        dry_run(bool): only report what would be deleted (the default)
+        min_age(datetime.timedelta): never delete anything modified more recently than this,
+            since a package being pushed has its data and manifest written before its pointers
+        max_deletes_per_second(number): limits the rate of deletes; unlimited by default
+        versions(bool): sweep object versions rather than keys, for versioned buckets
+
+    Returns:
+        A tuple of the top hashes of the unreferenced manifests and the S3 URLs
+        of the unreferenced objects (with version IDs, if `versions` is set),
+        which were deleted unless `dry_run` is set
+    """
+    registry = _registry_root(registry)
+    registry_url = urlparse(registry)
+    if registry_url.scheme != 's3':
+        raise NotImplementedError
+    bucket, registry_path, _ = parse_s3_url(registry_url)
+    cutoff = datetime.datetime.now(pytz.utc) - min_age
+
+    # Mark: the manifests that pointers point to are live, and so is everything in them.
+    named_packages_path = registry_path + '.quilt/named_packages/'
+    pointer_keys = [obj['Key'] for obj in list_objects(bucket, named_packages_path)]
+    pkg_names = {'/'.join(key[len(named_packages_path):].split('/')[:2]) for key in pointer_keys}
+
+    def read_pointer(key):
+        pkg_hash, _ = get_bytes(make_s3_url(bucket, key))
+        return pkg_hash.decode('utf-8').strip()
+
+    with ThreadPoolExecutor(LIST_PACKAGES_THREADS) as executor:
+        live_hashes = set(executor.map(read_pointer, pointer_keys))
+
+    packages_path = registry_path + '.quilt/packages/'
+    _, package_objects = list_objects(bucket, packages_path, recursive=False)
+    package_objects = {obj['Key'][len(packages_path):]: obj for obj in package_objects}
+    manifests = {
+        name: obj for name, obj in package_objects.items()
+        if not name.endswith(MANIFEST_SIDECAR_SUFFIXES)
+    }
+
+    referenced = _BloomFilter(sum(
+        manifests[top_hash]['Size'] for top_hash in live_hashes if top_hash in manifests
+    ) // MIN_MANIFEST_LINE_SIZE)
+
+    def mark(top_hash):
+        # A missing manifest raises rather than being skipped, since what it refers to is unknown.
+        keys = []
+        for line in iter_lines(make_s3_url(bucket, packages_path + top_hash)):
+            if not line:
+                continue
+            for physical_key in json.loads(line.decode('utf-8')).get('physical_keys', []):
+                physical_key_url = urlparse(physical_key)
+                if physical_key_url.scheme == 's3':
+                    key_bucket, key, version_id = parse_s3_url(physical_key_url)
+                    if versions and version_id is not None:
+                        key += '?versionId=' + version_id
+                    keys.append(key_bucket + '/' + key)
+            if len(keys) >= DELETE_OBJECTS_MAX_KEYS:
+                referenced.update(keys)
+                keys = []
+        referenced.update(keys)
+
+    with ThreadPoolExecutor(GC_MANIFEST_THREADS) as executor:
+        for _ in executor.map(mark, live_hashes):
+            pass
+
+    # Sweep.
+    garbage_manifests = sorted(
+        top_hash for top_hash, obj in manifests.items()
+        if top_hash not in live_hashes and obj['LastModified'] < cutoff
+    )
+
+    if prefixes is None:
+        prefixes = [registry + name + '/' for name in sorted(pkg_names)]
+
+    def is_referenced(obj_bucket, obj):
+        ref = obj_bucket + '/' + obj['Key']
+        if not versions:
+            return ref in referenced
+        return ref + '?versionId=' + obj['VersionId'] in referenced or (obj['IsLatest'] and ref in referenced)
+
+    garbage_objects = {}  # (bucket, key, version ID or None) -> None, in the order found
+    for prefix in prefixes:
+        prefix_url = urlparse(fix_url(prefix))
+        if prefix_url.scheme != 's3':
+            raise QuiltException("Only S3 prefixes can be swept: %s" % prefix)
+        prefix_bucket, prefix_path, _ = parse_s3_url(prefix_url)
+        if versions:
+            responses = _list_object_versions(Bucket=prefix_bucket, Prefix=prefix_path)
+        else:
+            responses = _list_objects(Bucket=prefix_bucket, Prefix=prefix_path)
+        for response in responses:
+            for obj in response.get('Versions' if versions else 'Contents', []):
+                key = obj['Key']
+                if prefix_bucket == bucket and key.startswith(registry_path + '.quilt/'):
+                    continue
+                if obj['LastModified'] >= cutoff or is_referenced(prefix_bucket, obj):
+                    continue
+                garbage_objects[(prefix_bucket, key, obj.get('VersionId') if versions else None)] = None
+
+    if not dry_run:
+        manifest_names = {
+            name
+            for top_hash in garbage_manifests
+            for name in [top_hash] + [top_hash + suffix for suffix in MANIFEST_SIDECAR_SUFFIXES]
+            if name in package_objects
+        }
+        if versions:
+            manifest_keys = [
+                (obj['Key'], obj['VersionId'])
+                for response in _list_object_versions(Bucket=bucket, Prefix=packages_path, Delimiter='/')
+                for obj in response.get('Versions', [])
+                if obj['Key'][len(packages_path):] in manifest_names
+            ]
+        else:
+            manifest_keys = [packages_path + name for name in sorted(manifest_names)]
+        keys_by_bucket = {bucket: manifest_keys}
+        for obj_bucket, key, version_id in garbage_objects:
+            keys_by_bucket.setdefault(obj_bucket, []).append(key if version_id is None else (key, version_id))
+
+        batch_size = DELETE_OBJECTS_MAX_KEYS
+        if max_deletes_per_second:
+            batch_size = max(1, min(batch_size, int(max_deletes_per_second)))
+        for keys_bucket, keys in keys_by_bucket.items():
+            for start in range(0, len(keys), batch_size):
+                batch_start = time.time()
+                batch = keys[start:start + batch_size]
+                delete_objects(keys_bucket, batch)
+                if max_deletes_per_second:
+                    time.sleep(max(0, len(batch) / max_deletes_per_second - (time.time() - batch_start)))
+
+    return garbage_manifests, [
+        make_s3_url(obj_bucket, key, version_id) for obj_bucket, key, version_id in garbage_objects
+    ]
+
+
 def config(*catalog_url, **config_values):
     """Set or read the T4 configuration.
 
@@ -4,15 +4,28 @@ bucket.py
 Contains the Bucket class, which provides several useful functions
     over an s3 bucket.
 """
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import os
 import pathlib
+import time
 from urllib.parse import urlparse
 
-from .data_transfer import (copy_file, delete_object, get_bytes,
-                            get_size_and_meta, list_object_versions,
-                            list_objects, put_bytes, select)
+from botocore.exceptions import ClientError
+
+from . import data_transfer
+from .bucket_index import BucketIndex
+from .data_transfer import (copy_file, copy_file_list, delete_object, delete_objects, get_bytes,
+                            get_local_etags, get_size_and_meta, iter_listing, list_objects,
+                            put_bytes, select, walk_local_dir, _listing_record_name, _list_objects)
 from .formats import FormatRegistry
-from .search_util import get_search_schema, search
-from .util import QuiltException, find_bucket_config, fix_url, get_from_config, parse_s3_url
+from .search_util import get_search_schema, iter_search, search
+from .util import (QuiltException, find_bucket_config, fix_url, get_catalog_config_url, make_s3_url,
+                   parse_file_url, parse_s3_url)
+
+# Number of objects whose metadata `set_meta_many` rewrites at a time.
+SET_META_BATCH_SIZE = 1000
 
 
 class Bucket(object):
@@ -37,19 +50,15 @@ class Bucket(object):
         self._bucket = bucket
         self._search_endpoint = None
         self._region = None
+        self._ls_cache = {}  # ls arguments -> (time listed, result)
+        self._index = None
 
     def config(self, config_url=None):
         """
         Updates this bucket's search endpoint based on a federation config.
         """
         if not config_url:
-            navigator_url = get_from_config('navigator_url')
-            if not navigator_url:
-                raise QuiltException("Must set `t4.config(navigator_url)`, where `navigator_url` is the URL "
-                                     "of your catalog homepage.")
-
-            navigator_url.rstrip('/') # remove trailing / if present
-            config_url = navigator_url + '/config.json'
+            config_url = get_catalog_config_url()
 
         bucket_config = find_bucket_config(self._bucket, config_url)
         if 'searchEndpoint' in bucket_config:
@@ -69,13 +78,17 @@ class Bucket(object):
         schema = get_search_schema(self._search_endpoint, self._region)
         return schema['user_meta']
 
-    def search(self, query, limit=10):
+    def search(self, query, limit=10, source_includes=None, source_excludes=None):
         """
         Execute a search against the configured search endpoint.
 
         Args:
             query (str): query string to search
             limit (number): maximum number of results to return. Defaults to 10
+            source_includes (list): fields of the source documents to return;
+                defaults to all of them
+            source_excludes (list): fields of the source documents not to return,
+                e.g. ['text'] to skip the (large) indexed text
 
         Query Syntax:
             By default, a normal plaintext search will be executed over the query string.
@@ -98,13 +111,26 @@ class Bucket(object):
                 "time": <timestamp for operation>,
             }...]
             ```
+            newest first. Keys for fields that aren't returned are None.
+        """
+        if not self._search_endpoint:
+            self.config()
+        kwargs = dict(source_includes=source_includes, source_excludes=source_excludes)
+        if self._region:
+            kwargs.update(aws_region=self._region)
+        return search(query, self._search_endpoint, limit=limit, **kwargs)
+
+    def iter_search(self, query, source_includes=None, source_excludes=None):
+        """
+        Like `search`, but returns a generator over all the results, which are
+        fetched from the search endpoint a page at a time.
         """
         if not self._search_endpoint:
             self.config()
+        kwargs = dict(source_includes=source_includes, source_excludes=source_excludes)
         if self._region:
-            return search(
-                query, self._search_endpoint, limit=limit, aws_region=self._region)
-        return search(query, self._search_endpoint, limit=limit)
+            kwargs.update(aws_region=self._region)
+        return iter_search(query, self._search_endpoint, **kwargs)
 
     def deserialize(self, key):
         """
@@ -152,6 +178,7 @@ class Bucket(object):
         all_meta.update(format_meta)
 
         put_bytes(data, dest, all_meta)
+        self._changed(key)
 
     def put_file(self, key, path, meta=None):
         """
@@ -177,6 +204,7 @@ class Bucket(object):
             'user_meta': user_meta,
         }
         copy_file(fix_url(path), dest, all_meta)
+        self._changed(key)
 
     def put_dir(self, key, directory):
         """
@@ -204,16 +232,132 @@ class Bucket(object):
         source_dir = src_path.resolve().as_uri() + '/'
         s3_uri_prefix = self._uri + key
         copy_file(source_dir, s3_uri_prefix)
+        self._changed(key, is_prefix=True)
 
     def keys(self):
         """
-        Lists all keys in the bucket.
+        Lists all keys in the bucket (from the local index, if it has one).
 
         Returns:
             List of strings
         """
+        if self._index is not None:
+            return list(self._index.keys())
         return [x.get('Key') for x in list_objects(self._bucket, '')]
 
+    def exists(self, path):
+        """
+        Checks whether `path` is a key in the bucket or, if it ends in '/',
+        whether there are any keys under it. Uses the local index, if the bucket has one.
+
+        Args:
+            path(str): key or directory to check
+
+        Returns:
+            bool
+        """
+        if self._index is not None:
+            return self._index.exists(path)
+        if path.endswith('/'):
+            response = next(_list_objects(Bucket=self._bucket, Prefix=path, MaxKeys=1))
+            return bool(response.get('Contents'))
+        try:
+            get_size_and_meta(self._uri + path)
+        except ClientError as ex:
+            if ex.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+        return True
+
+    def build_index(self, inventory=None, path=None):
+        """
+        Builds a local index of the keys in the bucket, and uses it to answer `keys`,
+        `exists` and `ls(..., latest_only=True)` from then on. Writes through this
+        Bucket keep it up to date; use `refresh_index` for changes made elsewhere.
+
+        Args:
+            inventory(str): URL of the manifest.json of an S3 Inventory report (CSV or
+                Parquet) to build the index from. By default, the bucket is listed.
+            path(str): where to keep the index; defaults to the T4 cache directory
+
+        Returns:
+            None
+        """
+        index = BucketIndex(path or BucketIndex.default_path(self._bucket))
+        if inventory:
+            index.load_inventory(fix_url(inventory))
+        else:
+            index.refresh(self._bucket)
+        self._use_index(index)
+
+    def load_index(self, path=None):
+        """
+        Uses an index made earlier by `build_index` to answer `keys`, `exists`
+        and `ls(..., latest_only=True)`.
+
+        Args:
+            path(str): where the index is kept; defaults to the T4 cache directory
+
+        Returns:
+            None
+
+        Raises:
+            QuiltException: if there's no index
+        """
+        path = pathlib.Path(path or BucketIndex.default_path(self._bucket))
+        if not path.is_file():
+            raise QuiltException("No index of %s at %s; use build_index" % (self._uri, path))
+        self._use_index(BucketIndex(path))
+
+    def refresh_index(self, prefix=''):
+        """
+        Re-lists the keys starting with `prefix` and updates the local index with them.
+
+        Args:
+            prefix(str): beginning of the keys to refresh; defaults to all of them
+        """
+        if self._index is None:
+            raise QuiltException("Bucket has no index; use build_index or load_index")
+        self._index.refresh(self._bucket, prefix)
+        self._ls_cache.clear()
+
+    def _iter_keys(self, prefix):
+        """
+        Generator over the keys starting with `prefix` (not necessarily a directory).
+        """
+        if self._index is not None:
+            yield from self._index.keys(prefix)
+        else:
+            for response in _list_objects(Bucket=self._bucket, Prefix=prefix):
+                for obj in response.get('Contents', []):
+                    yield obj['Key']
+
+    def _use_index(self, index):
+        if self._index is not None:
+            self._index.close()
+        self._index = index
+        self._ls_cache.clear()
+
+    def _changed(self, key, is_prefix=False):
+        """
+        Invalidates listings after writing a key, or the keys that start with it.
+        """
+        self._ls_cache.clear()
+        if self._index is not None:
+            if is_prefix:
+                self._index.refresh(self._bucket, key)
+            else:
+                self._index.refresh_key(self._bucket, key)
+
+    def _deleted(self, keys):
+        """
+        Invalidates listings after deleting keys; they're removed from the index
+        without listing them again.
+        """
+        self._ls_cache.clear()
+        if self._index is not None:
+            self._index.delete_keys(keys)
+
     def delete(self, key):
         """
         Deletes a key from the bucket.
@@ -234,6 +378,7 @@ class Bucket(object):
             raise QuiltException("Must use delete_dir to delete directories")
 
         delete_object(self._bucket, key)
+        self._deleted([key])
 
     def delete_dir(self, path):
         """Delete a directory and all of its contents from the bucket.
@@ -242,28 +387,103 @@ class Bucket(object):
                 path (str): path to the directory to delete
         """
         results = list_objects(self._bucket, path)
-        for result in results:
-            self.delete(result['Key'])
-
-    def ls(self, path=None, recursive=False):
+        deleted = []
+        try:
+            for result in results:
+                delete_object(self._bucket, result['Key'])
+                deleted.append(result['Key'])
+        finally:
+            self._deleted(deleted)
+
+    def ls(self, path=None, recursive=False, latest_only=False, limit=None, start_after=None,
+           cache_ttl=None):
         """List data from the specified path.
 
         Parameters:
             path (str): bucket path to list
             recursive (bool): show subdirectories and their contents as well
+            latest_only (bool): list only the current version of each object, which
+                is much faster for prefixes with many versions
+            limit (int): list at most this many keys (with all their versions)
+                and directories
+            start_after (str): list the keys and directories after this one, e.g. the
+                last one in the previous page
+            cache_ttl (number): reuse the result of an identical call made less than
+                this many seconds ago. Writes through this Bucket clear the cache.
 
         Returns:
             ``list``: Return value structure has not yet been permanently decided
             Currently, it's a ``tuple`` of ``list`` objects, containing the
             following: (directory info, file/object info, delete markers).
+            With `latest_only`, delete markers are omitted, and so are directories if
+            `recursive`; with `recursive` alone, directories are omitted.
         """
+        path = self._ls_path(path)
+        cache_key = (path, recursive, latest_only, limit, start_after)
+        if cache_ttl:
+            cached = self._ls_cache.get(cache_key)
+            if cached is not None and time.time() - cached[0] < cache_ttl:
+                return self._copy_ls_result(cached[1])
+
+        listed_at = time.time()
+        records = self.iter_ls(path, recursive=recursive, latest_only=latest_only,
+                               start_after=start_after)
+        if limit is not None:
+            names = itertools.groupby(records, key=_listing_record_name)
+            records = (record for _, group in itertools.islice(names, limit) for record in group)
+
+        prefixes, objects, delete_markers = [], [], []
+        for record in records:
+            if 'Prefix' in record:
+                prefixes.append(record)
+            elif record.get('DeleteMarker'):
+                delete_markers.append(record)
+            else:
+                objects.append(record)
+
+        if latest_only:
+            result = objects if recursive else (prefixes, objects)
+        else:
+            result = (objects, delete_markers) if recursive else (prefixes, objects, delete_markers)
+
+        if cache_ttl:
+            self._ls_cache[cache_key] = (listed_at, result)
+            return self._copy_ls_result(result)
+        return result
+
+    def iter_ls(self, path=None, recursive=False, latest_only=False, start_after=None):
+        """Lazily list data from the specified path, requesting a page at a time.
+
+        Parameters:
+            path (str): bucket path to list
+            recursive (bool): show subdirectories and their contents as well
+            latest_only (bool): list only the current version of each object
+            start_after (str): list the keys and directories after this one
+
+        Returns:
+            A generator of the directory, object and delete marker dicts that `ls`
+            returns, in key order. Directories have a 'Prefix'; delete markers
+            have 'DeleteMarker': True.
+        """
+        path = self._ls_path(path)
+        if latest_only and self._index is not None:
+            return self._index.iter_listing(path, recursive=recursive, start_after=start_after)
+        return iter_listing(self._bucket, path, recursive=recursive,
+                            versions=not latest_only, start_after=start_after)
+
+    @staticmethod
+    def _ls_path(path):
         if path and not path.endswith('/'):
             path += '/'
         elif not path:
             path = ""  # enumerate top-of-bucket
+        return path
 
-        results = list_object_versions(self._bucket, path, recursive=recursive)
-        return results
+    @staticmethod
+    def _copy_ls_result(result):
+        if isinstance(result, list):
+            return list(result)
+        return tuple(list(records) for records in result)
 
     def fetch(self, key, path):
         """
@@ -289,6 +509,108 @@ class Bucket(object):
         dest_uri = fix_url(path)
         copy_file(source_uri, dest_uri)
 
+    def sync(self, src, dest, delete=False, compare='etag', dry_run=False):
+        """
+        Copies the files that differ between a local directory and a directory in the
+        bucket, in either direction. Each side is listed once, and only new and changed
+        files are copied.
+
+        Args:
+            src(str): directory to copy from: a local path, or the S3 URL of a
+                directory in this bucket
+            dest(str): directory to copy to, likewise; one of `src` and `dest`
+                must be local, and the other in this bucket
+            delete(bool): delete files in `dest` that aren't in `src`
+            compare(str): how to tell whether a file in `dest` is up to date:
+                'etag' if it has the same size and ETag as in `src` (ETags of local files
+                are cached, so unchanged files are only read once), or 'mtime' if it has
+                the same size and isn't older than in `src`
+            dry_run(bool): only report what would be copied and deleted
+
+        Returns:
+            dict of the relative paths that were 'copied', 'skipped' (up to date)
+            and 'deleted'
+
+        Raises:
+            QuiltException: if `src` and `dest` aren't a local directory and one in this bucket
+        """
+        if compare not in ('etag', 'mtime'):
+            raise QuiltException("compare must be 'etag' or 'mtime'")
+
+        src_url = urlparse(fix_url(src))
+        dest_url = urlparse(fix_url(dest))
+        if {src_url.scheme, dest_url.scheme} != {'file', 's3'}:
+            raise QuiltException("Must sync between a local directory and a directory in the bucket")
+        upload = src_url.scheme == 'file'
+        local_url, remote_url = (src_url, dest_url) if upload else (dest_url, src_url)
+
+        bucket, prefix, version_id = parse_s3_url(remote_url)
+        if bucket != self._bucket or version_id:
+            raise QuiltException("Can only sync with a directory in %s" % self._uri)
+        prefix = self._ls_path(prefix)
+        local_dir = pathlib.Path(parse_file_url(local_url))
+        if upload and not local_dir.is_dir():
+            raise QuiltException("Not a directory: %s" % local_dir)
+
+        # Relative path -> (size, ETag, mtime)
+        remote_files = {
+            record['Key'][len(prefix):]: (record['Size'], record['ETag'], record['LastModified'].timestamp())
+            for record in self.iter_ls(prefix, recursive=True, latest_only=True)
+            if not record['Key'].endswith('/')
+        }
+        local_files = {}
+        if local_dir.is_dir():
+            local_files = {rel_path: (size, None, mtime) for rel_path, size, mtime in walk_local_dir(local_dir)}
+        src_files, dest_files = (local_files, remote_files) if upload else (remote_files, local_files)
+
+        candidates = [
+            rel_path for rel_path, (size, _, _) in src_files.items()
+            if rel_path in dest_files and dest_files[rel_path][0] == size
+        ]
+        if compare == 'etag':
+            local_etags = get_local_etags(
+                (local_dir / rel_path, local_files[rel_path][0], local_files[rel_path][2])
+                for rel_path in candidates
+            )
+            skipped = [
+                rel_path for rel_path, local_etag in zip(candidates, local_etags)
+                if local_etag == remote_files[rel_path][1]
+            ]
+        else:
+            skipped = [
+                rel_path for rel_path in candidates
+                if dest_files[rel_path][2] >= src_files[rel_path][2]
+            ]
+
+        skipped_set = set(skipped)
+        copied = sorted(rel_path for rel_path in src_files if rel_path not in skipped_set)
+        deleted = sorted(rel_path for rel_path in dest_files if rel_path not in src_files) if delete else []
+
+        if not dry_run:
+            def local_file_url(rel_path):
+                return (local_dir / rel_path).as_uri()
+
+            def remote_file_url(rel_path):
+                return make_s3_url(self._bucket, prefix + rel_path)
+
+            src_file_url, dest_file_url = (
+                (local_file_url, remote_file_url) if upload else (remote_file_url, local_file_url)
+            )
+            if copied:
+                copy_file_list([
+                    (src_file_url(rel_path), dest_file_url(rel_path), src_files[rel_path][0], None)
+                    for rel_path in copied
+                ])
+            if upload:
+                delete_objects(self._bucket, [prefix + rel_path for rel_path in deleted])
+                if copied or deleted:
+                    self._changed(prefix, is_prefix=True)
+            else:
+                for rel_path in deleted:
+                    (local_dir / rel_path).unlink()
+
+        return dict(copied=copied, skipped=sorted(skipped), deleted=deleted)
+
     def get_meta(self, key):
         """
         Gets the metadata associated with a `key` in the bucket.
@@ -323,6 +645,138 @@ class Bucket(object):
         size, existing_meta, _ = get_size_and_meta(key_uri)
         existing_meta['user_meta'] = meta
         copy_file(key_uri, key_uri, existing_meta, size)
+        self._changed(key)
+
+    def set_meta_many(self, mapping_or_prefix, meta_fn=None):
+        """
+        Sets user metadata on many keys in the bucket at once, copying the objects
+        onto themselves in parallel. If the bucket has a local index, the updated keys'
+        longest common prefix is re-listed once at the end to bring it up to date.
+
+        Args:
+            mapping_or_prefix(dict or str): either a dict of keys to the user metadata
+                to set on them, or a prefix of the keys to update with `meta_fn`
+            meta_fn(callable): for a prefix, a function of a key and its current user
+                metadata that returns its new user metadata, or None to leave it alone
+
+        Returns:
+            dict of the keys that failed to the exceptions that happened to them
+
+        Raises:
+            QuiltException: if a prefix is given without `meta_fn`
+        """
+        if isinstance(mapping_or_prefix, str):
+            if meta_fn is None:
+                raise QuiltException("Must specify meta_fn to set metadata on a prefix")
+            keys = self._iter_keys(mapping_or_prefix)
+            get_user_meta = meta_fn
+        else:
+            keys = iter(mapping_or_prefix)
+
+            def get_user_meta(key, user_meta):  # pylint: disable=unused-argument
+                return mapping_or_prefix[key]
+
+        errors = {}
+        updates = []
+        updated_keys = []
+
+        def get_new_meta(key):
+            url = make_s3_url(self._bucket, key)
+            try:
+                size, meta, _ = get_size_and_meta(url)
+                user_meta = get_user_meta(key, meta.get('user_meta', {}))
+            except Exception as ex:  # pylint: disable=broad-except
+                errors[key] = ex
+                return None
+            if user_meta is None:
+                return None
+            meta['user_meta'] = user_meta
+            return key, (url, url, size, meta)
+
+        def copy_updates():
+            copy_errors = {}
+            copy_file_list([file_args for _, file_args in updates], errors=copy_errors)
+            for idx, (key, _) in enumerate(updates):
+                if idx in copy_errors:
+                    errors[key] = copy_errors[idx]
+                else:
+                    updated_keys.append(key)
+            updates.clear()
+
+        def add_update(update):
+            if update is not None:
+                updates.append(update)
+            if len(updates) >= SET_META_BATCH_SIZE:
+                copy_updates()
+
+        # Every object's current metadata (e.g. its format) has to be kept, so it needs a HEAD.
+        # Keys are streamed through a bounded number of HEADs in flight, and copied in batches.
+        max_pending = data_transfer.s3_threads
+        with ThreadPoolExecutor(max_pending) as executor:
+            pending = collections.deque()
+            for key in keys:
+                pending.append(executor.submit(get_new_meta, key))
+                if len(pending) >= max_pending:
+                    add_update(pending.popleft().result())
+            while pending:
+                add_update(pending.popleft().result())
+        if updates:
+            copy_updates()
+        if updated_keys:
+            self._changed(os.path.commonprefix(updated_keys), is_prefix=True)
+
+        return errors
+
+    def select_many(self, prefix_or_keys, query, lazy=False, key_column='key', threads=None):
+        """
+        Selects data from many S3 objects, querying them in parallel. Each object is
+        queried with its metadata, like `select`, so its format and format options apply.
+
+        Args:
+            prefix_or_keys(str or list): prefix of the keys to query, or a list of keys
+            query(str): query to execute on each object (SQL by default)
+            lazy(bool): return a generator of (key, pandas.DataFrame) pairs
+                instead of a single DataFrame
+            key_column(str): name of the column to add the key of each row's object in
+            threads(int): number of objects to query at once; defaults to
+                `t4.data_transfer.s3_select_threads`
+
+        Returns:
+            pandas.DataFrame: results of all the queries, in key order
+        """
+        if isinstance(prefix_or_keys, str):
+            keys = (key for key in self._iter_keys(prefix_or_keys) if not key.endswith('/'))
+        else:
+            keys = iter(prefix_or_keys)
+
+        def select_key(key):
+            url = make_s3_url(self._bucket, key)
+            return select(url, query, meta=get_size_and_meta(url)[1])
+
+        def iter_results():
+            max_pending = threads or data_transfer.s3_select_threads
+            with ThreadPoolExecutor(max_pending) as executor:
+                # Keep a bounded number of queries in flight, and return results in order.
+                pending = collections.deque()
+                try:
+                    for key in keys:
+                        pending.append((key, executor.submit(select_key, key)))
+                        if len(pending) >= max_pending:
+                            done_key, future = pending.popleft()
+                            yield done_key, future.result()
+                    while pending:
+                        done_key, future = pending.popleft()
+                        yield done_key, future.result()
+                finally:
+                    for _, future in pending:
+                        future.cancel()
+
+        if lazy:
+            return iter_results()
+
+        from pandas import concat, DataFrame  # Lazy import for slow module
+        frames = [df.assign(**{key_column: key}) for key, df in iter_results()]
+        return concat(frames, ignore_index=True, sort=False) if frames else DataFrame()
 
     def select(self, key, query, raw=False):
         """
@@ -0,0 +1,261 @@
+"""
+bucket_index.py
+
+Contains the BucketIndex class, a local SQLite index of the objects in an S3 bucket,
+which answers listing and existence queries without listing the bucket.
+"""
+import csv
+import datetime
+import gzip
+import io
+import json
+import pathlib
+import sqlite3
+from urllib.parse import unquote_plus
+
+from .data_transfer import _list_objects, get_bytes
+from .util import CACHE_PATH, QuiltException
+
+BUCKET_INDEX_PATH = CACHE_PATH / 'bucket_index'
+# Rows inserted per statement when building or refreshing an index.
+INSERT_BATCH_SIZE = 10000
+
+INVENTORY_PARQUET_COLUMNS = {
+    'key': 'Key',
+    'size': 'Size',
+    'last_modified_date': 'LastModifiedDate',
+    'e_tag': 'ETag',
+    'is_latest': 'IsLatest',
+    'is_delete_marker': 'IsDeleteMarker',
+}
+
+
+def _prefix_end(prefix):
+    """
+    Returns the smallest string greater than every string that starts with `prefix`,
+    or None for the empty prefix.
+    """
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class BucketIndex(object):
+    """
+    Local index of the latest versions of the objects in a bucket: their keys, sizes,
+    ETags and modification times. It reflects the bucket as of the listing or inventory
+    report it was built from, plus any refreshes since.
+    """
+    def __init__(self, path):
+        """
+        Opens the index at `path` (see `BucketIndex.default_path`), creating an empty one
+        if there is none.
+        """
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path))
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS objects ('
+                'key TEXT PRIMARY KEY, size INTEGER, etag TEXT, last_modified REAL, '
+                'generation INTEGER) WITHOUT ROWID'
+            )
+            self._db.execute('CREATE TABLE IF NOT EXISTS info (name TEXT PRIMARY KEY, value TEXT)')
+
+    @staticmethod
+    def default_path(bucket):
+        return BUCKET_INDEX_PATH / f'{bucket}.sqlite'
+
+    def _get_info(self, name, default=None):
+        row = self._db.execute('SELECT value FROM info WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_info(self, name, value):
+        self._db.execute('INSERT OR REPLACE INTO info VALUES (?, ?)', (name, json.dumps(value)))
+
+    def _key_range(self, prefix):
+        end = _prefix_end(prefix)
+        if end is None:
+            return 'key >= ?', (prefix,)
+        return 'key >= ? AND key < ?', (prefix, end)
+
+    def _replace(self, records, prefix):
+        """
+        Replaces the rows under `prefix` with `records` of (key, size, ETag, timestamp).
+        """
+        with self._db:
+            generation = self._get_info('generation', 0) + 1
+            self._set_info('generation', generation)
+            for batch in _batches(records, INSERT_BATCH_SIZE):
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)',
+                    [record + (generation,) for record in batch]
+                )
+            condition, params = self._key_range(prefix)
+            self._db.execute(
+                f'DELETE FROM objects WHERE {condition} AND generation < ?',
+                params + (generation,)
+            )
+
+    def refresh(self, bucket, prefix=''):
+        """
+        Re-lists the keys in `bucket` that start with `prefix` (not necessarily a directory)
+        and brings the index up to date for them.
+        """
+        def records():
+            for response in _list_objects(Bucket=bucket, Prefix=prefix):
+                for obj in response.get('Contents', []):
+                    yield (obj['Key'], obj['Size'], obj['ETag'], obj['LastModified'].timestamp())
+
+        self._replace(records(), prefix)
+
+    def refresh_key(self, bucket, key):
+        """
+        Brings the index up to date for a single key.
+        """
+        # A key sorts before everything else it's a prefix of.
+        response = next(_list_objects(Bucket=bucket, Prefix=key, MaxKeys=1))
+        objects = [obj for obj in response.get('Contents', []) if obj['Key'] == key]
+        with self._db:
+            if objects:
+                obj = objects[0]
+                self._db.execute(
+                    'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)',
+                    (key, obj['Size'], obj['ETag'], obj['LastModified'].timestamp(),
+                     self._get_info('generation', 0))
+                )
+            else:
+                self._db.execute('DELETE FROM objects WHERE key = ?', (key,))
+
+    def delete_keys(self, keys):
+        """
+        Removes keys that were deleted from the bucket, without listing it.
+        """
+        with self._db:
+            for batch in _batches(keys, INSERT_BATCH_SIZE):
+                self._db.executemany('DELETE FROM objects WHERE key = ?', [(key,) for key in batch])
+
+    def load_inventory(self, manifest_url):
+        """
+        Replaces the contents of the index with an S3 Inventory report (in CSV or
+        Parquet format), given the URL of its manifest.json.
+        """
+        manifest_bytes, _ = get_bytes(manifest_url)
+        manifest = json.loads(manifest_bytes.decode('utf-8'))
+        destination_bucket = manifest['destinationBucket'].split(':')[-1]
+        file_format = manifest['fileFormat']
+        if file_format == 'CSV':
+            read_file = self._read_inventory_csv
+            columns = [column.strip() for column in manifest['fileSchema'].split(',')]
+        elif file_format == 'Parquet':
+            read_file = self._read_inventory_parquet
+            columns = None
+        else:
+            raise QuiltException("Unsupported S3 Inventory format: %s" % file_format)
+
+        def records():
+            for inventory_file in manifest['files']:
+                data, _ = get_bytes(f"s3://{destination_bucket}/{inventory_file['key']}")
+                for row in read_file(data, columns):
+                    if row.get('IsLatest', 'true') != 'true' or row.get('IsDeleteMarker') == 'true':
+                        continue
+                    last_modified = datetime.datetime.strptime(
+                        row['LastModifiedDate'], '%Y-%m-%dT%H:%M:%S.%fZ'
+                    ).replace(tzinfo=datetime.timezone.utc)
+                    yield (row['Key'], int(row['Size']), '"%s"' % row['ETag'], last_modified.timestamp())
+
+        self._replace(records(), '')
+        with self._db:
+            self._set_info('inventory', manifest_url)
+
+    @staticmethod
+    def _read_inventory_csv(data, columns):
+        reader = csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(data)), 'utf-8'))
+        for values in reader:
+            row = dict(zip(columns, values))
+            # CSV reports have URL-encoded keys.
+            row['Key'] = unquote_plus(row['Key'])
+            yield row
+
+    @staticmethod
+    def _read_inventory_parquet(data, columns):  # pylint: disable=unused-argument
+        from pyarrow import parquet  # Lazy import for slow module
+
+        table = parquet.read_table(io.BytesIO(data))
+        for record in table.to_pandas().to_dict('records'):
+            row = {
+                INVENTORY_PARQUET_COLUMNS[name]: value for name, value in record.items()
+                if name in INVENTORY_PARQUET_COLUMNS
+            }
+            for flag in ('IsLatest', 'IsDeleteMarker'):
+                if flag in row:
+                    row[flag] = 'true' if row[flag] else 'false'
+            if hasattr(row['LastModifiedDate'], 'strftime'):
+                row['LastModifiedDate'] = row['LastModifiedDate'].strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            yield row
+
+    def keys(self, prefix=''):
+        """
+        Generator over the keys that start with `prefix`, in order.
+        """
+        condition, params = self._key_range(prefix)
+        for key, in self._db.execute(f'SELECT key FROM objects WHERE {condition} ORDER BY key', params):
+            yield key
+
+    def exists(self, path):
+        """
+        Whether `path` is a key, or (if it ends in '/') whether there are keys under it.
+        """
+        if path.endswith('/'):
+            condition, params = self._key_range(path)
+        else:
+            condition, params = 'key = ?', (path,)
+        row = self._db.execute(f'SELECT 1 FROM objects WHERE {condition} LIMIT 1', params).fetchone()
+        return row is not None
+
+    def iter_listing(self, prefix, recursive=True, start_after=None):
+        """
+        Generator over the records under `prefix`, in the form and order of
+        `data_transfer.iter_listing` for latest versions.
+        """
+        end = _prefix_end(prefix)
+        # Keys before the prefix aren't under it, even if they're after `start_after`.
+        lower, lower_op = (start_after, '>') if start_after and start_after >= prefix else (prefix, '>=')
+        while True:
+            query = f'SELECT key, size, etag, last_modified FROM objects WHERE key {lower_op} ?'
+            params = (lower,)
+            if end is not None:
+                query += ' AND key < ?'
+                params += (end,)
+            for key, size, etag, last_modified in self._db.execute(query + ' ORDER BY key', params):
+                if not recursive:
+                    slash = key.find('/', len(prefix))
+                    if slash != -1:
+                        subdir = key[:slash + 1]
+                        if subdir != start_after:
+                            yield {'Prefix': subdir}
+                        # Skip the rest of the directory.
+                        lower, lower_op = _prefix_end(subdir), '>='
+                        break
+                yield {
+                    'Key': key,
+                    'Size': size,
+                    'ETag': etag,
+                    'LastModified': datetime.datetime.fromtimestamp(last_modified, datetime.timezone.utc),
+                }
+            else:
+                return
+
+    def close(self):
+        self._db.close()
+
@@ -1,11 +1,17 @@
 from codecs import iterdecode
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import closing
+import functools
 import hashlib
+import heapq
+import io
 import itertools
 import json
+import os
 import pathlib
 import platform
 import shutil
+import sqlite3
 from threading import Lock
 from urllib.parse import urlparse
 
@@ -25,7 +31,7 @@ with warnings.catch_warnings():
 
 import jsonlines
 
-from .util import QuiltException, make_s3_url, parse_file_url, parse_s3_url
+from .util import CACHE_PATH, QuiltException, make_s3_url, parse_file_url, parse_s3_url
 from . import xattr
 
 
@@ -47,11 +53,21 @@ else:
 
 s3_transfer_config = TransferConfig()
 s3_threads = 4
+# Scanning local directories is bound by file system metadata latency (especially on
+# network file systems), so it's worth many more threads than CPUs.
+local_scan_threads = 16
+# S3 Select requests are mostly waiting for S3 to scan the objects.
+s3_select_threads = 8
 
 # When uploading files at least this size, compare the ETags first and skip the upload if they're equal;
 # copy the remote file onto itself if the metadata changes.
 UPLOAD_ETAG_OPTIMIZATION_THRESHOLD = 1024
 
+# The most keys S3 accepts in a single DeleteObjects request.
+DELETE_OBJECTS_MAX_KEYS = 1000
+
+LOCAL_ETAG_CACHE_PATH = CACHE_PATH / 'etags.sqlite'
+
 
 def _update_credentials(credentials):
     session = get_session()
@@ -352,10 +368,13 @@ class WorkerContext(object):
         self.run = run
 
 
-def _copy_file_list_internal(file_list):
+def _copy_file_list_internal(file_list, errors=None):
     """
     Takes a list of tuples (src, dest, size, override_meta) and copies the data in parallel.
     Returns versioned URLs for S3 destinations and regular file URLs for files.
+
+    If `errors` is a dict, failed copies don't raise: their exceptions are stored in it
+    by index, and their results are None.
     """
     total_size = sum(size for _, _, size, _ in file_list)
 
@@ -370,8 +389,17 @@ def _copy_file_list_internal(file_list):
             with lock:
                 progress.update(size)
 
-        def run_task(func, *args):
-            future = executor.submit(func, *args)
+        def run_task(idx, func, *args):
+            def task():
+                try:
+                    func(*args)
+                except Exception as ex:  # pylint: disable=broad-except
+                    if errors is None:
+                        raise
+                    with lock:
+                        errors.setdefault(idx, ex)
+
+            future = executor.submit(task)
             with lock:
                 futures.append(future)
 
@@ -382,7 +410,8 @@ def _copy_file_list_internal(file_list):
                     assert results[idx] is None
                     results[idx] = value
 
-            ctx = WorkerContext(progress=progress_callback, done=done_callback, run=run_task)
+            ctx = WorkerContext(progress=progress_callback, done=done_callback,
+                                run=functools.partial(run_task, idx))
 
             if src_url.scheme == 'file':
                 src_path = parse_file_url(src_url)
@@ -413,7 +442,7 @@ def _copy_file_list_internal(file_list):
                 raise NotImplementedError
 
         for idx, args in enumerate(file_list):
-            run_task(worker, idx, *args)
+            run_task(idx, worker, idx, *args)
 
         # ThreadPoolExecutor does not appear to have a way to just wait for everything to complete.
         # Shutting it down will cause it to wait - but will prevent any new tasks from starting.
@@ -426,7 +455,8 @@ def _copy_file_list_internal(file_list):
                 future = futures.pop()
             future.result()
 
-    assert all(results)
+    if errors is None:
+        assert all(results)
 
     return results
 
@@ -455,6 +485,38 @@ def _calculate_etag(file_path):
     return '"%s"' % etag
 
 
+def get_local_etags(files):
+    """
+    Returns the ETags (as calculated by `_calculate_etag`) of local files, given as tuples
+    of (path, size, mtime). ETags are cached by path, size and mtime, so unchanged files
+    are only read once; the others are read in parallel.
+    """
+    files = [(str(pathlib.Path(path).resolve()), size, mtime) for path, size, mtime in files]
+    etags = [None] * len(files)
+
+    LOCAL_ETAG_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with closing(sqlite3.connect(str(LOCAL_ETAG_CACHE_PATH))) as db:
+        db.execute('CREATE TABLE IF NOT EXISTS etags '
+                   '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, etag TEXT)')
+        missing = []
+        for idx, (path, size, mtime) in enumerate(files):
+            row = db.execute('SELECT etag FROM etags WHERE path = ? AND size = ? AND mtime = ?',
+                             (path, size, mtime)).fetchone()
+            if row is None:
+                missing.append(idx)
+            else:
+                etags[idx] = row[0]
+
+        with ThreadPoolExecutor(local_scan_threads) as executor:
+            for idx, etag in zip(missing, executor.map(_calculate_etag, [files[idx][0] for idx in missing])):
+                etags[idx] = etag
+
+        with db:
+            db.executemany('INSERT OR REPLACE INTO etags VALUES (?, ?, ?, ?)',
+                           [files[idx] + (etags[idx],) for idx in missing])
+    return etags
+
+
 def delete_object(bucket, key):
     if key.endswith('/'):
         for response in _list_objects(Bucket=bucket, Prefix=key):
@@ -465,6 +527,31 @@ def delete_object(bucket, key):
         s3_client.delete_object(Bucket=bucket, Key=key)  # Actually delete it
 
 
+def delete_objects(bucket, keys):
+    """
+    Deletes keys from a bucket with as few requests as possible (up to 1000 keys each).
+    Keys that don't exist are not an error. A (key, version ID) tuple deletes that
+    version of the key; in a versioned bucket, deleting just a key only adds a delete marker.
+    """
+    objects = [
+        dict(Key=key) if isinstance(key, str) else dict(Key=key[0], VersionId=key[1])
+        for key in keys
+    ]
+    errors = []
+    for start in range(0, len(objects), DELETE_OBJECTS_MAX_KEYS):
+        response = s3_client.delete_objects(
+            Bucket=bucket,
+            Delete=dict(
+                Objects=objects[start:start + DELETE_OBJECTS_MAX_KEYS],
+                Quiet=True
+            )
+        )
+        errors += response.get('Errors', [])
+    if errors:
+        raise QuiltException("Failed to delete %d object(s) from %s, e.g. %s: %s" % (
+            len(errors), bucket, errors[0]['Key'], errors[0]['Message']))
+
+
 def list_object_versions(bucket, prefix, recursive=True):
     if prefix and not prefix.endswith('/'):
         raise ValueError("Prefix must end with /")
@@ -492,6 +579,51 @@ def list_object_versions(bucket, prefix, recursive=True):
         return prefixes, versions, delete_markers
 
 
+def _listing_record_name(record):
+    return record['Prefix'] if 'Prefix' in record else record['Key']
+
+
+def iter_listing(bucket, prefix, recursive=True, versions=False, start_after=None):
+    """
+    Generator over the records under a prefix, in key order, requesting one page at a time.
+
+    Records are the dicts S3 returns for objects (or, if `versions` is set, for object
+    versions and delete markers, the latter with 'DeleteMarker': True added) and,
+    when not `recursive`, for directories (with just a 'Prefix').
+    Listing starts after the key or directory `start_after`.
+    """
+    if prefix and not prefix.endswith('/'):
+        raise ValueError("Prefix must end with /")
+
+    list_obj_params = dict(Bucket=bucket, Prefix=prefix)
+    if not recursive:
+        # Treat '/' as a directory separator and only return one level of files instead of everything.
+        list_obj_params.update(dict(Delimiter='/'))
+
+    if versions:
+        if start_after:
+            list_obj_params.update(dict(KeyMarker=start_after))
+        responses = _list_object_versions(**list_obj_params)
+    else:
+        if start_after:
+            list_obj_params.update(dict(StartAfter=start_after))
+        responses = _list_objects(**list_obj_params)
+
+    for response in responses:
+        # Keys under start_after come after it, so S3 returns it again as a directory.
+        prefixes = [p for p in response.get('CommonPrefixes', []) if p['Prefix'] != start_after]
+        if versions:
+            delete_markers = [dict(marker, DeleteMarker=True) for marker in response.get('DeleteMarkers', [])]
+            # Each key's versions and delete markers, newest first.
+            records = heapq.merge(
+                response.get('Versions', []), delete_markers,
+                key=lambda record: (record['Key'], -record['LastModified'].timestamp())
+            )
+        else:
+            records = response.get('Contents', [])
+        yield from heapq.merge(prefixes, records, key=_listing_record_name)
+
+
 def list_objects(bucket, prefix, recursive=True):
     if prefix and not prefix.endswith('/'):
         raise ValueError("Prefix must end with /")
@@ -514,6 +646,60 @@ def list_objects(bucket, prefix, recursive=True):
         return prefixes, objects
 
 
+def _scan_local_dir(path, rel_path, ignore):
+    files = []
+    subdirs = []
+    try:
+        dir_entries = os.scandir(path)
+    except (FileNotFoundError, PermissionError):
+        return files, subdirs
+
+    with dir_entries:
+        for dir_entry in dir_entries:
+            try:
+                # Like Path.rglob, don't descend into symlinked directories.
+                if dir_entry.is_dir(follow_symlinks=False):
+                    if ignore is None or not ignore.match(rel_path + dir_entry.name, is_dir=True):
+                        subdirs.append((dir_entry.path, rel_path + dir_entry.name + '/'))
+                elif dir_entry.is_file():
+                    if ignore is None or not ignore.match(rel_path + dir_entry.name):
+                        stat = dir_entry.stat()
+                        files.append((rel_path + dir_entry.name, stat.st_size, stat.st_mtime))
+            except FileNotFoundError:
+                # If a file does not exist, is it really a file?
+                pass
+    return files, subdirs
+
+
+def walk_local_dir(path, threads=None, ignore=None):
+    """
+    Generator over all files under a local directory, as tuples of
+    (relative path in POSIX form, size, mtime), in no particular order.
+
+    Subdirectories are scanned in parallel with `os.scandir`, which gets the file
+    types from the directory listing itself, so each file only needs one `stat`.
+
+    Args:
+        path: a local directory
+        threads: number of directories to scan at once; defaults to `local_scan_threads`
+        ignore(QuiltIgnore): rules for files to skip; ignored directories aren't scanned at all
+    """
+    with ThreadPoolExecutor(threads or local_scan_threads) as executor:
+        pending = {executor.submit(_scan_local_dir, str(path), '', ignore)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, subdirs = future.result()
+                    for subdir_path, subdir_rel_path in subdirs:
+                        pending.add(executor.submit(_scan_local_dir, subdir_path, subdir_rel_path, ignore))
+                    yield from files
+        finally:
+            # Stopped early; don't scan the rest of the tree.
+            for future in pending:
+                future.cancel()
+
+
 def list_url(src):
     src_url = urlparse(src)
     if src_url.scheme == 'file':
@@ -522,14 +708,8 @@ def list_url(src):
         if not src_file.is_dir():
             raise ValueError("Not a directory: %r" % src_url)
 
-        for f in src_file.rglob('*'):
-            try:
-                if f.is_file():
-                    size = f.stat().st_size
-                    yield f.relative_to(src_file).as_posix(), size
-            except FileNotFoundError:
-                # If a file does not exist, is it really a file?
-                pass
+        for rel_path, size, _ in walk_local_dir(src_file):
+            yield rel_path, size
     elif src_url.scheme == 's3':
         src_bucket, src_path, src_version_id = parse_s3_url(src_url)
         if src_version_id is not None:
@@ -550,11 +730,14 @@ def _looks_like_dir(s):
     return not s or s.endswith('/')
 
 
-def copy_file_list(file_list):
+def copy_file_list(file_list, errors=None):
     """
     Takes a list of tuples (src, dest, size, override_meta) and copies them in parallel.
     URLs must be regular files, not directories.
     Returns versioned URLs for S3 destinations and regular file URLs for files.
+
+    If `errors` is a dict, failed copies don't raise: their exceptions are stored in it
+    by index, and their results are None.
     """
     processed_file_list = []
     for src, dest, size, override_meta in file_list:
@@ -568,7 +751,7 @@ def copy_file_list(file_list):
 
         processed_file_list.append((src_url, dest_url, size, override_meta))
 
-    return _copy_file_list_internal(processed_file_list)
+    return _copy_file_list_internal(processed_file_list, errors)
 
 
 def copy_file(src, dest, override_meta=None, size=None):
@@ -658,6 +841,122 @@ def get_bytes(src):
         raise NotImplementedError
     return data, meta
 
+def iter_lines(src, chunk_size=1024 * 1024):
+    """
+    Generator over the lines (as bytes, without line endings) of the object at a given URL.
+    S3 objects are streamed in chunks rather than read into memory all at once.
+    """
+    src_url = urlparse(src)
+    if src_url.scheme == 'file':
+        with open(parse_file_url(src_url), 'rb') as fd:
+            for line in fd:
+                yield line.rstrip(b'\n')
+    elif src_url.scheme == 's3':
+        src_bucket, src_path, src_version_id = parse_s3_url(src_url)
+        params = dict(Bucket=src_bucket, Key=src_path)
+        if src_version_id is not None:
+            params.update(dict(VersionId=src_version_id))
+        body = s3_client.get_object(**params)['Body']
+        pending = b''
+        while True:
+            chunk = body.read(chunk_size)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            yield from lines
+        if pending:
+            yield pending
+    else:
+        raise NotImplementedError
+
+
+def get_bytes_if_changed(src, etag=None):
+    """
+    Gets an S3 object unless its ETag still matches `etag`, using a conditional GET.
+
+    Returns:
+        data (None if the object has not changed), etag
+    """
+    src_bucket, src_path, src_version_id = parse_s3_url(urlparse(src))
+    params = dict(Bucket=src_bucket, Key=src_path)
+    if src_version_id is not None:
+        params.update(dict(VersionId=src_version_id))
+    if etag is not None:
+        params.update(dict(IfNoneMatch=etag))
+    try:
+        resp = s3_client.get_object(**params)
+    except ClientError as error:
+        if error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304:
+            return None, etag
+        raise
+    return resp['Body'].read(), resp['ETag']
+
+def get_byte_range(src, start, end):
+    """
+    Gets bytes [start, end) of the object at a given URL, using a range GET for S3.
+    """
+    if end <= start:
+        return b''
+
+    src_url = urlparse(src)
+    if src_url.scheme == 'file':
+        with open(parse_file_url(src_url), 'rb') as fd:
+            fd.seek(start)
+            data = fd.read(end - start)
+    elif src_url.scheme == 's3':
+        src_bucket, src_path, src_version_id = parse_s3_url(src_url)
+        params = dict(Bucket=src_bucket, Key=src_path, Range='bytes=%d-%d' % (start, end - 1))
+        if src_version_id is not None:
+            params.update(dict(VersionId=src_version_id))
+        resp = s3_client.get_object(**params)
+        data = resp['Body'].read()
+    else:
+        raise NotImplementedError
+    return data
+
+class ByteRangeReader(io.RawIOBase):
+    """
+    A read-only, seekable file over the object at a given URL, which only fetches
+    the byte ranges that are read (with range GETs for S3). Lets readers that seek,
+    like pyarrow's Parquet reader, get parts of an object without downloading it all.
+    """
+    def __init__(self, src, size=None):
+        super().__init__()
+        self._src = src
+        self._size = get_size_and_meta(src)[0] if size is None else size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError("Invalid whence: %r" % whence)
+        if pos < 0:
+            raise ValueError("Negative seek position: %d" % pos)
+        self._pos = pos
+        return self._pos
+
+    def readinto(self, buffer):
+        data = get_byte_range(self._src, self._pos, min(self._pos + len(buffer), self._size))
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
 def get_size_and_meta(src):
     """
     Gets metadata for the object at a given URL.
@@ -2,14 +2,48 @@
 
 from importlib.machinery import ModuleSpec
 import sys
+from types import ModuleType
 
+from t4.api import _list_package_names
 from t4.util import get_from_config
-from t4 import list_packages, Package
+from t4 import Package
 
 
 MODULE_PATH = []
 
 
+class DataNamespaceModule(ModuleType):
+    """
+    Module for a namespace of data packages, e.g. `t4.data.foo`. Its attributes are the
+    packages in the namespace, each browsed the first time it's accessed and then kept
+    as an ordinary module attribute.
+    """
+
+    def _package_names(self):
+        names = self.__dict__.get('_package_names_cache')
+        if names is None:
+            registry = get_from_config('default_local_registry')
+            names = self.__dict__['_package_names_cache'] = _list_package_names(
+                registry, self.__name__.split('.')[2])
+        return names
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't set, i.e. packages not browsed yet.
+        if name == '__all__':
+            return list(self._package_names())
+        if name.startswith('_') or name not in self._package_names():
+            raise AttributeError(f"module {self.__name__!r} has no attribute {name!r}")
+
+        namespace = self.__name__.split('.')[2]
+        registry = get_from_config('default_local_registry')
+        pkg = Package.browse(f'{namespace}/{name}', registry=registry)
+        setattr(self, name, pkg)
+        return pkg
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()) | set(self._package_names()))
+
+
 class DataPackageImporter:
     """
     Data package module loader. Executes package import code and adds the package to the
@@ -17,10 +51,12 @@ class DataPackageImporter:
     """
 
     @classmethod
-    def create_module(cls, spec):  # pylint: disable=unused-argument
+    def create_module(cls, spec):
         """
         Module creator. Returning None causes Python to use the default module creator.
         """
+        if len(spec.name.split('.')) == 3:  # e.g. spec.name == t4.data.foo
+            return DataNamespaceModule(spec.name)
         return None
 
     @classmethod
@@ -29,7 +65,6 @@ class DataPackageImporter:
         Module executor.
         """
         name_parts = module.__name__.split('.')
-        registry = get_from_config('default_local_registry')
 
         if module.__name__ == 't4.data':
             # __path__ must be set even if the package is virtual. Since __path__ will be
@@ -39,14 +74,7 @@ class DataPackageImporter:
             return module
 
         elif len(name_parts) == 3:  # e.g. module.__name__ == t4.data.foo
-            namespace = name_parts[2]
-
-            # we do not know the name the user will ask for, so populate all valid names
-            for pkg in list_packages():
-                pkg_user, pkg_name = pkg.split('/')
-                if pkg_user == namespace:
-                    module.__dict__[pkg_name] = Package.browse(pkg, registry=registry)
-
+            # packages are browsed on access by DataNamespaceModule.__getattr__
             module.__path__ = MODULE_PATH
             return module
 
@@ -1,31 +1,57 @@
+from bisect import bisect_left
 from collections import deque
 import copy
 import hashlib
 import io
+import itertools
 import json
 import pathlib
 import os
 
 import time
+from uuid import uuid4
 
 from urllib.parse import quote, urlparse, unquote
 
+from botocore.exceptions import ClientError
 import jsonlines
 from six import string_types, binary_type
 
 
 from .data_transfer import (
-    calculate_sha256, copy_file, copy_file_list, get_bytes, get_size_and_meta, 
-    list_object_versions, put_bytes
+    ByteRangeReader, calculate_sha256, copy_file, copy_file_list, get_byte_range, get_bytes,
+    get_bytes_if_changed, get_size_and_meta, iter_lines, list_object_versions, put_bytes,
+    walk_local_dir
 )
 from .exceptions import PackageException
 from .formats import FormatRegistry
 from .util import (
-    QuiltException, fix_url, get_from_config, get_install_location,
+    CACHE_PATH, QuiltException, QuiltIgnore, fix_url, get_from_config, get_install_location,
     get_package_registry, make_s3_url, parse_file_url, parse_s3_url,
-    validate_package_name, quiltignore_filter, validate_key
+    validate_package_name, validate_key
 )
 
+# Suffix of the optional columnar (Parquet) manifest written next to `packages/<top_hash>`.
+COLUMNAR_MANIFEST_SUFFIX = '.parquet'
+# Parquet schema metadata key holding the package-level metadata.
+COLUMNAR_META_KEY = b't4.package_meta'
+COLUMNAR_COLUMNS = ('logical_key', 'physical_keys', 'size', 'hash_type', 'hash_value', 'meta')
+# Suffix of the sidecar index mapping directory prefixes to byte ranges of the JSONL manifest.
+PREFIX_INDEX_SUFFIX = '.index'
+# Suffix of the sidecar with a summary of the package (entry count, size, message, etc.),
+# so listing a registry doesn't need to read every manifest.
+SUMMARY_SUFFIX = '.summary'
+# Objects written next to `packages/<top_hash>` that belong to the same package version.
+MANIFEST_SIDECAR_SUFFIXES = (COLUMNAR_MANIFEST_SUFFIX, PREFIX_INDEX_SUFFIX, SUMMARY_SUFFIX)
+
+# Local copies of manifests (and their sidecars) from S3 registries. They are
+# content-addressed by top hash, so they never need to be revalidated.
+MANIFEST_CACHE_PATH = CACHE_PATH / 'manifests'
+# Last seen `latest` pointers of S3 registries, with their ETags.
+LATEST_CACHE_PATH = CACHE_PATH / 'latest'
+# How long (in seconds) a cached `latest` pointer is trusted before it's revalidated.
+LATEST_POINTER_TTL = 30
+
 
 def hash_file(readable_file):
     """ Returns SHA256 hash of readable file-like object """
@@ -37,6 +63,133 @@ def hash_file(readable_file):
 
     return hasher.hexdigest()
 
+def _cache_path(cache_dir, uri):
+    """ Returns the local cache file for an S3 object, keyed by its parent prefix and name. """
+    parent, name = uri.rsplit('/', 1)
+    return cache_dir / hashlib.sha256(parent.encode('utf-8')).hexdigest() / name
+
+def _write_cache_file(path, data):
+    """ Atomically writes a cache file, so concurrent readers never see a partial one. """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name('{}.{}.tmp'.format(path.name, uuid4().hex))
+    tmp_path.write_bytes(data)
+    os.replace(str(tmp_path), str(path))
+
+def _get_manifest_bytes(uri):
+    """
+    Gets a manifest or one of its sidecars. Those are immutable once written,
+    so objects from S3 registries are only downloaded once.
+    """
+    if urlparse(uri).scheme != 's3':
+        data, _ = get_bytes(uri)
+        return data
+
+    path = _cache_path(MANIFEST_CACHE_PATH, uri)
+    try:
+        return path.read_bytes()
+    except FileNotFoundError:
+        pass
+    data, _ = get_bytes(uri)
+    _write_cache_file(path, data)
+    return data
+
+def _get_latest_hash(uri):
+    """
+    Resolves a `latest` pointer. For S3 registries, a pointer fetched less than
+    `LATEST_POINTER_TTL` seconds ago is reused as is; an older one is revalidated
+    with a conditional GET, which doesn't transfer the body if it hasn't changed.
+    """
+    if urlparse(uri).scheme != 's3':
+        data, _ = get_bytes(uri)
+        return data.decode('utf-8').strip()
+
+    path = _cache_path(LATEST_CACHE_PATH, uri)
+    try:
+        cached = json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        cached = None
+
+    now = time.time()
+    if cached is not None and 0 <= now - cached['fetched'] < LATEST_POINTER_TTL:
+        return cached['top_hash']
+
+    data, etag = get_bytes_if_changed(uri, cached['etag'] if cached is not None else None)
+    latest_hash = cached['top_hash'] if data is None else data.decode('utf-8').strip()
+    _write_cache_file(path, json.dumps(
+        dict(top_hash=latest_hash, etag=etag, fetched=now)).encode('utf-8'))
+    return latest_hash
+
+def _evict_latest_hash(uri):
+    """ Forgets the cached `latest` pointer at `uri`, after it's been changed or deleted. """
+    if urlparse(uri).scheme != 's3':
+        return
+    try:
+        _cache_path(LATEST_CACHE_PATH, uri).unlink()
+    except FileNotFoundError:
+        pass
+
+def _iter_manifest_lines(manifest):
+    """
+    Generator over the lines of a manifest, given as a URL or a readable file-like object,
+    without reading the whole manifest into memory.
+    """
+    if not isinstance(manifest, string_types):
+        yield from manifest
+        return
+    manifest = fix_url(manifest)
+    if urlparse(manifest).scheme == 's3':
+        cached_manifest = _cache_path(MANIFEST_CACHE_PATH, manifest)
+        if cached_manifest.exists():
+            manifest = cached_manifest.as_uri()
+    yield from iter_lines(manifest)
+
+def _manifest_entries(lines):
+    """
+    Parses manifest lines into (logical_key, comparable) tuples, skipping the package
+    and directory metadata. Comparables are equal when the entries would be.
+    """
+    lines = iter(lines)
+    next(lines, None)  # Package metadata.
+    for line in lines:
+        if not line.strip():
+            continue
+        obj = json.loads(line)
+        if 'physical_keys' not in obj:
+            continue  # Directory metadata.
+        yield obj['logical_key'], (obj['size'], obj['hash'], obj['meta'])
+
+def _merge_diff(entries, other_entries):
+    """
+    Merge-joins two streams of (logical_key, comparable) tuples in `Package.walk` order,
+    and yields (change, logical_key) tuples, where change is 'added', 'modified' or 'deleted'.
+    """
+    def sorted_entries(pairs):
+        prev_path = None
+        for logical_key, entry in pairs:
+            path = logical_key.split('/')
+            if prev_path is not None and path <= prev_path:
+                raise PackageException(
+                    "Manifest entries are not in order: %r follows %r" % (logical_key, '/'.join(prev_path)))
+            prev_path = path
+            yield path, logical_key, entry
+
+    entries = sorted_entries(entries)
+    other_entries = sorted_entries(other_entries)
+    cur = next(entries, None)
+    other = next(other_entries, None)
+    while cur is not None or other is not None:
+        if other is None or (cur is not None and cur[0] < other[0]):
+            yield 'deleted', cur[1]
+            cur = next(entries, None)
+        elif cur is None or other[0] < cur[0]:
+            yield 'added', other[1]
+            other = next(other_entries, None)
+        else:
+            if cur[2] != other[2]:
+                yield 'modified', cur[1]
+            cur = next(entries, None)
+            other = next(other_entries, None)
+
 def _to_singleton(physical_keys):
     """
     Ensure that there is a single physical key, throw otherwise.
@@ -63,7 +216,7 @@ class PackageEntry(object):
     """
     Represents an entry at a logical key inside a package.
     """
-    __slots__ = ['physical_keys', 'size', 'hash', '_meta']
+    __slots__ = ['physical_keys', 'size', 'hash', '_raw_meta', '_meta_shared', '_hash_cache']
     def __init__(self, physical_keys, size, hash_obj, meta):
         """
         Creates an entry.
@@ -82,13 +235,14 @@ class PackageEntry(object):
         self.size = size
         self.hash = hash_obj
         self._meta = meta or {}
+        self._hash_cache = None
 
     def __eq__(self, other):
         return (
             # Don't check physical keys.
             self.size == other.size
             and self.hash == other.hash
-            and self._meta == other._meta
+            and self._raw_meta == other._raw_meta
         )
 
     def __repr__(self):
@@ -102,16 +256,74 @@ class PackageEntry(object):
             'physical_keys': self.physical_keys,
             'size': self.size,
             'hash': self.hash,
-            'meta': self._meta
+            'meta': self._raw_meta
         }
         return copy.deepcopy(ret)
 
-    def _clone(self):
-        """
-        Returns clone of this PackageEntry.
-        """
-        return self.__class__(copy.deepcopy(self.physical_keys), self.size, \
-                              copy.deepcopy(self.hash), copy.deepcopy(self._meta))
+    def _hash_fragments(self):
+        """
+        Returns the serialized entry (without physical keys) that goes into the top hash,
+        split around its logical key, which the entry itself doesn't know.
+
+        The serialization is cached, and is only redone when the hashed fields change.
+        Equal values can serialize differently (e.g. 1, 1.0 and True), so it isn't
+        enough to compare them: getting the metadata to edit it (through `_meta` or
+        `meta`) drops the cache, the size is compared by type as well as value, and the
+        hash, which is only ever replaced, must be the same object. The metadata is
+        also compared with a copy, which catches most edits through references kept
+        from before the cache was filled.
+        """
+        cached = self._hash_cache
+        if cached is not None:
+            (size, hash_obj, meta), head, tail = cached
+            if (type(self.size) is type(size) and self.size == size and self.hash is hash_obj
+                    and self._raw_meta == meta):
+                return head, tail
+
+        hash_str = json.dumps(self.hash, sort_keys=True, separators=(',', ':'))
+        meta_str = json.dumps(self._raw_meta, sort_keys=True, separators=(',', ':'))
+        # Same bytes as dumping the whole dict with sorted keys.
+        head = ('{"hash":%s,"logical_key":' % hash_str).encode('utf-8')
+        tail = (',"meta":%s,"size":%s}' % (meta_str, json.dumps(self.size))).encode('utf-8')
+        # Round-tripping the metadata through JSON gives an independent copy to compare
+        # against later; anything that doesn't round-trip exactly just never hits the cache.
+        snapshot = (self.size, self.hash, json.loads(meta_str))
+        self._hash_cache = (snapshot, head, tail)
+        return head, tail
+
+    @property
+    def _meta(self):
+        # Copy on write: the metadata may be shared with other entries (see `_share`),
+        # and whoever gets the dict may modify it, so make a private copy first.
+        if self._meta_shared:
+            self._raw_meta = copy.deepcopy(self._raw_meta)
+            self._meta_shared = False
+        # For the same reason, the cached serialization may go stale.
+        self._hash_cache = None
+        return self._raw_meta
+
+    @_meta.setter
+    def _meta(self, meta):
+        self._raw_meta = meta
+        self._meta_shared = False
+        self._hash_cache = None
+
+    def _share(self):
+        """
+        Returns a copy of this PackageEntry for use in another package, without
+        copying any of its data.
+
+        Physical keys and hash are only ever replaced, never modified in place.
+        The metadata is copied on write, by whichever entry changes it first.
+        """
+        entry = self.__class__.__new__(self.__class__)
+        entry.physical_keys = self.physical_keys
+        entry.size = self.size
+        entry.hash = self.hash
+        entry._raw_meta = self._raw_meta
+        entry._meta_shared = self._meta_shared = True
+        entry._hash_cache = self._hash_cache
+        return entry
 
     @property
     def meta(self):
@@ -221,7 +433,7 @@ class PackageEntry(object):
 
         # return a package reroot package physical keys after the copy operation succeeds
         # see GH#388 for context
-        entry = self._clone()
+        entry = self._share()
         entry.physical_keys = [dest]
         return entry
 
@@ -233,11 +445,66 @@ class PackageEntry(object):
         return self.deserialize(func=func, **kwargs)
 
 
+class _SortedChildren(dict):
+    """
+    Children of a package node. A dict that also keeps its keys in sorted order,
+    so traversals don't sort every directory again each time.
+
+    The order is maintained incrementally when keys are added in order (as when
+    loading a manifest), and recomputed lazily after any other change.
+    """
+    _sorted_keys = None
+
+    def __init__(self):
+        super().__init__()
+        self._sorted_keys = []
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            sorted_keys = self._sorted_keys
+            if sorted_keys is not None and (not sorted_keys or key > sorted_keys[-1]):
+                sorted_keys.append(key)
+            else:
+                self._sorted_keys = None
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._sorted_keys = None
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        self._sorted_keys = None
+        return super().pop(key, *args)
+
+    def popitem(self):
+        self._sorted_keys = None
+        return super().popitem()
+
+    def clear(self):
+        super().clear()
+        self._sorted_keys = []
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def sorted_keys(self):
+        """ Returns the keys in sorted order. Don't modify the returned list. """
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(self)
+        return self._sorted_keys
+
+
 class Package(object):
     """ In-memory representation of a package """
 
     def __init__(self):
-        self._children = {}
+        self._children = _SortedChildren()
         self._meta = {'version': 'v0'}
 
     def __repr__(self, max_lines=20):
@@ -287,7 +554,7 @@ class Package(object):
                 logical_key = logical_key + '/'
                 new_parent_keys = parent_keys.copy()
                 new_parent_keys.append(logical_key)
-                for child_key in sorted(entry.keys()):
+                for child_key in entry._children.sorted_keys():
                     candidates.append([[child_key, entry[child_key]], new_parent_keys])
 
             current_result_level = results_dict
@@ -349,7 +616,7 @@ class Package(object):
 
 
     @classmethod
-    def browse(cls, name=None, registry=None, top_hash=None):
+    def browse(cls, name=None, registry=None, top_hash=None, columnar=False, prefix=None):
         """
         Load a package into memory from a registry without making a local copy of
         the manifest.
@@ -357,6 +624,58 @@ class Package(object):
             name(string): name of package to load
             registry(string): location of registry to load package from
             top_hash(string): top hash of package version to load
+            columnar(bool): load the columnar (Parquet) manifest written by
+                `build(..., columnar=True)` instead of the JSONL one
+            prefix(string): only load the entries whose logical keys start with
+                `prefix`, e.g. 'images/2019/'. Uses the prefix index written by
+                `build` to read just the needed parts of the manifest. Logical keys
+                are kept as they are in the full package.
+        """
+        pkg_path = cls._manifest_path(name, registry, top_hash)
+        if prefix:
+            if columnar:
+                raise ValueError("Cannot load a prefix of a columnar manifest.")
+            return cls._from_path_prefix(pkg_path, prefix)
+        if columnar:
+            return cls._from_path(pkg_path + COLUMNAR_MANIFEST_SUFFIX, columnar=True)
+        return cls._from_path(pkg_path)
+
+    @classmethod
+    def browse_columns(cls, name=None, registry=None, top_hash=None, columns=None):
+        """
+        Reads selected columns of a package's columnar manifest into a DataFrame,
+        without building a Package.
+
+        The manifest must have been written with `build(..., columnar=True)`.
+        Available columns are 'logical_key', 'physical_keys', 'size', 'hash_type',
+        'hash_value' and 'meta' (a JSON string). Directory-level metadata rows have
+        a logical key ending in '/' and no size or hash.
+
+        Args:
+            name(string): name of package to load
+            registry(string): location of registry to load package from
+            top_hash(string): top hash of package version to load
+            columns(list): columns to read; defaults to all of them
+
+        Returns:
+            pandas.DataFrame
+        """
+        from pyarrow import parquet  # Lazy import for slow module
+
+        if columns is not None:
+            unknown = set(columns) - set(COLUMNAR_COLUMNS)
+            if unknown:
+                raise QuiltException("Unknown manifest columns: %s" % ', '.join(sorted(unknown)))
+
+        pkg_path = cls._manifest_path(name, registry, top_hash) + COLUMNAR_MANIFEST_SUFFIX
+        table = parquet.read_table(cls._open_manifest(pkg_path, ranged=True), columns=columns)
+        return table.to_pandas()
+
+    @classmethod
+    def _manifest_path(cls, name=None, registry=None, top_hash=None):
+        """
+        Resolves the registry and (if needed) the latest pointer of a package,
+        and returns the URI of its manifest.
         """
         if registry is None:
             registry = get_from_config('default_remote_registry')
@@ -371,34 +690,97 @@ class Package(object):
 
         if top_hash is not None:
             # If hash is specified, name doesn't matter.
-            pkg_path = '{}/packages/{}'.format(registry_prefix, top_hash)
-            return cls._from_path(pkg_path)
+            return '{}/packages/{}'.format(registry_prefix, top_hash)
         else:
             validate_package_name(name)
 
         pkg_path = '{}/named_packages/{}/latest'.format(registry_prefix, quote(name))
-        latest_bytes, _ = get_bytes(pkg_path)
-        latest_hash = latest_bytes.decode('utf-8')
-
-        latest_hash = latest_hash.strip()
-        latest_path = '{}/packages/{}'.format(registry_prefix, quote(latest_hash))
-        return cls._from_path(latest_path)
-
+        latest_hash = _get_latest_hash(pkg_path)
+        return '{}/packages/{}'.format(registry_prefix, quote(latest_hash))
 
     @classmethod
-    def _from_path(cls, uri):
+    def _from_path(cls, uri, columnar=False):
         """ Takes a URI and returns a package loaded from that URI """
+        if columnar:
+            return cls.load_columnar(cls._open_manifest(uri))
+
         src_url = urlparse(uri)
         if src_url.scheme == 'file':
             with open(parse_file_url(src_url)) as open_file:
                 pkg = cls.load(open_file)
         elif src_url.scheme == 's3':
-            body, _ = get_bytes(uri)
+            body = _get_manifest_bytes(uri)
             pkg = cls.load(io.BytesIO(body))
         else:
             raise NotImplementedError
         return pkg
 
+    @classmethod
+    def _from_path_prefix(cls, uri, prefix):
+        """
+        Takes a manifest URI and returns a package with only the entries under
+        `prefix`, fetching just the byte ranges listed in the manifest's prefix index.
+        """
+        def is_relevant(obj):
+            # Keep the entries under the prefix, and the metadata of the directories
+            # under it or on the way to it.
+            logical_key = obj['logical_key']
+            if logical_key.startswith(prefix):
+                return True
+            return not obj.get('physical_keys') and prefix.startswith(logical_key)
+
+        try:
+            index_bytes = _get_manifest_bytes(uri + PREFIX_INDEX_SUFFIX)
+        except (FileNotFoundError, ClientError):
+            # Built before prefix indexes existed; read the whole manifest.
+            body = _get_manifest_bytes(uri)
+            reader = jsonlines.Reader(io.BytesIO(body))
+            meta = reader.read()
+            return cls._from_manifest_dicts(
+                meta, (obj for obj in reader if is_relevant(obj)))
+
+        index = json.loads(index_bytes.decode('utf-8'))
+        if urlparse(uri).scheme == 's3':
+            cached_manifest = _cache_path(MANIFEST_CACHE_PATH, uri)
+            if cached_manifest.exists():
+                # Already downloaded in full; read the ranges locally.
+                uri = cached_manifest.as_uri()
+        header = get_byte_range(uri, *index['header'])
+        reader = jsonlines.Reader(io.BytesIO(header))
+        meta = reader.read()
+        objs = [obj for obj in reader if is_relevant(obj)]
+
+        # Entries under a directory are contiguous in the manifest, so only the range
+        # of the innermost directory containing the prefix needs to be read.
+        dir_prefix = prefix[:prefix.rfind('/') + 1]
+        entries_range = index['prefixes'].get(dir_prefix)
+        if entries_range is not None:
+            entries = get_byte_range(uri, *entries_range)
+            objs.extend(obj for obj in jsonlines.Reader(io.BytesIO(entries))
+                        if obj['logical_key'].startswith(prefix))
+
+        return cls._from_manifest_dicts(meta, objs)
+
+    @classmethod
+    def _open_manifest(cls, uri, ranged=False):
+        """
+        Returns something pyarrow can read a columnar manifest from: a local path,
+        a buffer with the downloaded object, or (if `ranged`, for reading only some
+        of the columns) a reader that fetches just the byte ranges pyarrow reads.
+        """
+        src_url = urlparse(uri)
+        if src_url.scheme == 'file':
+            return parse_file_url(src_url)
+        elif src_url.scheme == 's3':
+            cached_manifest = _cache_path(MANIFEST_CACHE_PATH, uri)
+            if cached_manifest.exists():
+                return str(cached_manifest)
+            if ranged:
+                return ByteRangeReader(uri)
+            return io.BytesIO(_get_manifest_bytes(uri))
+        else:
+            raise NotImplementedError
+
     @classmethod
     def _split_key(cls, logical_key):
         """
@@ -420,11 +802,12 @@ class Package(object):
         Returns:
             True or False
         """
-        try:
-            self[logical_key]
-            return True
-        except KeyError:
-            return False
+        pkg = self
+        for key_fragment in self._split_key(logical_key):
+            if not isinstance(pkg, Package) or key_fragment not in pkg._children:
+                return False
+            pkg = pkg._children[key_fragment]
+        return True
 
     def __getitem__(self, logical_key):
         """
@@ -456,22 +839,25 @@ class Package(object):
         """
         nice_dest = fix_url(dest).rstrip('/')
         file_list = []
-        pkg = Package()
+        new_entries = []
 
         for logical_key, entry in self.walk():
             physical_key = _to_singleton(entry.physical_keys)
             new_physical_key = f'{nice_dest}/{quote(logical_key)}'
 
-            file_list.append((physical_key, new_physical_key, entry.size, entry.meta))
+            file_list.append((physical_key, new_physical_key, entry.size,
+                              entry._raw_meta.get('user_meta', {})))
 
             # return a package reroot package physical keys after the copy operation succeeds
             # see GH#388 for context
-            new_entry = entry._clone()
+            new_entry = entry._share()
             new_entry.physical_keys = [new_physical_key]
-            pkg.set(logical_key, new_entry)
+            new_entries.append((logical_key, new_entry))
 
         copy_file_list(file_list)
-        
+
+        pkg = Package()
+        pkg._set_entries(new_entries)
         return pkg
 
     def keys(self):
@@ -491,20 +877,54 @@ class Package(object):
         Generator that traverses all entries in the package tree and returns tuples of (key, entry),
         with keys in alphabetical order.
         """
-        for name, child in sorted(self._children.items()):
+        children = self._children
+        for name in children.sorted_keys():
+            child = children[name]
             if isinstance(child, PackageEntry):
                 yield name, child
             else:
                 for key, value in child.walk():
                     yield name + '/' + key, value
 
+    def iter_prefix(self, prefix):
+        """
+        Generator over the entries whose logical keys start with `prefix`, as tuples
+        of (key, entry) in the same order as `walk`. Only the matching part of the
+        tree is visited.
+
+        Args:
+            prefix(str): a logical key prefix, e.g. 'a/b/' or 'a/b/c'
+        """
+        *dir_keys, partial = prefix.split('/')
+        pkg = self
+        for key_fragment in dir_keys:
+            pkg = pkg._children.get(key_fragment)
+            if not isinstance(pkg, Package):
+                return
+        dir_prefix = ''.join(key_fragment + '/' for key_fragment in dir_keys)
+
+        children = pkg._children
+        names = children.sorted_keys()
+        # Names starting with `partial` are contiguous in the sorted order.
+        for name in itertools.islice(names, bisect_left(names, partial), None):
+            if not name.startswith(partial):
+                break
+            child = children[name]
+            if isinstance(child, PackageEntry):
+                yield dir_prefix + name, child
+            else:
+                for key, value in child.walk():
+                    yield dir_prefix + name + '/' + key, value
+
     def _walk_dir_meta(self):
         """
         Generator that traverses all entries in the package tree and returns
             tuples of (key, meta) for each directory with metadata.
         Keys will all end in '/' to indicate that they are directories.
         """
-        for key, child in sorted(self._children.items()):
+        children = self._children
+        for key in children.sorted_keys():
+            child = children[key]
             if isinstance(child, PackageEntry):
                 continue
             meta = child.meta
@@ -531,10 +951,58 @@ class Package(object):
         """
         reader = jsonlines.Reader(readable_file)
         meta = reader.read()
+        return cls._from_manifest_dicts(meta, reader)
+
+    @classmethod
+    def load_columnar(cls, source):
+        """
+        Loads a package from a columnar (Parquet) manifest written by `dump_columnar`.
+
+        Args:
+            source: path or readable file-like object to deserialize package from
+
+        Returns:
+            A new Package object
+
+        Raises:
+            file not found
+            invalid package exception
+        """
+        from pyarrow import parquet  # Lazy import for slow module
+
+        table = parquet.read_table(source)
+        schema_meta = table.schema.metadata or {}
+        if COLUMNAR_META_KEY not in schema_meta:
+            raise PackageException("Not a columnar package manifest")
+        meta = json.loads(schema_meta[COLUMNAR_META_KEY].decode('utf-8'))
+
+        columns = {
+            name: table.column(table.schema.get_field_index(name)).to_pylist()
+            for name in COLUMNAR_COLUMNS
+        }
+
+        def objs():
+            for logical_key, physical_keys, size, hash_type, hash_value, obj_meta in zip(
+                    *(columns[name] for name in COLUMNAR_COLUMNS)):
+                obj = {'logical_key': logical_key, 'meta': json.loads(obj_meta)}
+                if physical_keys:
+                    obj['physical_keys'] = physical_keys
+                    obj['size'] = size
+                    obj['hash'] = (None if hash_type is None
+                                   else {'type': hash_type, 'value': hash_value})
+                yield obj
+
+        return cls._from_manifest_dicts(meta, objs())
+
+    @classmethod
+    def _from_manifest_dicts(cls, meta, objs):
+        """
+        Builds a package from the package metadata and an iterable of manifest lines.
+        """
         meta.pop('top_hash', None)  # Obsolete as of PR #130
         pkg = cls()
         pkg._meta = meta
-        for obj in reader:
+        for obj in objs:
             path = cls._split_key(obj.pop('logical_key'))
             subpkg = pkg._ensure_subpackage(path[:-1])
             key = path[-1]
@@ -590,18 +1058,16 @@ class Package(object):
             if not src_path.is_dir():
                 raise PackageException("The specified directory doesn't exist")
 
-            files = src_path.rglob('*')
-            ignore = src_path / '.quiltignore'
-            if ignore.exists():
-                files = quiltignore_filter(files, ignore, 'file')
-
-            for f in files:
-                if not f.is_file():
-                    continue
-                entry = PackageEntry([f.as_uri()], f.stat().st_size, None, None)
-                logical_key = f.relative_to(src_path).as_posix()
-                # TODO: Warn if overwritting a logical key?
-                root.set(logical_key, entry)
+            ignore_path = src_path / '.quiltignore'
+            ignore = QuiltIgnore.from_file(ignore_path) if ignore_path.exists() else None
+
+            def entries():
+                for logical_key, size, _ in walk_local_dir(src_path, ignore=ignore):
+                    entry = PackageEntry([(src_path / logical_key).as_uri()], size, None, None)
+                    yield logical_key, entry
+
+            # TODO: Warn if overwritting a logical key?
+            root._set_entries(entries())
         elif url.scheme == 's3':
             src_bucket, src_key, src_version = parse_s3_url(url)
             if src_version:
@@ -609,14 +1075,18 @@ class Package(object):
             if src_key and not src_key.endswith('/'):
                 src_key += '/'
             objects, _ = list_object_versions(src_bucket, src_key)
-            for obj in objects:
-                if not obj['IsLatest']:
-                    continue
-                obj_url = make_s3_url(src_bucket, obj['Key'], obj.get('VersionId'))
-                entry = PackageEntry([obj_url], obj['Size'], None, None)
-                logical_key = obj['Key'][len(src_key):]
-                # TODO: Warn if overwritting a logical key?
-                root.set(logical_key, entry)
+
+            def entries():
+                for obj in objects:
+                    if not obj['IsLatest']:
+                        continue
+                    obj_url = make_s3_url(src_bucket, obj['Key'], obj.get('VersionId'))
+                    entry = PackageEntry([obj_url], obj['Size'], None, None)
+                    logical_key = obj['Key'][len(src_key):]
+                    yield logical_key, entry
+
+            # TODO: Warn if overwritting a logical key?
+            root._set_entries(entries())
         else:
             raise NotImplementedError
 
@@ -750,7 +1220,7 @@ class Package(object):
 
         self._meta.update({'message': msg})
 
-    def build(self, name=None, registry=None, message=None):
+    def build(self, name=None, registry=None, message=None, columnar=False):
         """
         Serializes this package to a registry.
 
@@ -759,6 +1229,8 @@ class Package(object):
             registry: registry to build to
                     defaults to local registry
             message: the commit message of the package
+            columnar: also write a columnar (Parquet) manifest next to the JSONL one,
+                    for use with `browse(..., columnar=True)` and `browse_columns`
 
         Returns:
             The top hash as a string.
@@ -774,12 +1246,29 @@ class Package(object):
 
         hash_string = self.top_hash
         manifest = io.BytesIO()
-        self.dump(manifest)
+        prefix_index = self._dump_indexed(manifest)
+        manifest_path = registry_prefix + '/packages/' + hash_string
+        put_bytes(manifest.getvalue(), manifest_path)
+        if urlparse(manifest_path).scheme == 's3':
+            # Browsing this version later shouldn't download it again.
+            _write_cache_file(_cache_path(MANIFEST_CACHE_PATH, manifest_path), manifest.getvalue())
+        put_bytes(
+            json.dumps(prefix_index, separators=(',', ':')).encode('utf-8'),
+            registry_prefix + '/packages/' + hash_string + PREFIX_INDEX_SUFFIX
+        )
         put_bytes(
-            manifest.getvalue(),
-            registry_prefix + '/packages/' + hash_string
+            json.dumps(self._summary(hash_string, time.time())).encode('utf-8'),
+            registry_prefix + '/packages/' + hash_string + SUMMARY_SUFFIX
         )
 
+        if columnar:
+            columnar_manifest = io.BytesIO()
+            self.dump_columnar(columnar_manifest)
+            put_bytes(
+                columnar_manifest.getvalue(),
+                registry_prefix + '/packages/' + hash_string + COLUMNAR_MANIFEST_SUFFIX
+            )
+
         if name:
             # Sanitize name.
             validate_package_name(name)
@@ -791,9 +1280,32 @@ class Package(object):
             latest_path = named_path + "latest"
             put_bytes(hash_bytes, timestamp_path)
             put_bytes(hash_bytes, latest_path)
+            # Don't keep serving the previous version from the cache.
+            _evict_latest_hash(latest_path)
 
         return self
 
+    def _summary(self, top_hash, timestamp):
+        """
+        Returns the summary of this package written next to its manifest.
+
+        Args:
+            top_hash: the top hash of the package
+            timestamp: when the package was built, in seconds since the epoch
+        """
+        entries = 0
+        size = 0
+        for _, entry in self.walk():
+            entries += 1
+            size += entry.size or 0
+        return {
+            'top_hash': top_hash,
+            'entries': entries,
+            'size': size,
+            'message': self._meta.get('message'),
+            'timestamp': timestamp,
+        }
+
     def dump(self, writable_file):
         """
         Serializes this package to a writable file-like object.
@@ -812,6 +1324,80 @@ class Package(object):
         for line in self.manifest:
             writer.write(line)
 
+    def _dump_indexed(self, writable_file):
+        """
+        Serializes this package like `dump` to a binary file-like object, and
+        returns the prefix index used by `browse(..., prefix=...)`:
+            {
+                'header': [start, end] of the package and directory metadata lines,
+                'prefixes': {directory prefix: [start, end] of its entries' lines}
+            }
+        Ranges are byte offsets, end exclusive. The '' prefix covers all entries.
+        """
+        writer = jsonlines.Writer(writable_file)
+        header_end = 0
+        prefixes = {}
+        for line in self.manifest:
+            start = writable_file.tell()
+            writer.write(line)
+            end = writable_file.tell()
+            if 'physical_keys' not in line:
+                # Package or directory metadata; these all precede the entries.
+                header_end = end
+                continue
+            dir_prefix = ''
+            for key_fragment in line['logical_key'].split('/')[:-1] + [None]:
+                prefixes.setdefault(dir_prefix, [start, end])[1] = end
+                if key_fragment is not None:
+                    dir_prefix += key_fragment + '/'
+        return {'header': [0, header_end], 'prefixes': prefixes}
+
+    def dump_columnar(self, writable_file):
+        """
+        Serializes this package to a writable file-like object as a Parquet table
+        with one row per manifest line.
+
+        Package-level metadata is stored in the table's schema metadata, so the
+        package can be loaded back with `load_columnar` and has the same top hash.
+
+        Args:
+            writable_file: binary file-like object to write serialized package.
+
+        Returns:
+            None
+        """
+        import pyarrow as pa  # Lazy import for slow module
+        from pyarrow import parquet
+
+        columns = {name: [] for name in COLUMNAR_COLUMNS}
+        manifest = self.manifest
+        meta = next(manifest)
+        for obj in manifest:
+            columns['logical_key'].append(obj['logical_key'])
+            columns['physical_keys'].append(obj.get('physical_keys'))
+            columns['size'].append(obj.get('size'))
+            obj_hash = obj.get('hash') or {}
+            columns['hash_type'].append(obj_hash.get('type'))
+            columns['hash_value'].append(obj_hash.get('value'))
+            columns['meta'].append(json.dumps(obj['meta'], sort_keys=True, separators=(',', ':')))
+
+        types = {
+            'logical_key': pa.string(),
+            'physical_keys': pa.list_(pa.string()),
+            'size': pa.int64(),
+            'hash_type': pa.string(),
+            'hash_value': pa.string(),
+            'meta': pa.string(),
+        }
+        table = pa.Table.from_arrays(
+            [pa.array(columns[name], type=types[name]) for name in COLUMNAR_COLUMNS],
+            names=list(COLUMNAR_COLUMNS)
+        )
+        table = table.replace_schema_metadata({
+            COLUMNAR_META_KEY: json.dumps(meta, sort_keys=True).encode('utf-8')
+        })
+        parquet.write_table(table, writable_file)
+
     @property
     def manifest(self):
         """
@@ -862,7 +1448,7 @@ class Package(object):
                     url = make_s3_url(bucket, key, version)
             entry = PackageEntry([url], size, None, orig_meta)
         elif isinstance(entry, PackageEntry):
-            entry = entry._clone()
+            entry = entry._share()
         else:
             raise TypeError(
                 f"Expected a string for entry, but got an instance of {type(entry)}."
@@ -880,6 +1466,90 @@ class Package(object):
 
         return self
 
+    @classmethod
+    def from_entries(cls, entries):
+        """
+        Creates a package from many entries at once. See `set_many`.
+
+        Args:
+            entries: iterable of (logical_key, PackageEntry) tuples
+
+        Returns:
+            A new Package
+        """
+        return cls().set_many(entries)
+
+    def set_many(self, entries):
+        """
+        Sets many entries at once. Much faster than calling `set` for each one:
+        all keys are validated before the package is changed, and the tree is built
+        in one pass. Entries are copied, but share their data with the originals
+        until either of them is modified.
+
+        Args:
+            entries: iterable of (logical_key, PackageEntry) tuples
+
+        Returns:
+            self
+        """
+        def shared_entries():
+            for logical_key, entry in entries:
+                if not isinstance(entry, PackageEntry):
+                    raise TypeError(
+                        f"Expected a PackageEntry for {logical_key!r}, but got an instance of {type(entry)}."
+                    )
+                yield logical_key, entry._share()
+
+        return self._set_entries(shared_entries())
+
+    def _set_entries(self, entries):
+        """
+        Adds (logical_key, PackageEntry) tuples to the package as is, without copying
+        the entries. Keys are validated before anything is changed.
+        """
+        items = []
+        for logical_key, entry in entries:
+            if not logical_key or logical_key.endswith('/'):
+                raise QuiltException(
+                    f"Invalid logical key {logical_key!r}. "
+                    f"A package entry logical key cannot be a directory."
+                )
+            validate_key(logical_key)
+            items.append((logical_key.split('/'), entry))
+
+        # Check for keys that would replace directories, or directories that would replace
+        # entries, both in the package and among the new keys.
+        keys = set()
+        dirs = {}  # Directory path -> the existing package there, or None if there isn't one.
+        for path, _ in items:
+            keys.add(tuple(path))
+            dir_path = tuple(path[:-1])
+            if dir_path in dirs:
+                continue
+            pkg = self
+            for i, key_fragment in enumerate(dir_path):
+                if pkg is not None:
+                    pkg = pkg._children.get(key_fragment)
+                    if isinstance(pkg, PackageEntry):
+                        raise QuiltException("Already a PackageEntry along the path.")
+                dirs.setdefault(dir_path[:i + 1], pkg)
+            dirs[dir_path] = pkg
+        for path in keys:
+            existing = dirs.get(path[:-1])
+            if path in dirs or (existing is not None and isinstance(existing._children.get(path[-1]), Package)):
+                raise QuiltException("Cannot overwrite directory with PackageEntry")
+
+        # Consecutive entries usually share a directory, so only look it up when it changes.
+        dir_path = None
+        pkg = None
+        for path, entry in items:
+            if path[:-1] != dir_path:
+                dir_path = path[:-1]
+                pkg = self._ensure_subpackage(dir_path)
+            pkg._children[path[-1]] = entry
+
+        return self
+
     def _ensure_subpackage(self, path, ensure_no_entry=False):
         """
         Creates a package and any intermediate packages at the given path.
@@ -933,11 +1603,10 @@ class Package(object):
         for logical_key, entry in self.walk():
             if entry.hash is None or entry.size is None:
                 raise QuiltException("PackageEntry missing hash and/or size: %s" % entry.physical_keys[0])
-            entry_dict = entry.as_dict()
-            entry_dict['logical_key'] = logical_key
-            entry_dict.pop('physical_keys', None)
-            entry_dict_str = json.dumps(entry_dict, sort_keys=True, separators=(',', ':'))
-            top_hash.update(entry_dict_str.encode('utf-8'))
+            head, tail = entry._hash_fragments()
+            top_hash.update(head)
+            top_hash.update(json.dumps(logical_key).encode('utf-8'))
+            top_hash.update(tail)
 
         return top_hash.hexdigest()
 
@@ -1026,16 +1695,20 @@ class Package(object):
             # Copy the datafiles in the package.
             physical_key = _to_singleton(entry.physical_keys)
             new_physical_key = dest_url + "/" + quote(logical_key)
-            file_list.append((physical_key, new_physical_key, entry.size, entry.meta))
+            file_list.append((physical_key, new_physical_key, entry.size,
+                              entry._raw_meta.get('user_meta', {})))
 
         results = copy_file_list(file_list)
 
-        for (logical_key, entry), versioned_key in zip(self.walk(), results):
-            # Create a new package entry pointing to the new remote key.
-            assert versioned_key is not None
-            new_entry = entry._clone()
-            new_entry.physical_keys = [versioned_key]
-            pkg.set(logical_key, new_entry)
+        def new_entries():
+            for (logical_key, entry), versioned_key in zip(self.walk(), results):
+                # Create a new package entry pointing to the new remote key.
+                assert versioned_key is not None
+                new_entry = entry._share()
+                new_entry.physical_keys = [versioned_key]
+                yield logical_key, new_entry
+
+        pkg._set_entries(new_entries())
         return pkg
 
     def diff(self, other_pkg):
@@ -1052,19 +1725,36 @@ class Package(object):
         Returns:
             added, modified, deleted (all lists of logical keys)
         """
-        deleted = []
-        modified = []
-        other_entries = dict(other_pkg.walk())
-        for lk, entry in self.walk():
-            other_entry = other_entries.pop(lk, None)
-            if other_entry is None:
-                deleted.append(lk)
-            elif entry != other_entry:
-                modified.append(lk)
+        changes = dict(added=[], modified=[], deleted=[])
+        for change, lk in _merge_diff(self.walk(), other_pkg.walk()):
+            changes[change].append(lk)
 
-        added = list(sorted(other_entries))
-        
-        return added, modified, deleted
+        return changes['added'], changes['modified'], changes['deleted']
+
+    @classmethod
+    def diff_manifests(cls, manifest, other_manifest):
+        """
+        Diffs two manifests without loading either of them into a Package.
+
+        Both manifests are streamed and merge-joined on their logical keys, so memory use
+        doesn't depend on the size of the packages. Changes have the same meaning as in `diff`.
+
+        Args:
+            manifest: URL of a manifest, e.g. 's3://bucket/.quilt/packages/<top_hash>',
+                or a readable file-like object
+            other_manifest: the manifest to compare against, same as above
+
+        Returns:
+            A generator of (change, logical_key) tuples, where change is
+            'added', 'modified' or 'deleted'
+
+        Raises:
+            PackageException: if a manifest's entries aren't in order
+        """
+        return _merge_diff(
+            _manifest_entries(_iter_manifest_lines(manifest)),
+            _manifest_entries(_iter_manifest_lines(other_manifest))
+        )
 
     def map(self, f, include_directories=False):
         """
@@ -1110,10 +1800,11 @@ class Package(object):
                 if not f(lk, self[lk.rstrip("/")]):
                     excluded_dirs.add(lk)
 
-        for lk, entity in self.walk():
-            if (not any(p in excluded_dirs 
+        p.set_many(
+            (lk, entity) for lk, entity in self.walk()
+            if (not any(p in excluded_dirs
                         for p in pathlib.PurePosixPath(lk).parents)
-                    and f(lk, entity)):
-                p.set(lk, entity)
+                and f(lk, entity))
+        )
 
         return p
@@ -0,0 +1,487 @@
+"""
+search_index.py
+
+Contains the SearchIndex class, a local SQLite full-text index of package manifests
+and bucket objects, which answers searches without an Elasticsearch endpoint.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import pathlib
+import re
+import sqlite3
+
+from botocore.exceptions import ClientError
+
+from . import data_transfer
+from .api import _list_package_names, _list_package_namespaces, _registry_root
+from .bucket_index import _batches, _prefix_end, INSERT_BATCH_SIZE
+from .data_transfer import _list_objects, get_bytes, get_size_and_meta
+from .packages import _get_latest_hash, _iter_manifest_lines, SUMMARY_SUFFIX
+from .search_util import _parse_hits
+from .util import CACHE_PATH, QuiltException, make_s3_url
+
+SEARCH_INDEX_PATH = CACHE_PATH / 'search_index.sqlite'
+
+# Fields of `field:value` query clauses -> indexed columns.
+QUERY_FIELDS = {
+    'key': 'key',
+    'package': 'package',
+    'text': 'text',
+    'content': 'text',
+    'user_meta': 'user_meta',
+}
+# Columns searched by clauses without a field. (Package entries all have the package
+# name, which would drown out the package itself.)
+DEFAULT_COLUMNS = '{key user_meta text}'
+
+_QUERY_TOKEN = re.compile(r'''
+    \s*(?:
+        (?P<op>AND\b|OR\b|NOT\b|&&|\|\||!|[+-]?\(|\))
+        |(?P<sign>[+-])?(?:(?P<field>[\w.]+):)?(?P<value>"(?:[^"\\]|\\.)*"|[^\s()"]+)
+    )
+''', re.VERBOSE)
+_OPERATORS = {'AND': 'AND', '&&': 'AND', 'OR': 'OR', '||': 'OR', 'NOT': 'NOT', '!': 'NOT'}
+# What the FTS5 (unicode61) tokenizer treats as a token.
+_WORD = re.compile(r'[^\W_]+')
+# Ends each flattened metadata leaf; not a path token, since those are hex after the 'p'.
+_META_LEAF_END = 'pend'
+
+
+def _fts_string(text):
+    return '"%s"' % text.replace('"', '""')
+
+
+def _meta_path_token(path):
+    """
+    A single token for a path in user metadata (which the tokenizer would otherwise split
+    into its parts), so a field only matches its own full path.
+    """
+    return 'p' + '.'.join(path).encode('utf-8').hex()
+
+
+def _meta_phrase(path, value):
+    """
+    The words of a metadata value, each preceded by the token for its path, so a phrase
+    only matches consecutive words under the same path.
+    """
+    path_token = _meta_path_token(path)
+    words = _WORD.findall(value)
+    return ' '.join(token for word in words for token in (path_token, word)) or path_token
+
+
+def _flatten_meta(meta, path=()):
+    """
+    Generator over the leaves of user metadata as lines of path and value tokens (see
+    `_meta_phrase`), which `user_meta.path.to.leaf:value` clauses match as phrases.
+    Each line ends with a token of its own, so phrases can't run into the next leaf.
+    """
+    if isinstance(meta, dict):
+        for name, value in meta.items():
+            yield from _flatten_meta(value, path + (str(name),))
+    elif isinstance(meta, list):
+        for value in meta:
+            yield from _flatten_meta(value, path)
+    else:
+        yield '%s %s' % (_meta_phrase(path, str(meta)), _META_LEAF_END)
+
+
+def _match_clause(field, value):
+    quoted = value.startswith('"')
+    if quoted:
+        value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        prefix = False
+    else:
+        prefix = value.endswith('*')
+        value = value.rstrip('*')
+        if '*' in value or '?' in value:
+            raise QuiltException("Only trailing wildcards are supported: %r" % value)
+
+    if field is not None and field.startswith('user_meta.'):
+        # Flattened metadata has the path to each value before each of its words.
+        if not value:
+            prefix = False  # Any value.
+        value = _meta_phrase(field.split('.')[1:], value)
+        column = 'user_meta'
+    elif field is not None:
+        column = QUERY_FIELDS.get(field)
+        if column is None:
+            raise QuiltException("Unsupported search field: %r" % field)
+    else:
+        column = DEFAULT_COLUMNS
+
+    if not value:
+        return None  # A lone wildcard matches everything.
+    return '%s : %s' % (column, _fts_string(value) + (' *' if prefix else ''))
+
+
+def _join_expressions(expressions, operator):
+    """
+    Joins FTS5 expressions with an operator, in parentheses if there's more than one.
+    """
+    if not expressions:
+        return None
+    if len(expressions) == 1:
+        return expressions[0]
+    return '( %s )' % (' %s ' % operator).join(expressions)
+
+
+def _combine_clauses(clauses):
+    """
+    Combines (occur, expression) clauses the way Elasticsearch does: the required ('+')
+    ones must all match, and the optional ones only matter if there are none of those,
+    when one of them must match; the excluded ('-') ones must not match. An expression
+    of None matches everything, as does a query with nothing but exclusions.
+
+    Returns the expressions that must and must not match, each None if there isn't one.
+    """
+    must = [expression for occur, expression in clauses if occur == '+']
+    should = [expression for occur, expression in clauses if occur is None]
+    must_not = [expression for occur, expression in clauses if occur == '-']
+    if None in must_not:
+        raise QuiltException("A query can't exclude everything")
+    if must:
+        positive = _join_expressions([expression for expression in must if expression is not None], 'AND')
+    elif None not in should:
+        positive = _join_expressions(should, 'OR')
+    else:
+        positive = None
+    return positive, _join_expressions(must_not, 'OR')
+
+
+def _match_expression(query):
+    """
+    Translates a query string, in the subset of the Elasticsearch query string syntax
+    used with `search_util.search`, into an FTS5 match expression, or returns None
+    if it matches everything.
+
+    Supported: terms and "quoted phrases", trailing wildcards, `field:value` clauses
+    for key, package, text (or content) and user_meta(.path.to.field), AND, OR, NOT,
+    +/- signs and parentheses, with the meanings they have in Elasticsearch: terms
+    without an operator between them are optional, AND makes the terms on either side
+    of it required, and NOT excludes the term after it.
+
+    A query that only excludes terms (e.g. '-foo') matches everything else, which FTS5
+    can't express; it's returned as 'NOT' followed by the expression for what it
+    excludes, for `SearchIndex.search` to run as a subquery.
+    """
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = _QUERY_TOKEN.match(query, position)
+        if not match or match.end() == position:
+            raise QuiltException("Invalid search query: %r" % query)
+        position = match.end()
+        tokens.append(match)
+    tokens.reverse()
+
+    def parse_group(nested):
+        """
+        Parses clauses up to the end of the query, or of the group if `nested`, into
+        the expressions that must and must not match (see `_combine_clauses`).
+        """
+        clauses = []  # [occur, expression]: occur is '+', '-' or None (optional)
+        conjunction = None
+        occur = None
+        while tokens:
+            match = tokens.pop()
+            op = match.group('op')
+            if op in ('AND', '&&', 'OR', '||'):
+                if not clauses or conjunction or occur:
+                    raise QuiltException("%s needs a term on either side of it" % op)
+                conjunction = _OPERATORS[op]
+                continue
+            elif op in ('NOT', '!'):
+                if occur:
+                    raise QuiltException("NOT needs a term after it")
+                occur = '-'
+                continue
+            elif op == ')':
+                if not nested:
+                    raise QuiltException("Unbalanced parentheses in search query: %r" % query)
+                break
+            elif op is not None:  # Opening parenthesis, maybe with a sign.
+                occur = occur or op[:-1] or None
+                positive, negative = parse_group(nested=True)
+                if positive is None and negative is not None:
+                    raise QuiltException("A group in parentheses needs a term that isn't excluded")
+                expression = '( %s NOT %s )' % (positive, negative) if negative else positive
+            else:
+                occur = occur or match.group('sign')
+                expression = _match_clause(match.group('field'), match.group('value'))
+
+            if conjunction == 'AND':
+                if clauses[-1][0] is None:
+                    clauses[-1][0] = '+'
+                occur = occur or '+'
+            clauses.append([occur, expression])
+            conjunction = occur = None
+        else:
+            if nested:
+                raise QuiltException("Unbalanced parentheses in search query: %r" % query)
+        if conjunction or occur:
+            raise QuiltException("Search query ends with an operator: %r" % query)
+        return _combine_clauses(clauses)
+
+    positive, negative = parse_group(nested=False)
+    if negative is None:
+        return positive
+    if positive is None:
+        return 'NOT %s' % negative
+    return '%s NOT %s' % (positive, negative)
+
+
+def _query_expression(query):
+    """
+    Like `_match_expression`, but also takes the Elasticsearch queries (dicts) that
+    correspond to query strings: query_string, match_all, and match or term queries.
+    """
+    if isinstance(query, str):
+        return _match_expression(query)
+    if not isinstance(query, dict):
+        raise QuiltException('Value provided for `query` is invalid')
+
+    (query_type, params), = query.get('query', {'match_all': {}}).items()
+    if query_type == 'match_all':
+        return None
+    elif query_type == 'query_string':
+        return _match_expression(params['query'])
+    elif query_type in ('match', 'term'):
+        (field, value), = params.items()
+        if isinstance(value, dict):
+            value = value.get('query', value.get('value'))
+        return _match_clause(field, json.dumps(str(value)))
+    raise QuiltException("Unsupported query type: %r" % query_type)
+
+
+def _timestamp_to_iso(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat()
+
+
+def _object_fingerprint(obj):
+    # Metadata is rewritten by copying an object onto itself, which can keep its ETag.
+    return '%s %s' % (obj['ETag'], obj['LastModified'].timestamp())
+
+
+class SearchIndex(object):
+    """
+    Local full-text index of the packages in registries and the objects in buckets:
+    their keys, package names and messages, and user metadata. Searches take the
+    same queries as `Bucket.search`, and return results in the same form.
+
+    Building the index again only reads what changed: packages whose latest top hash
+    changed, and objects whose ETags or modification times changed (rewriting an
+    object's metadata doesn't change its ETag).
+    """
+    def __init__(self, path=SEARCH_INDEX_PATH):
+        """
+        Opens the index at `path`, creating an empty one if there is none.
+        """
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path))
+        try:
+            self._create_tables()
+        except sqlite3.OperationalError as error:
+            self._db.close()
+            if 'fts5' in str(error):
+                raise QuiltException(
+                    "Search indexes need SQLite with full-text search (FTS5), "
+                    "which this Python's SQLite %s doesn't have" % sqlite3.sqlite_version
+                )
+            raise
+
+    def _create_tables(self):
+        with self._db:
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS origins (origin TEXT PRIMARY KEY, fingerprint TEXT) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS documents (
+                    id INTEGER PRIMARY KEY, origin TEXT, updated TEXT, source TEXT,
+                    key TEXT, package TEXT, user_meta TEXT, text TEXT);
+                CREATE INDEX IF NOT EXISTS documents_origin ON documents (origin);
+                CREATE INDEX IF NOT EXISTS documents_updated ON documents (updated);
+                CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+                    key, package, user_meta, text, content='documents', content_rowid='id');
+                CREATE TRIGGER IF NOT EXISTS documents_insert AFTER INSERT ON documents BEGIN
+                    INSERT INTO documents_fts (rowid, key, package, user_meta, text)
+                    VALUES (new.id, new.key, new.package, new.user_meta, new.text);
+                END;
+                CREATE TRIGGER IF NOT EXISTS documents_delete AFTER DELETE ON documents BEGIN
+                    INSERT INTO documents_fts (documents_fts, rowid, key, package, user_meta, text)
+                    VALUES ('delete', old.id, old.key, old.package, old.user_meta, old.text);
+                END;
+            ''')
+
+    def _fingerprints(self, origin_prefix):
+        end = _prefix_end(origin_prefix)
+        return dict(self._db.execute(
+            'SELECT origin, fingerprint FROM origins WHERE origin >= ? AND origin < ?',
+            (origin_prefix, end)
+        ))
+
+    def _replace_origin(self, origin, fingerprint, sources):
+        """
+        Replaces the documents from `origin` with the source documents `sources`.
+        """
+        self._db.execute('DELETE FROM documents WHERE origin = ?', (origin,))
+        for batch in _batches(sources, INSERT_BATCH_SIZE):
+            self._db.executemany(
+                'INSERT INTO documents (origin, updated, source, key, package, user_meta, text) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(origin, source.get('updated'), json.dumps(source), source['key'], source.get('package'),
+                  '\n'.join(_flatten_meta(source.get('user_meta', {}))), source.get('text'))
+                 for source in batch]
+            )
+        if fingerprint is None:
+            self._db.execute('DELETE FROM origins WHERE origin = ?', (origin,))
+        else:
+            self._db.execute('INSERT OR REPLACE INTO origins VALUES (?, ?)', (origin, fingerprint))
+
+    def add_registry(self, registry=None):
+        """
+        Indexes the latest versions of the packages in a registry (the local
+        registry by default): their names, messages and metadata, and the
+        logical keys and metadata of their entries. Packages that have been
+        deleted are removed from the index.
+        """
+        registry = _registry_root(registry)
+        origin_prefix = f'package:{registry}'
+        indexed = self._fingerprints(origin_prefix)
+        for namespace in _list_package_namespaces(registry):
+            for name in _list_package_names(registry, namespace):
+                name = f'{namespace}/{name}'
+                origin = origin_prefix + name
+                top_hash = _get_latest_hash(f'{registry}.quilt/named_packages/{name}/latest')
+                if indexed.pop(origin, None) == top_hash:
+                    continue
+                with self._db:
+                    self._replace_origin(origin, top_hash, self._package_sources(registry, name, top_hash))
+
+        with self._db:
+            for origin in indexed:
+                self._replace_origin(origin, None, [])
+
+    @staticmethod
+    def _package_sources(registry, name, top_hash):
+        try:
+            summary_bytes, _ = get_bytes(f'{registry}.quilt/packages/{top_hash}{SUMMARY_SUFFIX}')
+            timestamp = json.loads(summary_bytes.decode('utf-8')).get('timestamp')
+        except (FileNotFoundError, ClientError):
+            # Built before summaries existed.
+            timestamp = None
+        updated = _timestamp_to_iso(timestamp)
+
+        lines = _iter_manifest_lines(f'{registry}.quilt/packages/{top_hash}')
+        package_meta = json.loads(next(lines))
+        yield {
+            'key': name,
+            'package': name,
+            'top_hash': top_hash,
+            'type': 'Create',
+            'user_meta': package_meta.get('user_meta', {}),
+            'text': package_meta.get('message') or '',
+            'updated': updated,
+        }
+        for line in lines:
+            if not line.strip():
+                continue
+            obj = json.loads(line)
+            if 'physical_keys' not in obj:
+                continue  # Directory metadata.
+            yield {
+                'key': obj['logical_key'],
+                'package': name,
+                'top_hash': top_hash,
+                'physical_key': obj['physical_keys'][0],
+                'type': 'Create',
+                'user_meta': (obj.get('meta') or {}).get('user_meta', {}),
+                'size': obj['size'],
+                'updated': updated,
+            }
+
+    def add_bucket(self, bucket, prefix=''):
+        """
+        Indexes the keys and metadata of the objects in `bucket` whose keys start
+        with `prefix`. Objects that have been deleted are removed from the index.
+        """
+        origin_prefix = f's3://{bucket}/'
+        indexed = self._fingerprints(origin_prefix + prefix)
+        changed = []
+        for response in _list_objects(Bucket=bucket, Prefix=prefix):
+            for obj in response.get('Contents', []):
+                if obj['Key'].endswith('/'):
+                    continue
+                origin = origin_prefix + obj['Key']
+                if indexed.pop(origin, None) != _object_fingerprint(obj):
+                    changed.append(obj)
+
+        def get_source(obj):
+            _, meta, _ = get_size_and_meta(make_s3_url(bucket, obj['Key']))
+            return {
+                'key': obj['Key'],
+                'type': 'Create',
+                'user_meta': meta.get('user_meta', {}),
+                'size': obj['Size'],
+                'updated': obj['LastModified'].astimezone(datetime.timezone.utc).isoformat(),
+            }
+
+        with ThreadPoolExecutor(data_transfer.s3_threads) as executor:
+            for batch in _batches(changed, INSERT_BATCH_SIZE):
+                sources = list(executor.map(get_source, batch))
+                with self._db:
+                    for obj, source in zip(batch, sources):
+                        self._replace_origin(origin_prefix + obj['Key'], _object_fingerprint(obj), [source])
+
+        with self._db:
+            for origin in indexed:
+                self._replace_origin(origin, None, [])
+
+    def search(self, query, limit=10, order_by='time'):
+        """
+        Searches the index.
+
+        Args:
+            query(str or dict): query string, or Elasticsearch query, as for `Bucket.search`;
+                see `_match_expression` for the supported syntax
+            limit(int): maximum number of results to return
+            order_by(str): 'time' for the newest results first, or 'score' for the most
+                relevant first
+
+        Returns:
+            a list of results in the form returned by `Bucket.search`; package documents
+            and entries have their package name and top hash in their source.
+        """
+        if order_by not in ('time', 'score'):
+            raise QuiltException("`order_by` must be 'time' or 'score'")
+        expression = _query_expression(query)
+        try:
+            if expression is None:
+                rows = self._db.execute(
+                    'SELECT source, NULL FROM documents ORDER BY updated DESC, id LIMIT ?', (limit,)
+                ).fetchall()
+            elif expression.startswith('NOT '):
+                # Everything but what the rest matches; there's nothing to score.
+                rows = self._db.execute(
+                    'SELECT source, NULL FROM documents WHERE id NOT IN '
+                    '(SELECT rowid FROM documents_fts WHERE documents_fts MATCH ?) '
+                    'ORDER BY updated DESC, id LIMIT ?',
+                    (expression[len('NOT '):], limit)
+                ).fetchall()
+            else:
+                order = 'bm25(documents_fts)' if order_by == 'score' else 'documents.updated DESC'
+                rows = self._db.execute(
+                    'SELECT documents.source, -bm25(documents_fts) FROM documents_fts '
+                    'JOIN documents ON documents.id = documents_fts.rowid '
+                    f'WHERE documents_fts MATCH ? ORDER BY {order}, documents.id LIMIT ?',
+                    (expression, limit)
+                ).fetchall()
+        except sqlite3.OperationalError as error:
+            raise QuiltException("Invalid search query: %s" % error)
+
+        hits = [{'_source': json.loads(source), '_score': score} for source, score in rows]
+        return _parse_hits({'hits': {'hits': hits}})
+
+    def close(self):
+        self._db.close()
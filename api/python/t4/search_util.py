@@ -3,10 +3,12 @@ search_util.py
 
 Contains search-related glue code
 """
+import itertools
 import json
+from threading import Lock
 from urllib.parse import urlparse
 
-from aws_requests_auth.boto_utils import BotoAWSRequestsAuth
+from aws_requests_auth.boto_utils import BotoAWSRequestsAuth, get_credentials as get_auth_credentials
 from aws_requests_auth.aws_auth import AWSRequestsAuth
 from elasticsearch import Elasticsearch, RequestsHttpConnection
 
@@ -14,43 +16,117 @@ from .session import get_credentials
 from .util import QuiltException
 
 ES_INDEX = 'drive'
+# Elasticsearch's default index.max_result_window: larger searches have to scroll.
+MAX_RESULT_WINDOW = 10000
+SCROLL_PAGE_SIZE = 1000
+SCROLL_TIMEOUT = '1m'
+DEFAULT_SORT = [{'updated': {'order': 'desc'}}]
+SCORE_SORT = ['_score'] + DEFAULT_SORT
+
+_es_clients = {}  # (search endpoint, AWS region) -> (credentials, client)
+_es_clients_lock = Lock()
+
+
+class _CredentialsAuth(AWSRequestsAuth):
+    """
+    Signs each request with the current credentials of a (refreshable) credentials object.
+    """
+    def __init__(self, credentials, aws_host, aws_region, aws_service):
+        super().__init__(None, None, aws_host, aws_region, aws_service)
+        self._credentials = credentials
+
+    def get_aws_request_headers_handler(self, r):
+        return self.get_aws_request_headers(r, **get_auth_credentials(self._credentials))
+
 
 def _create_es(search_endpoint, aws_region):
     """
     search_endpoint: url for search endpoint
     aws_region: name of aws region endpoint is hosted in
-    """
-    es_url = urlparse(search_endpoint)
 
+    Clients are thread safe, so they're cached until the credentials change.
+    """
     credentials = get_credentials()
-    if credentials:
-        # use registry-provided credentials
-        creds = credentials.get_frozen_credentials()
-        auth = AWSRequestsAuth(aws_access_key=creds.access_key,
-                               aws_secret_access_key=creds.secret_key,
-                               aws_host=es_url.hostname,
-                               aws_region=aws_region,
-                               aws_service='es',
-                               aws_token=creds.token,
-                               )
+    with _es_clients_lock:
+        cached = _es_clients.get((search_endpoint, aws_region))
+        if cached is not None and cached[0] is credentials:
+            return cached[1]
+
+        es_url = urlparse(search_endpoint)
+
+        if credentials:
+            # use registry-provided credentials
+            auth = _CredentialsAuth(credentials,
+                                    aws_host=es_url.hostname,
+                                    aws_region=aws_region,
+                                    aws_service='es')
+        else:
+            auth = BotoAWSRequestsAuth(aws_host=es_url.hostname,
+                                       aws_region=aws_region,
+                                       aws_service='es')
+
+        port = es_url.port or (443 if es_url.scheme == 'https' else 80)
+
+        es_client = Elasticsearch(
+            hosts=[{'host': es_url.hostname, 'port': port}],
+            http_auth=auth,
+            use_ssl=True,
+            verify_certs=True,
+            connection_class=RequestsHttpConnection
+        )
+
+        _es_clients[(search_endpoint, aws_region)] = (credentials, es_client)
+        return es_client
+
+def _search_payload(query, source_includes=None, source_excludes=None, sort=None):
+    if isinstance(query, dict):
+        payload = dict(query)
+    elif isinstance(query, str):
+        payload = {'query': {'query_string': {
+            'default_field': 'content',
+            'query': query,
+        }}}
     else:
-        auth = BotoAWSRequestsAuth(aws_host=es_url.hostname,
-                                   aws_region=aws_region,
-                                   aws_service='es')
-
-    port = es_url.port or (443 if es_url.scheme == 'https' else 80)
-
-    es_client = Elasticsearch(
-        hosts=[{'host': es_url.hostname, 'port': port}],
-        http_auth=auth,
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=RequestsHttpConnection
-    )
+        raise QuiltException('Value provided for `query` is invalid')
 
-    return es_client
+    if sort is not None:
+        payload['sort'] = sort
+    else:
+        payload.setdefault('sort', DEFAULT_SORT)
+    if source_includes is not None or source_excludes is not None:
+        source = payload['_source'] = {}
+        if source_includes is not None:
+            # The key is needed to make sense of the results.
+            source['includes'] = list(source_includes) + ['key']
+        if source_excludes is not None:
+            source['excludes'] = list(source_excludes)
+    return payload
+
+def _parse_hits(raw_response):
+    try:
+        results = []
+        for result in raw_response['hits']['hits']:
+            source = result['_source']
+            results.append({
+                'key': source['key'],
+                'version_id': source.get('version_id'),
+                'operation': source.get('type'),
+                'meta': json.dumps(source['user_meta']) if 'user_meta' in source else None,
+                'size': str(source['size']) if 'size' in source else None,
+                'text': source.get('text'),
+                'source': source,
+                'time': str(source['updated']) if 'updated' in source else None,
+                'score': result.get('_score'),
+            })
+        return results
+    except KeyError:
+        exception =  QuiltException("Query failed unexpectedly due to either a "
+                                    "bad query or a misconfigured search service.")
+        setattr(exception, 'raw_response', raw_response)
+        raise exception
 
-def search(query, search_endpoint, limit, aws_region='us-east-1'):
+def search(query, search_endpoint, limit, aws_region='us-east-1', source_includes=None,
+           source_excludes=None, sort=None):
     """
     Searches your bucket. Query may contain plaintext and clauses of the 
         form $key:"$value" that search for exact matches on specific keys.
@@ -60,9 +136,16 @@ def search(query, search_endpoint, limit, aws_region='us-east-1'):
         search_endpoint(string): where to go to make the search
         limit(number): maximum number of results to return
         aws_region(string): aws region (used to sign requests)
+        source_includes(list): fields of the source documents to return, e.g.
+            ['key', 'size']; defaults to all of them
+        source_excludes(list): fields of the source documents not to return,
+            e.g. ['text'] to skip the (large) indexed text
+        sort(list): Elasticsearch sort clauses, e.g. SCORE_SORT for the most
+            relevant results first; defaults to the query's own sort, if any,
+            or DEFAULT_SORT (newest first)
 
     Returns either the request object (in case of an error)
-            or a list of objects with the following keys:
+            or a list of objects, in sort order, with the following keys:
         key: key of the object
         version_id: version_id of object version
         operation: Create or Delete
@@ -71,52 +154,49 @@ def search(query, search_endpoint, limit, aws_region='us-east-1'):
         text: indexed text of object
         source: source document for object (what is actually stored in ElasticSeach)
         time: timestamp for operation
+        score: relevance score (None unless sorting by score)
+    Keys for fields that aren't returned are None.
     """
-    es_client = _create_es(search_endpoint, aws_region)
+    if limit and limit > MAX_RESULT_WINDOW:
+        return list(itertools.islice(
+            iter_search(query, search_endpoint, aws_region, source_includes=source_includes,
+                        source_excludes=source_excludes, sort=sort),
+            limit
+        ))
 
-    if isinstance(query, dict):
-        payload = query
-    elif isinstance(query, str):
-        payload = {'query': {'query_string': {
-            'default_field': 'content',
-            'query': query,
-        }}}
-    else:
-        raise QuiltException('Value provided for `query` is invalid')
+    es_client = _create_es(search_endpoint, aws_region)
 
+    payload = _search_payload(query, source_includes, source_excludes, sort)
     if limit:
         payload['size'] = limit
 
     raw_response = es_client.search(index=ES_INDEX, body=payload)
+    return _parse_hits(raw_response)
 
+def iter_search(query, search_endpoint, aws_region='us-east-1', page_size=SCROLL_PAGE_SIZE,
+                source_includes=None, source_excludes=None, sort=None):
+    """
+    Like `search`, but returns a generator over all the results, which are fetched
+    a page at a time with the scroll API.
+    """
+    es_client = _create_es(search_endpoint, aws_region)
+
+    payload = _search_payload(query, source_includes, source_excludes, sort)
+    payload['size'] = page_size
+
+    raw_response = es_client.search(index=ES_INDEX, body=payload, scroll=SCROLL_TIMEOUT)
+    scroll_id = raw_response.get('_scroll_id')
     try:
-        results = []
-        for result in raw_response['hits']['hits']:
-            key = result['_source']['key']
-            vid = result['_source']['version_id']
-            operation = result['_source']['type']
-            meta = json.dumps(result['_source']['user_meta'])
-            size = str(result['_source']['size'])
-            text = result['_source']['text']
-
-            time = str(result['_source']['updated'])
-            results.append({
-                'key': key,
-                'version_id': vid,
-                'operation': operation,
-                'meta': meta,
-                'size': size,
-                'text': text,
-                'source': result['_source'],
-                'time': time
-            })
-        results = list(sorted(results, key=lambda x: x['time'], reverse=True))
-        return results
-    except KeyError:
-        exception =  QuiltException("Query failed unexpectedly due to either a "
-                                    "bad query or a misconfigured search service.")
-        setattr(exception, 'raw_response', raw_response)
-        raise exception
+        while True:
+            results = _parse_hits(raw_response)
+            if not results:
+                break
+            yield from results
+            raw_response = es_client.scroll(scroll_id=scroll_id, scroll=SCROLL_TIMEOUT)
+            scroll_id = raw_response.get('_scroll_id', scroll_id)
+    finally:
+        if scroll_id is not None:
+            es_client.clear_scroll(scroll_id=scroll_id)
 
 def get_raw_mapping_unpacked(endpoint, aws_region, return_full_response=False):
     """
@@ -1,9 +1,12 @@
 import re
 from collections import OrderedDict
 from collections.abc import Mapping, Sequence, Set
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import json
 import os
+from threading import Lock
+import time
 from urllib.parse import parse_qs, quote, unquote, urlencode, urljoin, urlparse, urlunparse
 from urllib.request import url2pathname
 from fnmatch import fnmatch
@@ -26,6 +29,7 @@ APP_AUTHOR = "QuiltData"
 BASE_DIR = user_data_dir(APP_NAME, APP_AUTHOR)
 BASE_PATH = pathlib.Path(BASE_DIR)
 CONFIG_PATH = BASE_PATH / 'config.yml'
+CACHE_PATH = BASE_PATH / 'cache'
 
 PACKAGE_NAME_FORMAT = r"[\w-]+/[\w-]+$"
 
@@ -260,42 +264,104 @@ class T4Config(OrderedDict):
         return "<{} at {!r} {}>".format(type(self).__name__, str(self.filepath), json.dumps(self, indent=4))
 
 
-def find_bucket_config(bucket_name, catalog_config_url):
-    config_request = requests.get(catalog_config_url)
-    if not config_request.ok:
+# Catalog, federation and bucket configs are reused for this many seconds, then revalidated.
+CONFIG_CACHE_TTL = 300
+# Number of federation and bucket configs to fetch at once.
+CONFIG_FETCH_THREADS = 8
+
+_config_cache = {}  # URL -> (time fetched, ETag, parsed config)
+_config_cache_lock = Lock()
+
+
+def _get_config_json(url):
+    """
+    Fetches and parses the JSON config at `url`, or returns None if that fails.
+
+    Configs are cached for CONFIG_CACHE_TTL seconds; after that, they're only
+    downloaded again if their ETag has changed.
+    """
+    with _config_cache_lock:
+        cached = _config_cache.get(url)
+    now = time.time()
+    headers = {}
+    if cached is not None:
+        fetched, etag, config_json = cached
+        if now - fetched < CONFIG_CACHE_TTL:
+            return config_json
+        if etag is not None:
+            headers['If-None-Match'] = etag
+
+    response = requests.get(url, headers=headers)
+    if cached is not None and response.status_code == 304:
+        with _config_cache_lock:
+            _config_cache[url] = (now, etag, config_json)
+        return config_json
+    if not response.ok:
+        return None
+    config_json = json.loads(response.text)
+    with _config_cache_lock:
+        _config_cache[url] = (now, response.headers.get('ETag'), config_json)
+    return config_json
+
+
+def get_bucket_configs(catalog_config_url):
+    """
+    Returns a dict of bucket name -> bucket config for all the buckets in the
+    federations of a catalog config. If a bucket is in several federations,
+    the last one's config wins.
+
+    Federations, and bucket configs given as URLs, are fetched concurrently.
+    """
+    config_json = _get_config_json(catalog_config_url)
+    if config_json is None:
         raise QuiltException("Failed to get catalog config")
-    config_json = json.loads(config_request.text)
     if 'federations' not in config_json:
         # try old config format
         try:
-            return config_json['configs'][bucket_name]
+            return dict(config_json['configs'])
         except KeyError:
             raise QuiltException("Catalog config malformed")
 
-    federations = config_json['federations']
-    federations.reverse() # want to get results from last federation first
-    for federation in federations:
-        parsed = urlparse(federation)
-        if not parsed.netloc:
-            # relative URL
-            federation = urljoin(catalog_config_url, federation)
-        federation_request = requests.get(federation)
-        if not federation_request.ok:
-            continue
-        federation = json.loads(federation_request.text)
-        if 'buckets' not in federation:
-            continue
-        buckets = federation['buckets']
-        for bucket in buckets:
+    federation_urls = [
+        # relative URLs are relative to the catalog config
+        federation if urlparse(federation).netloc else urljoin(catalog_config_url, federation)
+        for federation in config_json['federations']
+    ]
+    with ThreadPoolExecutor(CONFIG_FETCH_THREADS) as executor:
+        federations = [federation for federation in executor.map(_get_config_json, federation_urls)
+                       if federation is not None and 'buckets' in federation]
+        bucket_urls = {bucket for federation in federations for bucket in federation['buckets']
+                       if isinstance(bucket, str)}
+        fetched_buckets = dict(zip(bucket_urls, executor.map(_get_config_json, bucket_urls)))
+
+    bucket_configs = {}
+    # want to get results from last federation first
+    for federation in reversed(federations):
+        for bucket in federation['buckets']:
             if isinstance(bucket, str):
-                bucket_request = requests.get(bucket)
-                if not bucket_request.ok:
+                bucket = fetched_buckets[bucket]
+                if bucket is None:
                     continue
-                bucket = json.loads(bucket_request.text)
-            if bucket['name'] == bucket_name:
-                return bucket
+            bucket_configs.setdefault(bucket['name'], bucket)
+    return bucket_configs
+
 
-    raise QuiltException("Failed to find a config for the chosen bucket")
+def find_bucket_config(bucket_name, catalog_config_url):
+    try:
+        return get_bucket_configs(catalog_config_url)[bucket_name]
+    except KeyError:
+        raise QuiltException("Failed to find a config for the chosen bucket")
+
+
+def get_catalog_config_url():
+    """
+    Returns the URL of the config of the catalog at `navigator_url`.
+    """
+    navigator_url = get_from_config('navigator_url')
+    if not navigator_url:
+        raise QuiltException("Must set `t4.config(navigator_url)`, where `navigator_url` is the URL "
+                             "of your catalog homepage.")
+    return navigator_url.rstrip('/') + '/config.json'
 
 def validate_package_name(name):
     """ Verify that a package name is two alphanumerics strings separated by a slash."""
@@ -326,6 +392,132 @@ def get_install_location():
         loc = get_package_registry() + '/' + 'data/'
     return loc
 
+def _translate_ignore_glob(pattern):
+    """
+    Translates a .gitignore-style glob into a regex: `*` and `?` don't match `/`,
+    and `**` as a whole path component matches any number of directories.
+    """
+    res = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern.startswith('**', i) and (i == 0 or pattern[i - 1] == '/'):
+                if i + 2 == n:
+                    res.append('.*')
+                    i += 2
+                    continue
+                if pattern[i + 2] == '/':
+                    res.append('(?:.*/)?')
+                    i += 3
+                    continue
+            res.append('[^/]*')
+            while i < n and pattern[i] == '*':
+                i += 1
+            continue
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                res.append('\\[')
+            else:
+                stuff = pattern[i + 1:j].replace('\\', '\\\\')
+                if stuff[0] in '!^':
+                    stuff = '^' + stuff[1:]
+                res.append('[%s]' % stuff)
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            res.append(re.escape(pattern[i]))
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return ''.join(res)
+
+
+class QuiltIgnore(object):
+    """
+    Compiled .quiltignore rules, with the same syntax and semantics as .gitignore.
+
+    Paths are matched relative to the directory containing the rules, in POSIX form.
+    Consecutive rules that either all ignore or all re-include (`!`) paths are
+    combined into a single regex, so a path usually takes one regex match.
+    """
+    def __init__(self, rules):
+        """
+        Args:
+            rules: iterable of lines of a .quiltignore file
+        """
+        runs = []  # [negate, file regexes, directory regexes]
+        for rule in rules:
+            rule = rule.rstrip('\r\n')
+            if not rule.endswith('\\ '):
+                rule = rule.rstrip(' ')
+            if not rule or rule.startswith('#'):
+                continue
+
+            negate = rule.startswith('!')
+            if negate:
+                rule = rule[1:]
+            elif rule.startswith(('\\!', '\\#')):
+                rule = rule[1:]
+            dir_only = rule.endswith('/')
+            rule = rule.rstrip('/')
+            if not rule:
+                continue
+            # Patterns with a slash are relative to the root; others match at any level.
+            anchored = '/' in rule
+            regex = ('' if anchored else '(?:.*/)?') + _translate_ignore_glob(rule.lstrip('/'))
+
+            if not runs or runs[-1][0] != negate:
+                runs.append([negate, [], []])
+            if not dir_only:
+                runs[-1][1].append(regex)
+            runs[-1][2].append(regex)
+
+        def compile_run(regexes):
+            return re.compile('(?:%s)\\Z' % '|'.join(regexes)) if regexes else None
+
+        self._runs = [(negate, compile_run(file_regexes), compile_run(dir_regexes))
+                      for negate, file_regexes, dir_regexes in runs]
+
+    @classmethod
+    def from_file(cls, path):
+        """ Loads the rules from a .quiltignore file. """
+        return cls(pathlib.Path(path).read_text('utf-8').splitlines())
+
+    def match(self, rel_path, is_dir=False):
+        """
+        Returns whether a path is ignored by the rules themselves, without checking its
+        parent directories. Meant for walking a directory tree, where ignored
+        directories are skipped altogether.
+        """
+        # The last matching rule wins.
+        for negate, file_regex, dir_regex in reversed(self._runs):
+            regex = dir_regex if is_dir else file_regex
+            if regex is not None and regex.match(rel_path):
+                return not negate
+        return False
+
+    def is_ignored(self, rel_path, is_dir=False):
+        """
+        Returns whether a path is ignored, either by itself or because one of its
+        parent directories is. Like git, a path can't be re-included if its parent is ignored.
+        """
+        parts = rel_path.split('/')
+        for i in range(1, len(parts)):
+            if self.match('/'.join(parts[:i]), is_dir=True):
+                return True
+        return self.match(rel_path, is_dir)
+
+
 def quiltignore_filter(paths, ignore, url_scheme):
     """Given a list of paths, filter out the paths which are captured by the 
     given ignore rules.
@@ -337,33 +529,19 @@ def quiltignore_filter(paths, ignore, url_scheme):
         url_scheme (str): the URL scheme, only the "file" scheme is currently
             supported
     """
-    ignore_rules = ignore.read_text('utf-8').split("\n")
-    ignore_rules = ['*/' + rule for rule in ignore_rules if rule]
-
     if url_scheme == 'file':
-        from fnmatch import fnmatch
+        matcher = QuiltIgnore.from_file(ignore)
+        root = pathlib.Path(ignore).parent
 
-        files, dirs = set(), set()
+        kept = set()
         for path in paths:
-            if path.is_file():
-                files.add(path)
-            else:
-                dirs.add(path)
-
-        filtered_dirs = dirs.copy()
-        for ignore_rule in ignore_rules:
-
-            for pkg_dir in filtered_dirs.copy():
-                # copy git behavior --- git matches paths and directories equivalently.
-                # e.g. both foo and foo/ will match the ignore rule "foo"
-                # but only foo/ will match the ignore rule "foo/"
-                if fnmatch(pkg_dir.as_posix() + "/", ignore_rule) or fnmatch(pkg_dir.as_posix(), ignore_rule):
-                    files = set(n for n in files if pkg_dir not in n.parents)
-                    dirs = dirs - {pkg_dir}
-
-            files = set(n for n in files if not fnmatch(n, ignore_rule))
-
-        return files.union(dirs)
+            try:
+                rel_path = path.relative_to(root).as_posix()
+            except ValueError:
+                rel_path = path.as_posix()
+            if not matcher.is_ignored(rel_path, is_dir=not path.is_file()):
+                kept.add(path)
+        return kept
     else:
         raise NotImplementedError
 
@@ -1,16 +1,21 @@
 """ Integration tests for T4 Packages. """
+import datetime
 from io import BytesIO
+import json
 import os
 import pathlib
 from pathlib import Path
 import shutil
 
+from botocore.exceptions import ClientError
+import humanize
 import jsonlines
 from unittest.mock import patch, call, ANY
 import pytest
 
 import t4
 from t4 import Package
+from t4.exceptions import PackageException
 from t4.util import (QuiltException, APP_NAME, APP_AUTHOR, BASE_DIR, BASE_PATH,
                      validate_package_name, parse_file_url, fix_url)
 
@@ -196,9 +201,11 @@ class PackageTest(QuiltTestCase):
                     in [x[0][0] for x in pkgmock.call_args_list]
 
             pkgmock.reset_mock()
-            with patch('t4.packages.get_bytes') as dl_mock:
-                dl_mock.return_value = (top_hash.encode('utf-8'), None)
+            with patch('t4.packages.get_bytes_if_changed') as dl_mock:
+                dl_mock.return_value = (top_hash.encode('utf-8'), '"etag"')
                 pkg = Package.browse('Quilt/nice-name', registry=remote_registry)
+                assert remote_registry + '/.quilt/named_packages/Quilt/nice-name/latest' \
+                        == dl_mock.call_args_list[0][0][0]
             assert '{}/.quilt/packages/{}'.format(remote_registry, top_hash) \
                     in [x[0][0] for x in pkgmock.call_args_list]
 
@@ -330,6 +337,32 @@ class PackageTest(QuiltTestCase):
             }
         )
 
+        self.s3_stubber.add_response(
+            method='put_object',
+            service_response={
+                'VersionId': 'v2'
+            },
+            expected_params={
+                'Body': ANY,
+                'Bucket': 'my_test_bucket',
+                'Key': '.quilt/packages/' + top_hash + '.index',
+                'Metadata': {'helium': 'null'}
+            }
+        )
+
+        self.s3_stubber.add_response(
+            method='put_object',
+            service_response={
+                'VersionId': 'v2'
+            },
+            expected_params={
+                'Body': ANY,
+                'Bucket': 'my_test_bucket',
+                'Key': '.quilt/packages/' + top_hash + '.summary',
+                'Metadata': {'helium': 'null'}
+            }
+        )
+
         self.s3_stubber.add_response(
             method='put_object',
             service_response={
@@ -555,6 +588,10 @@ class PackageTest(QuiltTestCase):
             assert 'Quilt/Foo:latest' in pkgs_repr
             assert 'Quilt/Bar:latest' in pkgs_repr
 
+            # Verify namespaces can be listed without reading pointers.
+            assert t4.api._list_package_names(None, 'Quilt') == ['Bar', 'Foo', 'Test']
+            assert t4.api._list_package_names(None, 'Nobody') == []
+
             # Test unnamed packages are not added.
             Package().build()
             pkgs = t4.list_packages()
@@ -565,6 +602,35 @@ class PackageTest(QuiltTestCase):
             assert "Quilt/Foo" in pkgs
             assert "Quilt/Bar" in pkgs
 
+    def test_package_summaries(self):
+        """Verify list_packages reads package summaries, and backfilling them."""
+        pkg = Package()
+        pkg.set('foo', DATA_DIR / 'foo.txt')
+        pkg.set('bar/baz', DATA_DIR / 'foo.txt')
+        top_hash = pkg.build('Quilt/Summary', message='summarized').top_hash
+
+        summary_path = Path(BASE_PATH, '.quilt/packages', top_hash + '.summary')
+        summary = json.loads(summary_path.read_text())
+        size = (DATA_DIR / 'foo.txt').stat().st_size
+        assert summary['top_hash'] == top_hash
+        assert summary['entries'] == 2
+        assert summary['size'] == 2 * size
+        assert summary['message'] == 'summarized'
+
+        with patch('t4.Package.browse') as browse_mock:
+            assert 'Quilt/Summary' in t4.list_packages()
+            browse_mock.assert_not_called()
+
+        # Packages built before summaries existed still list, and can be backfilled.
+        summary_path.unlink()
+        pkgs = t4.list_packages()
+        assert 'Quilt/Summary' in pkgs
+        assert humanize.naturalsize(2 * size) in str(pkgs)
+
+        assert top_hash in t4.api.backfill_package_summaries()
+        assert json.loads(summary_path.read_text())['size'] == 2 * size
+        assert not t4.api.backfill_package_summaries()
+
     def test_set_package_entry(self):
         """ Set the physical key for a PackageEntry"""
         pkg = (
@@ -633,6 +699,88 @@ class PackageTest(QuiltTestCase):
         pkg.set('jkl;', REMOTE_MANIFEST)
         assert set(pkg) == {'asdf', 'jkl;'}
 
+    def test_walk_order_and_prefix(self):
+        """Verify walk order is kept up to date, and prefix iteration."""
+        pkg = Package()
+        for lk in ['b/y', 'b/x', 'a', 'b/z/1', 'bb', 'c']:
+            pkg.set(lk, LOCAL_MANIFEST)
+        assert [lk for lk, _ in pkg.walk()] == ['a', 'b/x', 'b/y', 'b/z/1', 'bb', 'c']
+
+        pkg.delete('b/y')
+        pkg.set('b/a', LOCAL_MANIFEST)
+        pkg.set('d', LOCAL_MANIFEST)
+        assert [lk for lk, _ in pkg.walk()] == ['a', 'b/a', 'b/x', 'b/z/1', 'bb', 'c', 'd']
+
+        assert [lk for lk, _ in pkg.iter_prefix('b/')] == ['b/a', 'b/x', 'b/z/1']
+        assert [lk for lk, _ in pkg.iter_prefix('b')] == ['b/a', 'b/x', 'b/z/1', 'bb']
+        assert [lk for lk, _ in pkg.iter_prefix('b/z')] == ['b/z/1']
+        assert [lk for lk, _ in pkg.iter_prefix('')] == [lk for lk, _ in pkg.walk()]
+        assert not list(pkg.iter_prefix('e'))
+        assert not list(pkg.iter_prefix('a/'))
+        assert not list(pkg.iter_prefix('nope/'))
+        assert next(pkg.iter_prefix('b/x'))[1] is pkg['b/x']
+
+        assert 'b/z/1' in pkg
+        assert 'b/z' in pkg
+        assert 'b/q' not in pkg
+        assert 'a/b' not in pkg
+
+    def test_set_many(self):
+        """Verify bulk construction matches set(), and validates up front."""
+        pkg = Package()
+        pkg.set('a/b', LOCAL_MANIFEST, meta={'a': 'b'})
+        pkg.set('a/c', REMOTE_MANIFEST)
+        pkg.set('d', LOCAL_MANIFEST)
+        pkg.build()
+
+        copied = Package.from_entries(pkg.walk())
+        assert copied.diff(pkg) == ([], [], [])
+        assert [lk for lk, _ in copied.walk()] == ['a/b', 'a/c', 'd']
+        # Entries are copies that share the hash with the originals.
+        assert copied['a/b'] is not pkg['a/b']
+        assert copied['a/b'].hash is pkg['a/b'].hash
+        copied['a/b'].set_meta({'changed': True})
+        assert pkg['a/b'].meta == {'a': 'b'}
+        assert copied['a/b'].meta == {'changed': True}
+
+        pkg.set_many([('e/f', pkg['d']), ('a/g', pkg['d'])])
+        assert [lk for lk, _ in pkg.walk()] == ['a/b', 'a/c', 'a/g', 'd', 'e/f']
+
+        for bad_key in ['x/', 'x/../y', '']:
+            with pytest.raises(QuiltException):
+                pkg.set_many([('ok', pkg['d']), (bad_key, pkg['d'])])
+            assert 'ok' not in pkg
+        # Conflicts with the package or among the new keys don't change anything.
+        keys = [lk for lk, _ in pkg.walk()]
+        for conflicting in (['a'], ['d/x'], ['new/x', 'new'], ['new', 'new/x'], ['a/b/x']):
+            with pytest.raises(QuiltException):
+                pkg.set_many([('ok/y', pkg['d'])] + [(lk, pkg['d']) for lk in conflicting])
+            assert [lk for lk, _ in pkg.walk()] == keys
+            assert 'ok' not in pkg and 'new' not in pkg
+        with pytest.raises(TypeError):
+            pkg.set_many([('x', LOCAL_MANIFEST)])
+
+    def test_copy_on_write(self):
+        """Verify derived packages share entry data until it's modified."""
+        pkg = Package()
+        pkg.set('a', LOCAL_MANIFEST, meta={'a': {'b': 'c'}})
+        pkg.set('d', LOCAL_MANIFEST, meta={'d': 'e'})
+        filtered = pkg.filter(lambda lk, entry: True)
+        copied = Package().set('a', pkg['a'])
+
+        for derived in [filtered, copied]:
+            assert derived['a']._raw_meta is pkg['a']._raw_meta
+            assert derived['a'].physical_keys is pkg['a'].physical_keys
+
+        # In-place edits of either side don't show up on the other.
+        filtered['a'].meta['a']['b'] = 'changed'
+        assert filtered['a'].meta == {'a': {'b': 'changed'}}
+        assert pkg['a'].meta == {'a': {'b': 'c'}}
+        assert copied['a'].meta == {'a': {'b': 'c'}}
+        pkg['d']._meta['target'] = 'unicode'
+        assert 'target' not in filtered['d']._meta
+        assert filtered['d'] != pkg['d']
+
     def test_invalid_set_key(self):
         """Verify an exception when setting a key with a path object."""
         pkg = Package()
@@ -700,12 +848,16 @@ class PackageTest(QuiltTestCase):
                 return (b'100', None)
             elif src.endswith('foo/bar/1549931300'):
                 return (b'90', None)
+            elif src == 's3://my_test_bucket/.quilt/packages/100.summary':
+                return (b'{"top_hash": "100", "entries": 2, "size": 5}', None)
+            elif src == 's3://my_test_bucket/.quilt/packages/90.summary':
+                raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
             else:
                 raise ValueError
 
         with patch('t4.api.list_objects', side_effect=pseudo_list_objects), \
             patch('t4.api.get_bytes', side_effect=pseudo_get_bytes), \
-            patch('t4.Package.browse', return_value=Package()):
+            patch('t4.Package.browse', return_value=Package()) as browse_mock:
             pkgs = t4.list_packages('s3://my_test_bucket/')
 
             assert len(pkgs) == 1
@@ -713,11 +865,14 @@ class PackageTest(QuiltTestCase):
 
             expected = (
                 'PACKAGE                    \tTOP HASH    \tCREATED     \tSIZE        \t\n'
-                'foo/bar:latest             \t100            \tnow            \t0 Bytes\t\n'
+                'foo/bar:latest             \t100            \tnow            \t5 Bytes\t\n'
                 'foo/bar                    \t90             \t30 seconds ago \t0 Bytes\t\n'
             )
             assert str(pkgs) == expected
 
+            # Only the version without a summary had its manifest read.
+            browse_mock.assert_called_once_with(registry='s3://my_test_bucket/', top_hash='90')
+
 
     def test_validate_package_name(self):
         validate_package_name("a/b")
@@ -754,6 +909,42 @@ class PackageTest(QuiltTestCase):
         p2 = Package.browse('Quilt/Test', registry='local')
         assert p1.diff(p2) == ([], [], [])
 
+    def test_diff_changes(self):
+        """Verify diffs of packages and of their manifests agree."""
+        pkg1 = Package()
+        for lk in ['a', 'b/c', 'b/d', 'b/e/f', 'b-', 'g']:
+            pkg1.set(lk, LOCAL_MANIFEST)
+        pkg2 = Package()
+        for lk in ['a', 'b/d', 'b/e/f', 'b/e/g', 'b-', 'h']:
+            pkg2.set(lk, LOCAL_MANIFEST)
+        pkg2['b/d'].set_meta({'changed': True})
+        pkg2.set('b-', REMOTE_MANIFEST)
+        pkg1.build()
+        pkg2.build()
+
+        expected = (['b/e/g', 'h'], ['b/d', 'b-'], ['b/c', 'g'])
+        assert pkg1.diff(pkg2) == expected
+        assert pkg2.diff(pkg1) == (expected[2], expected[1], expected[0])
+
+        manifest1 = (BASE_PATH / '.quilt/packages' / pkg1.top_hash).as_uri()
+        manifest2 = (BASE_PATH / '.quilt/packages' / pkg2.top_hash).as_uri()
+        changes = list(Package.diff_manifests(manifest1, manifest2))
+        assert changes == [
+            ('deleted', 'b/c'), ('modified', 'b/d'), ('added', 'b/e/g'),
+            ('modified', 'b-'), ('deleted', 'g'), ('added', 'h'),
+        ]
+        assert not list(Package.diff_manifests(manifest1, manifest1))
+
+        # Entries with different physical keys but the same contents are unchanged.
+        with open(BASE_PATH / '.quilt/packages' / pkg1.top_hash) as fd:
+            lines = fd.read().splitlines()
+        moved = [line.replace('local_manifest.jsonl', 'moved.jsonl') for line in lines]
+        assert not list(Package.diff_manifests(manifest1, moved))
+
+        unsorted = lines[:1] + lines[:0:-1]
+        with pytest.raises(PackageException):
+            list(Package.diff_manifests(manifest1, unsorted))
+
 
     def test_dir_meta(self):
         test_meta = {'test': 'meta'}
@@ -781,6 +972,103 @@ class PackageTest(QuiltTestCase):
         assert pkg2['qwer']['as'].meta == test_meta
         assert pkg2.meta == test_meta
 
+    def test_columnar_manifest(self):
+        """Verify the columnar manifest loads to the same package as the JSONL one."""
+        pkg = Package()
+        pkg.set('asdf/jkl', LOCAL_MANIFEST, meta={'foo': 'bar'})
+        pkg.set('asdf/qwer', LOCAL_MANIFEST)
+        pkg.set('qwer', LOCAL_MANIFEST)
+        pkg['asdf'].set_meta({'test': 'meta'})
+        pkg.set_meta({'package': 'meta'})
+        top_hash = pkg.build('Quilt/Test', columnar=True).top_hash
+
+        assert Path(BASE_PATH, '.quilt/packages', top_hash + '.parquet').exists()
+
+        pkg2 = Package.browse('Quilt/Test', registry='local', columnar=True)
+        assert pkg2.top_hash == top_hash
+        assert list(pkg2.manifest) == list(Package.browse('Quilt/Test', registry='local').manifest)
+        assert pkg2['asdf'].meta == {'test': 'meta'}
+        assert pkg2['asdf/jkl'].meta == {'foo': 'bar'}
+
+        df = Package.browse_columns('Quilt/Test', registry='local', columns=['logical_key', 'size'])
+        assert list(df.columns) == ['logical_key', 'size']
+        assert list(df['logical_key']) == ['asdf/', 'asdf/jkl', 'asdf/qwer', 'qwer']
+
+        with pytest.raises(QuiltException):
+            Package.browse_columns('Quilt/Test', registry='local', columns=['nope'])
+
+    def test_browse_prefix(self):
+        """Verify loading a subtree of a package through the prefix index."""
+        pkg = Package()
+        pkg.set('images/2018/a', LOCAL_MANIFEST)
+        pkg.set('images/2019/a', LOCAL_MANIFEST)
+        pkg.set('images/2019/b/c', LOCAL_MANIFEST)
+        pkg.set('images/2019b', LOCAL_MANIFEST)
+        pkg.set('z', LOCAL_MANIFEST)
+        pkg['images'].set_meta({'dir': 'images'})
+        pkg['images/2018'].set_meta({'dir': '2018'})
+        pkg['images/2019/b'].set_meta({'dir': 'b'})
+        pkg.set_meta({'package': 'meta'})
+        top_hash = pkg.build('Quilt/Test').top_hash
+
+        def check(sub_pkg):
+            assert [lk for lk, _ in sub_pkg.walk()] == ['images/2019/a', 'images/2019/b/c']
+            assert sub_pkg.meta == {'package': 'meta'}
+            assert sub_pkg['images'].meta == {'dir': 'images'}
+            assert sub_pkg['images/2019/b'].meta == {'dir': 'b'}
+            assert sub_pkg['images/2019/a'] == pkg['images/2019/a']
+
+        with patch('t4.packages.get_byte_range', wraps=t4.packages.get_byte_range) as range_mock:
+            check(Package.browse('Quilt/Test', registry='local', prefix='images/2019/'))
+            assert range_mock.call_count == 2
+
+        assert [lk for lk, _ in Package.browse(
+            'Quilt/Test', registry='local', prefix='images/2019').walk()] == \
+            ['images/2019/a', 'images/2019/b/c', 'images/2019b']
+        assert not list(Package.browse('Quilt/Test', registry='local', prefix='nope/').walk())
+
+        # Manifests without an index are read in full.
+        Path(BASE_PATH, '.quilt/packages', top_hash + '.index').unlink()
+        check(Package.browse('Quilt/Test', registry='local', prefix='images/2019/'))
+
+    def test_remote_browse_cache(self):
+        """Verify manifests and latest pointers of remote registries are cached locally."""
+        with open(REMOTE_MANIFEST) as fd:
+            top_hash = Package.load(fd).top_hash
+        manifest = Path(REMOTE_MANIFEST).read_bytes()
+
+        registry = 's3://cache-test-bucket'
+        latest_params = {
+            'Bucket': 'cache-test-bucket',
+            'Key': '.quilt/named_packages/Quilt/Cached/latest',
+        }
+        self.s3_stubber.add_response(
+            'get_object',
+            {'Body': BytesIO(top_hash.encode('utf-8')), 'ETag': '"latest1"'},
+            latest_params
+        )
+        self.s3_stubber.add_response(
+            'get_object',
+            {'Body': BytesIO(manifest), 'Metadata': {}},
+            {'Bucket': 'cache-test-bucket', 'Key': '.quilt/packages/' + top_hash}
+        )
+
+        assert Package.browse('Quilt/Cached', registry=registry).top_hash == top_hash
+        # Within the TTL, neither the pointer nor the manifest is requested again.
+        assert Package.browse('Quilt/Cached', registry=registry).top_hash == top_hash
+        assert Package.browse(registry=registry, top_hash=top_hash).top_hash == top_hash
+
+        # After the TTL, the pointer is revalidated with a conditional GET.
+        self.s3_stubber.add_client_error(
+            'get_object',
+            http_status_code=304,
+            expected_params=dict(latest_params, IfNoneMatch='"latest1"')
+        )
+        now = t4.packages.time.time()
+        with patch('t4.packages.time.time', return_value=now + t4.packages.LATEST_POINTER_TTL):
+            assert Package.browse('Quilt/Cached', registry=registry).top_hash == top_hash
+        self.s3_stubber.assert_no_pending_responses()
+
     def test_top_hash_stable(self):
         """Ensure that top_hash() never changes for a given manifest"""
 
@@ -792,6 +1080,43 @@ class PackageTest(QuiltTestCase):
         assert pkg.top_hash == top_hash, \
             "Unexpected top_hash for {}/.quilt/packages/{}".format(registry, top_hash)
 
+    def test_top_hash_cache(self):
+        """Verify cached entry serializations are reused, but never stale."""
+        registry = DATA_DIR
+        top_hash = '20de5433549a4db332a11d8d64b934a82bdea8f144b4aecd901e7d4134f8e733'
+        pkg = Package.browse(registry=registry, top_hash=top_hash)
+        assert pkg.top_hash == top_hash
+
+        with patch('t4.packages.json.dumps', wraps=json.dumps) as dumps_mock:
+            assert pkg.top_hash == top_hash
+            # Package meta and the logical keys only.
+            assert dumps_mock.call_count == 1 + len(list(pkg.walk()))
+
+        # In-place edits of entry metadata are picked up.
+        lk, entry = next(pkg.walk())
+        entry._meta['edited'] = True
+        edited_hash = pkg.top_hash
+        assert edited_hash != top_hash
+        manifest = BytesIO()
+        pkg.dump(manifest)
+        manifest.seek(0)
+        assert Package.load(manifest).top_hash == edited_hash
+
+        del entry._meta['edited']
+        assert pkg.top_hash == top_hash
+
+        # Changes to equal values that serialize differently are picked up too.
+        entry._meta['flag'] = 1
+        one_hash = pkg.top_hash
+        entry._meta['flag'] = True
+        assert pkg.top_hash != one_hash
+        size = entry.size
+        entry.size = float(size)
+        assert pkg.top_hash != one_hash
+        entry.size = size
+        del entry._meta['flag']
+        assert pkg.top_hash == top_hash
+
 
     def test_local_package_delete(self):
         """Verify local package delete works."""
@@ -835,16 +1160,25 @@ class PackageTest(QuiltTestCase):
 
         def get_bytes_mock(*args): return b'101', None
 
+        cached_latest = t4.packages._cache_path(
+            t4.packages.LATEST_CACHE_PATH, 's3://test-bucket/.quilt/named_packages/Quilt/Test/latest')
+        t4.packages._write_cache_file(cached_latest, b'{}')
+
         with patch('t4.api.list_packages', new=list_packages_mock), \
                 patch('t4.api._tophashes_with_packages', new=_tophashes_with_packages_mock), \
                 patch('t4.api.list_objects', new=list_objects_mock), \
                 patch('t4.api.get_bytes', new=get_bytes_mock), \
-                patch('t4.api.delete_object') as delete_mock:
+                patch('t4.api.delete_object') as delete_mock, \
+                patch('t4.api.delete_objects') as delete_objects_mock:
             t4.delete_package('Quilt/Test', registry='s3://test-bucket')
 
             delete_mock.assert_any_call('test-bucket', '.quilt/packages/101')
+            delete_objects_mock.assert_called_once_with(
+                'test-bucket', ['.quilt/packages/101' + suffix for suffix in t4.packages.MANIFEST_SIDECAR_SUFFIXES])
             delete_mock.assert_any_call('test-bucket', '.quilt/named_packages/Quilt/Test/0')
             delete_mock.assert_any_call('test-bucket', '.quilt/named_packages/Quilt/Test/latest')
+            # The deleted package's latest hash isn't served from the cache.
+            assert not cached_latest.exists()
 
 
     def test_remote_package_delete_overlapping(self):
@@ -878,6 +1212,106 @@ class PackageTest(QuiltTestCase):
             delete_mock.assert_any_call('test-bucket', '.quilt/named_packages/Quilt/Test1/latest')
 
 
+    def test_collect_garbage(self):
+        """Verify registry GC deletes only old, unreferenced manifests and data."""
+        old = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+        new = datetime.datetime.now(datetime.timezone.utc)
+
+        def list_objects_mock(bucket, prefix, recursive=True):
+            if prefix == '.quilt/named_packages/':
+                return [
+                    {'Key': '.quilt/named_packages/Quilt/Test/0'},
+                    {'Key': '.quilt/named_packages/Quilt/Test/latest'},
+                ]
+            assert prefix == '.quilt/packages/' and not recursive
+            return [], [
+                {'Key': '.quilt/packages/101', 'Size': 1000, 'LastModified': old},
+                {'Key': '.quilt/packages/102', 'Size': 1000, 'LastModified': old},
+                {'Key': '.quilt/packages/102.summary', 'Size': 100, 'LastModified': old},
+                {'Key': '.quilt/packages/103', 'Size': 1000, 'LastModified': new},
+            ]
+
+        def get_bytes_mock(url): return b'101', None
+
+        def iter_lines_mock(url):
+            assert url == 's3://test-bucket/.quilt/packages/101'
+            yield json.dumps({'version': 'v0'}).encode()
+            yield json.dumps({
+                'logical_key': 'foo',
+                'physical_keys': ['s3://test-bucket/Quilt/Test/foo?versionId=1'],
+            }).encode()
+
+        def _list_objects_mock(Bucket, Prefix):
+            assert (Bucket, Prefix) == ('test-bucket', 'Quilt/Test/')
+            yield {'Contents': [
+                {'Key': 'Quilt/Test/foo', 'LastModified': old},
+                {'Key': 'Quilt/Test/bar', 'LastModified': old},
+                {'Key': 'Quilt/Test/baz', 'LastModified': new},
+            ]}
+
+        with patch('t4.api.list_objects', new=list_objects_mock), \
+                patch('t4.api.get_bytes', new=get_bytes_mock), \
+                patch('t4.api.iter_lines', new=iter_lines_mock), \
+                patch('t4.api._list_objects', new=_list_objects_mock), \
+                patch('t4.api.delete_objects') as delete_mock:
+            result = t4.api.collect_garbage('s3://test-bucket')
+            assert result == (['102'], ['s3://test-bucket/Quilt/Test/bar'])
+            delete_mock.assert_not_called()
+
+            result = t4.api.collect_garbage('s3://test-bucket', dry_run=False)
+            assert result == (['102'], ['s3://test-bucket/Quilt/Test/bar'])
+            delete_mock.assert_called_once_with(
+                'test-bucket', ['.quilt/packages/102', '.quilt/packages/102.summary', 'Quilt/Test/bar'])
+
+            # Rate limiting splits the deletes into smaller batches.
+            delete_mock.reset_mock()
+            with patch('t4.api.time.sleep') as sleep_mock:
+                t4.api.collect_garbage('s3://test-bucket', dry_run=False, max_deletes_per_second=2)
+            assert delete_mock.call_args_list == [
+                call('test-bucket', ['.quilt/packages/102', '.quilt/packages/102.summary']),
+                call('test-bucket', ['Quilt/Test/bar']),
+            ]
+            assert sleep_mock.call_count == 2
+
+        # Sweeping versions keeps the referenced version, and deletes the others for good.
+        def _list_object_versions_mock(Bucket, Prefix, **kwargs):
+            if Prefix == '.quilt/packages/':
+                assert kwargs == {'Delimiter': '/'}
+                yield {'Versions': [
+                    {'Key': '.quilt/packages/101', 'VersionId': 'a'},
+                    {'Key': '.quilt/packages/102', 'VersionId': 'b'},
+                    {'Key': '.quilt/packages/102', 'VersionId': 'c'},
+                    {'Key': '.quilt/packages/102.summary', 'VersionId': 'd'},
+                ]}
+                return
+            assert (Bucket, Prefix) == ('test-bucket', 'Quilt/Test/')
+            yield {'Versions': [
+                {'Key': 'Quilt/Test/foo', 'VersionId': '2', 'IsLatest': True, 'LastModified': old},
+                {'Key': 'Quilt/Test/foo', 'VersionId': '1', 'IsLatest': False, 'LastModified': old},
+                {'Key': 'Quilt/Test/bar', 'VersionId': '3', 'IsLatest': True, 'LastModified': old},
+                {'Key': 'Quilt/Test/baz', 'VersionId': '4', 'IsLatest': True, 'LastModified': new},
+            ]}
+
+        with patch('t4.api.list_objects', new=list_objects_mock), \
+                patch('t4.api.get_bytes', new=get_bytes_mock), \
+                patch('t4.api.iter_lines', new=iter_lines_mock), \
+                patch('t4.api._list_object_versions', new=_list_object_versions_mock), \
+                patch('t4.api.delete_objects') as delete_mock:
+            result = t4.api.collect_garbage('s3://test-bucket', dry_run=False, versions=True)
+            assert result == (['102'], [
+                's3://test-bucket/Quilt/Test/foo?versionId=2', 's3://test-bucket/Quilt/Test/bar?versionId=3'
+            ])
+            delete_mock.assert_called_once_with('test-bucket', [
+                ('.quilt/packages/102', 'b'), ('.quilt/packages/102', 'c'), ('.quilt/packages/102.summary', 'd'),
+                ('Quilt/Test/foo', '2'), ('Quilt/Test/bar', '3'),
+            ])
+
+    def test_bloom_filter(self):
+        bloom = t4.api._BloomFilter(1000)
+        bloom.update(str(i) for i in range(1000))
+        assert all(str(i) in bloom for i in range(1000))
+        assert sum(str(i) in bloom for i in range(1000, 11000)) < 100
+
     def test_commit_message_on_push(self):
         """ Verify commit messages populate correctly on push."""
         with patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
@@ -1002,18 +1436,26 @@ class PackageTest(QuiltTestCase):
 
     def test_import(self):
         with patch('t4.Package.browse') as browse_mock, \
-            patch('t4.imports.list_packages') as list_packages_mock:
+            patch('t4.imports._list_package_names') as list_package_names_mock:
             browse_mock.return_value = t4.Package()
-            list_packages_mock.return_value = ['foo/bar', 'foo/baz']
+            list_package_names_mock.return_value = ['bar', 'baz']
 
             from t4.data.foo import bar
             assert isinstance(bar, Package)
-            browse_mock.assert_has_calls(
-                [call('foo/baz', registry=ANY), call('foo/bar', registry=ANY)], any_order=True
-            )
+            # only the imported package is browsed
+            browse_mock.assert_called_once_with('foo/bar', registry=ANY)
+            list_package_names_mock.assert_called_once_with(ANY, 'foo')
 
             from t4.data import foo
+            assert 'baz' in dir(foo) and 'qux' not in dir(foo)
             assert hasattr(foo, 'bar') and hasattr(foo, 'baz')
+            assert not hasattr(foo, 'qux')
+            assert browse_mock.call_count == 2
+
+            # browsed packages are cached
+            assert foo.baz is foo.baz
+            assert browse_mock.call_count == 2
+            assert list_package_names_mock.call_count == 1
 
 
     def test_invalid_key(self):
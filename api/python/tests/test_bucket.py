@@ -1,9 +1,11 @@
+import datetime
+import itertools
 import json
 from unittest.mock import patch
 import pathlib
 from urllib.parse import urlparse
 
-from botocore.stub import Stubber
+from botocore.stub import ANY, Stubber
 import pandas as pd
 import pytest
 import responses
@@ -163,6 +165,33 @@ class TestBucket(QuiltTestCase):
 
     # Further testing specific to select() is in test_data_transfer
 
+    def test_bucket_select_many(self):
+        def select_mock(url, query, meta):
+            assert meta == {'target': 'csv', 'format': {'opts': {'header': True}}}
+            return pd.DataFrame.from_records([{'n': url.rsplit('/', 1)[-1][0]}])
+
+        self.s3_stubber.add_response(
+            'list_objects_v2',
+            {'IsTruncated': False, 'Contents': [{'Key': 'p/1.csv'}, {'Key': 'p/2'}, {'Key': 'p/3.csv'}]},
+            {'Bucket': 'test-bucket', 'Prefix': 'p/'}
+        )
+        bucket = Bucket('s3://test-bucket')
+        with patch('t4.bucket.select', side_effect=select_mock), \
+                patch('t4.bucket.get_size_and_meta') as meta_mock:
+            meta_mock.return_value = (1, {'target': 'csv', 'format': {'opts': {'header': True}}}, None)
+            result = bucket.select_many('p/', 'select * from S3Object', threads=2)
+            # Objects are queried with their own metadata, as with select.
+            assert sorted(args[0] for args, _ in meta_mock.call_args_list) == \
+                ['s3://test-bucket/p/1.csv', 's3://test-bucket/p/2', 's3://test-bucket/p/3.csv']
+
+            expected = pd.DataFrame.from_records(
+                [('1', 'p/1.csv'), ('2', 'p/2'), ('3', 'p/3.csv')], columns=['n', 'key'])
+            assert result.equals(expected)
+
+            results = bucket.select_many(['a.csv', 'b.csv'], 'select * from S3Object', lazy=True)
+            assert [(key, df['n'][0]) for key, df in results] == [('a.csv', 'a'), ('b.csv', 'b')]
+
+
 
     def test_bucket_put_file(self):
         with patch("t4.bucket.copy_file") as copy_mock:
@@ -274,8 +303,200 @@ class TestBucket(QuiltTestCase):
         with pytest.raises(ValueError):
             bucket.delete_dir('s3://test-bucket/dir')
 
+    def test_bucket_set_meta_many(self):
+        def head(key, user_meta):
+            self.s3_stubber.add_response(
+                'head_object',
+                {'ContentLength': 10, 'Metadata': {
+                    'helium': json.dumps({'target': 'json', 'user_meta': user_meta})
+                }},
+                {'Bucket': 'test-bucket', 'Key': key}
+            )
+
+        def copy(key, user_meta):
+            return (
+                {},
+                {
+                    'CopySource': {'Bucket': 'test-bucket', 'Key': key},
+                    'Bucket': 'test-bucket',
+                    'Key': key,
+                    'MetadataDirective': 'REPLACE',
+                    'Metadata': {'helium': json.dumps({'target': 'json', 'user_meta': user_meta})},
+                }
+            )
+
+        self.s3_stubber.add_response(
+            'list_objects_v2',
+            {'IsTruncated': False, 'Contents': [{'Key': 'dir/a'}, {'Key': 'dir/b'}, {'Key': 'dir/c'}]},
+            {'Bucket': 'test-bucket', 'Prefix': 'dir/'}
+        )
+        head('dir/a', {'n': 1})
+        self.s3_stubber.add_client_error('head_object', http_status_code=404)
+        head('dir/c', {'n': 3})
+        self.s3_stubber.add_response('copy_object', *copy('dir/a', {'n': 2}))
+
+        def increment(key, user_meta):
+            return {'n': user_meta['n'] + 1} if key != 'dir/c' else None
+
+        bucket = Bucket('s3://test-bucket')
+        with patch('t4.data_transfer.s3_threads', 1):
+            with patch.object(bucket, '_changed') as changed_mock:
+                errors = bucket.set_meta_many('dir/', increment)
+            assert list(errors) == ['dir/b']
+            # Only the objects that were rewritten are marked as changed, all at once.
+            changed_mock.assert_called_once_with('dir/a', is_prefix=True)
+
+            with pytest.raises(QuiltException):
+                bucket.set_meta_many('dir/')
+
+            # Copy failures are reported too.
+            head('dir/a', {})
+            head('dir/c', {})
+            self.s3_stubber.add_response('copy_object', *copy('dir/a', {'a': 1}))
+            self.s3_stubber.add_client_error('copy_object', http_status_code=403)
+            errors = bucket.set_meta_many({'dir/a': {'a': 1}, 'dir/c': {'c': 1}})
+            assert list(errors) == ['dir/c']
+
+            # With an index, the updated keys are refreshed with one listing of their common prefix.
+            self.s3_stubber.add_response(
+                'list_objects_v2', {'IsTruncated': False, 'Contents': []}, {'Bucket': 'test-bucket', 'Prefix': ''}
+            )
+            bucket.build_index()
+            for key in ['dir/a', 'dir/c']:
+                head(key, {})
+            for key in ['dir/a', 'dir/c']:
+                self.s3_stubber.add_response('copy_object', *copy(key, {'k': key}))
+            self.s3_stubber.add_response(
+                'list_objects_v2',
+                {'IsTruncated': False, 'Contents': [
+                    {'Key': key, 'Size': 10, 'ETag': '"x"', 'LastModified': datetime.datetime(2019, 1, 1)}
+                    for key in ['dir/a', 'dir/c']
+                ]},
+                {'Bucket': 'test-bucket', 'Prefix': 'dir/'}
+            )
+            errors = bucket.set_meta_many({key: {'k': key} for key in ['dir/a', 'dir/c']})
+            assert not errors
+            self.s3_stubber.assert_no_pending_responses()
+            assert bucket.keys() == ['dir/a', 'dir/c']
+
+    def test_bucket_sync(self):
+        src_dir = pathlib.Path('sync_src')
+        src_dir.mkdir()
+        (src_dir / 'a').write_text('same')
+        (src_dir / 'b').write_text('changed')
+        (src_dir / 'sub').mkdir()
+        (src_dir / 'sub' / 'c').write_text('new')
+        same_etag = data_transfer._calculate_etag(src_dir / 'a')
+
+        last_modified = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+        listing = {
+            'IsTruncated': False,
+            'Contents': [
+                {'Key': 'dir/a', 'Size': 4, 'ETag': same_etag, 'LastModified': last_modified},
+                {'Key': 'dir/b', 'Size': 3, 'ETag': '"x"', 'LastModified': last_modified},
+                {'Key': 'dir/d', 'Size': 3, 'ETag': '"x"', 'LastModified': last_modified},
+            ]
+        }
+        bucket = Bucket('s3://test-bucket')
+
+        self.s3_stubber.add_response('list_objects_v2', listing, {'Bucket': 'test-bucket', 'Prefix': 'dir/'})
+        result = bucket.sync('sync_src', 's3://test-bucket/dir/', delete=True, dry_run=True)
+        assert result == dict(copied=['b', 'sub/c'], skipped=['a'], deleted=['d'])
+
+        self.s3_stubber.add_response('list_objects_v2', listing, {'Bucket': 'test-bucket', 'Prefix': 'dir/'})
+        for key in ['dir/b', 'dir/sub/c']:
+            self.s3_stubber.add_response(
+                'put_object', {}, {'Body': ANY, 'Bucket': 'test-bucket', 'Key': key, 'Metadata': ANY})
+        self.s3_stubber.add_response(
+            'delete_objects', {},
+            {'Bucket': 'test-bucket', 'Delete': {'Objects': [{'Key': 'dir/d'}], 'Quiet': True}}
+        )
+        # Local ETags are cached.
+        with patch('t4.data_transfer.s3_threads', 1), \
+                patch('t4.data_transfer._calculate_etag') as etag_mock:
+            result = bucket.sync('sync_src', 's3://test-bucket/dir/', delete=True)
+            etag_mock.assert_not_called()
+        assert result == dict(copied=['b', 'sub/c'], skipped=['a'], deleted=['d'])
+
+        # Downloads, comparing modification times: the local files are newer.
+        self.s3_stubber.add_response('list_objects_v2', listing, {'Bucket': 'test-bucket', 'Prefix': 'dir/'})
+        result = bucket.sync('s3://test-bucket/dir', 'sync_src', compare='mtime', dry_run=True)
+        assert result == dict(copied=['b', 'd'], skipped=['a'], deleted=[])
+
+        with pytest.raises(QuiltException):
+            bucket.sync('sync_src', 'other_dir')
+        with pytest.raises(QuiltException):
+            bucket.sync('sync_src', 's3://other-bucket/dir/')
+
+    def test_bucket_ls(self):
+        old = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+        new = datetime.datetime(2019, 1, 2, tzinfo=datetime.timezone.utc)
+        self.s3_stubber.add_response(
+            method='list_object_versions',
+            service_response={
+                'IsTruncated': False,
+                'CommonPrefixes': [{'Prefix': 'dir/b/'}],
+                'Versions': [
+                    {'Key': 'dir/a', 'VersionId': '1', 'LastModified': old},
+                    {'Key': 'dir/c', 'VersionId': '3', 'LastModified': old},
+                ],
+                'DeleteMarkers': [{'Key': 'dir/a', 'VersionId': '2', 'LastModified': new}],
+            },
+            expected_params={'Bucket': 'test-bucket', 'Prefix': 'dir/', 'Delimiter': '/'}
+        )
+
+        bucket = Bucket('s3://test-bucket')
+        prefixes, versions, delete_markers = bucket.ls('dir')
+        assert prefixes == [{'Prefix': 'dir/b/'}]
+        assert [v['VersionId'] for v in versions] == ['1', '3']
+        assert [m['VersionId'] for m in delete_markers] == ['2']
+
+        # Latest versions only, a page at a time.
+        self.s3_stubber.add_response(
+            method='list_objects_v2',
+            service_response={
+                'IsTruncated': True,
+                'NextContinuationToken': 'token',
+                'CommonPrefixes': [{'Prefix': 'dir/b/'}],
+                'Contents': [{'Key': 'dir/a'}],
+            },
+            expected_params={'Bucket': 'test-bucket', 'Prefix': 'dir/', 'Delimiter': '/'}
+        )
+        records = bucket.iter_ls('dir/', latest_only=True)
+        assert [r.get('Key', r.get('Prefix')) for r in itertools.islice(records, 2)] == ['dir/a', 'dir/b/']
+        self.s3_stubber.add_response(
+            method='list_objects_v2',
+            service_response={'IsTruncated': False, 'Contents': [{'Key': 'dir/c'}]},
+            expected_params={
+                'Bucket': 'test-bucket', 'Prefix': 'dir/', 'Delimiter': '/', 'ContinuationToken': 'token'
+            }
+        )
+        assert next(records) == {'Key': 'dir/c'}
+
+        # Pagination with limit and start_after, and the listing cache.
+        self.s3_stubber.add_response(
+            method='list_objects_v2',
+            service_response={
+                'IsTruncated': False,
+                'CommonPrefixes': [{'Prefix': 'dir/b/'}],
+                'Contents': [{'Key': 'dir/c'}, {'Key': 'dir/d'}],
+            },
+            expected_params={
+                'Bucket': 'test-bucket', 'Prefix': 'dir/', 'Delimiter': '/', 'StartAfter': 'dir/b/'
+            }
+        )
+        for _ in range(2):
+            prefixes, objects = bucket.ls('dir/', latest_only=True, limit=1, start_after='dir/b/',
+                                          cache_ttl=60)
+            assert prefixes == [] and objects == [{'Key': 'dir/c'}]
+        self.s3_stubber.assert_no_pending_responses()
+
+        with patch('t4.bucket.put_bytes'):
+            bucket.put('dir/e.txt', 'e')
+        assert not bucket._ls_cache
+
     @patch('t4.bucket.find_bucket_config')
-    @patch('t4.bucket.get_from_config')
+    @patch('t4.util.get_from_config')
     def test_bucket_config(self, config_mock, bucket_config_mock):
         bucket_config_mock.return_value = {
             'name': 'test-bucket',
@@ -300,7 +521,7 @@ class TestBucket(QuiltTestCase):
 
     # further testing in test_search.py
     @patch('t4.bucket.search')
-    @patch('t4.bucket.get_from_config')
+    @patch('t4.util.get_from_config')
     def test_search_bucket(self, config_mock, search_mock):
         config_mock.return_value = 'https://foo.bar'
         content = {
@@ -321,7 +542,8 @@ class TestBucket(QuiltTestCase):
         b.search('blah', limit=1)
 
         config_mock.assert_called_once_with('navigator_url')
-        search_mock.assert_called_once_with('blah', 'https://es-fake.endpoint', limit=1, aws_region='us-meow')
+        search_mock.assert_called_once_with('blah', 'https://es-fake.endpoint', limit=1, aws_region='us-meow',
+                                            source_includes=None, source_excludes=None)
 
     @patch('t4.bucket.put_bytes')
     def test_bucket_put_ext(self, put_bytes):
@@ -0,0 +1,148 @@
+""" Testing for bucket_index.py """
+import datetime
+import gzip
+import io
+import json
+import os
+import pathlib
+from unittest.mock import patch
+
+import pandas as pd
+import pytest
+
+from t4 import Bucket
+from t4.bucket_index import BucketIndex
+from t4.util import QuiltException
+
+from .utils import QuiltTestCase
+
+
+LAST_MODIFIED = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def listing(*keys, **kwargs):
+    return dict(
+        IsTruncated=False,
+        Contents=[dict(Key=key, Size=len(key), ETag='"%s"' % key, LastModified=LAST_MODIFIED)
+                  for key in keys],
+        **kwargs
+    )
+
+
+class TestBucketIndex(QuiltTestCase):
+    def test_index_listing(self):
+        self.s3_stubber.add_response(
+            'list_objects_v2',
+            listing('a', 'dir/b', 'dir/c/d', 'dir/c/e', 'dir/f', 'g/h'),
+            {'Bucket': 'test-bucket', 'Prefix': ''}
+        )
+        bucket = Bucket('s3://test-bucket')
+        bucket.build_index()
+        self.s3_stubber.assert_no_pending_responses()
+
+        # Answered from the index, without requests.
+        assert bucket.keys() == ['a', 'dir/b', 'dir/c/d', 'dir/c/e', 'dir/f', 'g/h']
+        assert bucket.exists('dir/b') and bucket.exists('dir/c/')
+        assert not bucket.exists('dir/c') and not bucket.exists('dir/x/')
+
+        prefixes, objects = bucket.ls('dir', latest_only=True)
+        assert prefixes == [{'Prefix': 'dir/c/'}]
+        assert [obj['Key'] for obj in objects] == ['dir/b', 'dir/f']
+        assert objects[0] == dict(Key='dir/b', Size=5, ETag='"dir/b"', LastModified=LAST_MODIFIED)
+
+        records = bucket.iter_ls('dir/', latest_only=True, start_after='dir/c/')
+        assert [record['Key'] for record in records] == ['dir/f']
+        records = bucket.iter_ls('', latest_only=True, start_after='dir/c/d')
+        assert [record.get('Key', record.get('Prefix')) for record in records] == ['dir/', 'g/']
+        # A start_after before the prefix doesn't let in keys outside it.
+        records = bucket.iter_ls('dir/c/', latest_only=True, start_after='a')
+        assert [record['Key'] for record in records] == ['dir/c/d', 'dir/c/e']
+        assert [obj['Key'] for obj in bucket.ls('dir/c', recursive=True, latest_only=True)] == \
+            ['dir/c/d', 'dir/c/e']
+
+        # Refreshing a prefix adds and removes keys under it only.
+        self.s3_stubber.add_response(
+            'list_objects_v2', listing('dir/c/e', 'dir/c/x'), {'Bucket': 'test-bucket', 'Prefix': 'dir/c/'}
+        )
+        bucket.refresh_index('dir/c/')
+        assert bucket.keys() == ['a', 'dir/b', 'dir/c/e', 'dir/c/x', 'dir/f', 'g/h']
+
+        # Writes through the bucket update the index; deleted keys are removed without listing them.
+        self.s3_stubber.add_response('head_object', {}, {'Bucket': 'test-bucket', 'Key': 'dir/b'})
+        self.s3_stubber.add_response('delete_object', {}, {'Bucket': 'test-bucket', 'Key': 'dir/b'})
+        bucket.delete('dir/b')
+        assert not bucket.exists('dir/b')
+
+        self.s3_stubber.add_response(
+            'list_objects_v2', listing('dir/c/e', 'dir/c/x'), {'Bucket': 'test-bucket', 'Prefix': 'dir/c/'}
+        )
+        for key in ['dir/c/e', 'dir/c/x']:
+            self.s3_stubber.add_response('head_object', {}, {'Bucket': 'test-bucket', 'Key': key})
+            self.s3_stubber.add_response('delete_object', {}, {'Bucket': 'test-bucket', 'Key': key})
+        bucket.delete_dir('dir/c/')
+        self.s3_stubber.assert_no_pending_responses()
+        assert bucket.keys() == ['a', 'dir/f', 'g/h']
+
+        # Syncing nothing doesn't re-list the prefix (the stubber would fail on an unexpected request).
+        pathlib.Path('sync_src').mkdir()
+        (pathlib.Path('sync_src') / 'f').write_text('dir/f')
+        old = LAST_MODIFIED.timestamp() - 1
+        os.utime('sync_src/f', (old, old))
+        result = bucket.sync('sync_src', 's3://test-bucket/dir/', compare='mtime')
+        assert result == dict(copied=[], skipped=['f'], deleted=[])
+
+        # The index persists.
+        other_bucket = Bucket('s3://test-bucket')
+        other_bucket.load_index()
+        assert other_bucket.keys() == ['a', 'dir/f', 'g/h']
+
+        with pytest.raises(QuiltException):
+            Bucket('s3://other-bucket').load_index()
+
+    def test_index_inventory(self):
+        manifest = {
+            'destinationBucket': 'arn:aws:s3:::inventory-bucket',
+            'fileFormat': 'CSV',
+            'fileSchema': 'Bucket, Key, VersionId, IsLatest, IsDeleteMarker, Size, LastModifiedDate, ETag',
+            'files': [{'key': 'inventory/data/1.csv.gz'}],
+        }
+        rows = [
+            '"test-bucket","a%2Bb+c","1","true","false","3","2019-01-01T00:00:00.000Z","abc"',
+            '"test-bucket","old","1","false","false","3","2019-01-01T00:00:00.000Z","abc"',
+            '"test-bucket","deleted","2","true","true","","2019-01-01T00:00:00.000Z",""',
+        ]
+        files = {
+            's3://inventory-bucket/inventory/manifest.json': json.dumps(manifest).encode(),
+            's3://inventory-bucket/inventory/data/1.csv.gz': gzip.compress('\n'.join(rows).encode()),
+        }
+
+        def get_bytes_mock(url): return files[url], {}
+
+        with patch('t4.bucket_index.get_bytes', new=get_bytes_mock):
+            bucket = Bucket('s3://test-bucket')
+            bucket.build_index(inventory='s3://inventory-bucket/inventory/manifest.json')
+        assert bucket.keys() == ['a+b c']
+        assert bucket.ls(recursive=True, latest_only=True) == [
+            dict(Key='a+b c', Size=3, ETag='"abc"', LastModified=LAST_MODIFIED)
+        ]
+
+        # Parquet reports have unencoded keys and typed columns.
+        manifest.update(fileFormat='Parquet', files=[{'key': 'inventory/data/1.parquet'}])
+        parquet_file = io.BytesIO()
+        pd.DataFrame({
+            'bucket': ['test-bucket'],
+            'key': ['a+b'],
+            'size': [3],
+            'last_modified_date': [pd.Timestamp('2019-01-01')],
+            'e_tag': ['abc'],
+        }).to_parquet(parquet_file)
+        files.update({
+            's3://inventory-bucket/inventory/manifest.json': json.dumps(manifest).encode(),
+            's3://inventory-bucket/inventory/data/1.parquet': parquet_file.getvalue(),
+        })
+        with patch('t4.bucket_index.get_bytes', new=get_bytes_mock):
+            bucket.build_index(inventory='s3://inventory-bucket/inventory/manifest.json')
+        assert bucket.keys() == ['a+b']
+
+    def test_index_path(self):
+        assert BucketIndex.default_path('test-bucket').name == 'test-bucket.sqlite'
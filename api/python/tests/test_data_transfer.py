@@ -1,6 +1,9 @@
 """ Testing for data_transfer.py """
 
 ### Python imports
+import io
+import itertools
+import os
 
 # Backports
 try: import pathlib2 as pathlib
@@ -10,12 +13,13 @@ try: import unittest.mock as mock
 except ImportError: import mock
 
 ### Third-party imports
+from botocore.exceptions import ClientError
 from botocore.stub import ANY
 import pandas as pd
 import pytest
 
 ### Project imports
-from t4 import data_transfer
+from t4 import data_transfer, util
 
 from .utils import QuiltTestCase
 
@@ -166,6 +170,61 @@ class DataTransferTest(QuiltTestCase):
         # Verify the verion is present
         assert data_transfer.get_size_and_meta('s3://my_bucket/my_obj')[2] == '1.0'
 
+    def test_get_byte_range(self):
+        response = {
+            'Body': io.BytesIO(b'cde'),
+        }
+        expected_params = {
+            'Bucket': 'my_bucket',
+            'Key': 'my_obj',
+            'VersionId': 'v1',
+            'Range': 'bytes=2-4',
+        }
+        self.s3_stubber.add_response('get_object', response, expected_params)
+        assert data_transfer.get_byte_range('s3://my_bucket/my_obj?versionId=v1', 2, 5) == b'cde'
+
+        assert data_transfer.get_byte_range('s3://my_bucket/my_obj', 5, 5) == b''
+
+        path = DATA_DIR / 'dir' / 'foo.txt'
+        assert data_transfer.get_byte_range(path.as_uri(), 1, 3) == path.read_bytes()[1:3]
+
+    def test_iter_lines(self):
+        self.s3_stubber.add_response(
+            'get_object',
+            {'Body': io.BytesIO(b'{"a": 1}\n{"b": 2}\n\n{"c": 3}')},
+            {'Bucket': 'my_bucket', 'Key': 'my_obj'}
+        )
+        lines = data_transfer.iter_lines('s3://my_bucket/my_obj', chunk_size=3)
+        assert list(lines) == [b'{"a": 1}', b'{"b": 2}', b'', b'{"c": 3}']
+
+        path = DATA_DIR / 'dir' / 'foo.txt'
+        assert list(data_transfer.iter_lines(path.as_uri())) == path.read_bytes().splitlines()
+
+    def test_get_bytes_if_changed(self):
+        expected_params = {
+            'Bucket': 'my_bucket',
+            'Key': 'my_obj',
+        }
+        self.s3_stubber.add_response(
+            'get_object', {'Body': io.BytesIO(b'abc'), 'ETag': '"etag1"'}, expected_params)
+        assert data_transfer.get_bytes_if_changed('s3://my_bucket/my_obj') == (b'abc', '"etag1"')
+
+        self.s3_stubber.add_client_error(
+            'get_object',
+            http_status_code=304,
+            expected_params=dict(expected_params, IfNoneMatch='"etag1"')
+        )
+        assert data_transfer.get_bytes_if_changed('s3://my_bucket/my_obj', '"etag1"') == (None, '"etag1"')
+
+        self.s3_stubber.add_client_error(
+            'get_object',
+            service_error_code='NoSuchKey',
+            http_status_code=404,
+            expected_params=dict(expected_params, IfNoneMatch='"etag1"')
+        )
+        with pytest.raises(ClientError):
+            data_transfer.get_bytes_if_changed('s3://my_bucket/my_obj', '"etag1"')
+
     def test_list_local_url(self):
         dir_path = DATA_DIR / 'dir'
         contents = set(list(data_transfer.list_url(dir_path.as_uri())))
@@ -174,6 +233,34 @@ class DataTransferTest(QuiltTestCase):
             ('x/blah.txt', 6)
         ])
 
+    def test_walk_local_dir(self):
+        root = pathlib.Path('walk_test')
+        for rel_path in ['a.txt', 'b/c.txt', 'b/d/e.txt', 'f/g/h/i.txt']:
+            path = root / rel_path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(rel_path)
+        (root / 'empty').mkdir()
+        (root / 'link.txt').symlink_to((root / 'a.txt').resolve())
+        (root / 'link_dir').symlink_to((root / 'b').resolve())
+
+        results = list(data_transfer.walk_local_dir(root, threads=2))
+        assert sorted(rel_path for rel_path, _, _ in results) == \
+            ['a.txt', 'b/c.txt', 'b/d/e.txt', 'f/g/h/i.txt', 'link.txt']
+        for rel_path, size, mtime in results:
+            stat = (root / rel_path).stat()
+            assert size == stat.st_size
+            assert mtime == stat.st_mtime
+
+        ignore = util.QuiltIgnore(['b/', '*.txt', '!i.txt'])
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir_mock:
+            results = list(data_transfer.walk_local_dir(root, ignore=ignore))
+        assert [rel_path for rel_path, _, _ in results] == ['f/g/h/i.txt']
+        # Ignored directories aren't scanned.
+        assert not any(call[0][0].endswith('b') for call in scandir_mock.call_args_list)
+
+        # Stopping early is fine.
+        assert len(list(itertools.islice(data_transfer.walk_local_dir(root), 2))) == 2
+
     def test_etag(self):
         assert data_transfer._calculate_etag(DATA_DIR / 'small_file.csv') == '"0bec5bf6f93c547bc9c6774acaf85e1a"'
         assert data_transfer._calculate_etag(DATA_DIR / 'buggy_parquet.parquet') == '"dfb5aca048931d396f4534395617363f"'
@@ -507,3 +594,27 @@ class DataTransferTest(QuiltTestCase):
             data_transfer.copy_file_list([
                 ('s3://example1/large_file1.npy', 's3://example2/large_file2.npy', file_size, None),
             ])
+
+    def test_byte_range_reader(self):
+        import pyarrow as pa
+        from pyarrow import parquet
+
+        path = pathlib.Path('test.parquet')
+        # Big enough that the footer isn't read along with everything else.
+        table = pa.Table.from_arrays(
+            [pa.array(range(10000)), pa.array([os.urandom(50).hex() for _ in range(10000)])],
+            names=['a', 'b'])
+        parquet.write_table(table, str(path))
+
+        ranges = []
+        def get_byte_range(src, start, end):
+            ranges.append(end - start)
+            return data_transfer_get_byte_range(src, start, end)
+
+        data_transfer_get_byte_range = data_transfer.get_byte_range
+        with mock.patch('t4.data_transfer.get_byte_range', side_effect=get_byte_range):
+            reader = data_transfer.ByteRangeReader(path.resolve().as_uri())
+            assert parquet.read_table(reader, columns=['a']).column(0).to_pylist() == list(range(10000))
+
+        # Only the footer and the projected column were read.
+        assert sum(ranges) < path.stat().st_size / 2
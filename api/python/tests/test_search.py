@@ -1,8 +1,12 @@
 import json
 from unittest.mock import patch, MagicMock
 
+import pytest
+
+import t4
 from t4 import Bucket
 
+from t4 import search_util, util
 from t4.search_util import get_search_schema
 
 @patch('t4.search_util.get_raw_mapping_unpacked')
@@ -67,9 +71,11 @@ def get_configured_bucket():
             mock_response = ResponseMock()
             setattr(mock_response, 'text', text)
             setattr(mock_response, 'ok', True)
+            setattr(mock_response, 'status_code', 200)
+            setattr(mock_response, 'headers', {})
             return mock_response
 
-        def mock_get(url):
+        def mock_get(url, headers=None):
             if url == CONFIG_URL:
                 return makeResponse(json.dumps(mock_config))
             elif url == FEDERATION_URL:
@@ -120,3 +126,115 @@ def test_bucket_search():
         results = bucket.search(query)
         assert es_mock.search.called_with('*', 'test')
         assert len(results) == 1
+
+def test_es_client_cache():
+    with patch('t4.search_util.Elasticsearch') as es_mock, \
+            patch('t4.search_util.BotoAWSRequestsAuth'), \
+            patch('t4.search_util.get_credentials') as credentials_mock:
+        credentials_mock.return_value = None
+        client = search_util._create_es('https://cache.endpoint', 'us-east-1')
+        assert search_util._create_es('https://cache.endpoint', 'us-east-1') is client
+        assert es_mock.call_count == 1
+
+        # New credentials (e.g. after logging in) need a new client.
+        credentials_mock.return_value = MagicMock()
+        search_util._create_es('https://cache.endpoint', 'us-east-1')
+        assert es_mock.call_count == 2
+        assert isinstance(es_mock.call_args[1]['http_auth'], search_util._CredentialsAuth)
+
+def test_search_payload_and_scroll():
+    def hits(*keys):
+        return {'_scroll_id': 'scroll', 'hits': {'hits': [{'_source': {'key': key}} for key in keys]}}
+
+    es_mock = MagicMock()
+    es_mock.search.return_value = hits('a')
+    with patch('t4.search_util._create_es', return_value=es_mock):
+        results = search_util.search('foo', 'https://test.endpoint', limit=5, source_excludes=['text'])
+        assert results[0]['key'] == 'a' and results[0]['text'] is None
+        body = es_mock.search.call_args[1]['body']
+        assert body['sort'] == [{'updated': {'order': 'desc'}}]
+        assert body['_source'] == {'excludes': ['text']}
+        assert body['size'] == 5
+
+        es_mock.search.return_value = hits('a', 'b')
+        es_mock.scroll.side_effect = [hits('c'), hits()]
+        results = search_util.iter_search({'query': {'match_all': {}}}, 'https://test.endpoint',
+                                          page_size=2, source_includes=['size'])
+        assert [result['key'] for result in results] == ['a', 'b', 'c']
+        body = es_mock.search.call_args[1]['body']
+        assert body['_source'] == {'includes': ['size', 'key']}
+        assert es_mock.search.call_args[1]['scroll'] == search_util.SCROLL_TIMEOUT
+        es_mock.clear_scroll.assert_called_once_with(scroll_id='scroll')
+
+        # Searches beyond the result window scroll.
+        es_mock.scroll.side_effect = [hits('c'), hits()]
+        assert len(search_util.search('foo', 'https://test.endpoint', limit=20000)) == 3
+
+def test_config_cache():
+    util._config_cache.clear()
+    requests_mock = MagicMock()
+
+    def makeResponse(config, status_code=200, etag=None):
+        return MagicMock(ok=status_code < 400, status_code=status_code, text=json.dumps(config),
+                         headers={'ETag': etag} if etag else {})
+
+    responses = {
+        'https://test.com/config.json': makeResponse(
+            {'federations': ['/first.json', 'https://other.com/second.json']}, etag='"1"'
+        ),
+        'https://test.com/first.json': makeResponse(
+            {'buckets': [{'name': 'a', 'searchEndpoint': 'first-a'}, 'https://test.com/b.json']}
+        ),
+        'https://other.com/second.json': makeResponse({'buckets': [{'name': 'a', 'searchEndpoint': 'second-a'}]}),
+        'https://test.com/b.json': makeResponse({'name': 'b', 'searchEndpoint': 'b'}),
+    }
+    requests_mock.get.side_effect = lambda url, headers: responses[url]
+    with patch('t4.util.requests', requests_mock), patch('t4.util.time') as time_mock:
+        time_mock.time.return_value = 1000
+        configs = util.get_bucket_configs('https://test.com/config.json')
+        # The last federation wins.
+        assert configs == {'a': {'name': 'a', 'searchEndpoint': 'second-a'},
+                           'b': {'name': 'b', 'searchEndpoint': 'b'}}
+        assert requests_mock.get.call_count == 4
+
+        # Within the TTL, nothing is fetched.
+        assert util.find_bucket_config('b', 'https://test.com/config.json')['searchEndpoint'] == 'b'
+        assert requests_mock.get.call_count == 4
+
+        # After it, configs are revalidated with their ETags.
+        time_mock.time.return_value = 1000 + util.CONFIG_CACHE_TTL
+        responses['https://test.com/config.json'] = makeResponse(None, status_code=304)
+        assert util.get_bucket_configs('https://test.com/config.json') == configs
+        requests_mock.get.assert_any_call('https://test.com/config.json', headers={'If-None-Match': '"1"'})
+    util._config_cache.clear()
+
+def test_federated_search():
+    configs = {
+        'a': {'name': 'a', 'searchEndpoint': 'https://a.endpoint'},
+        'b': {'name': 'b', 'searchEndpoint': 'https://b.endpoint', 'region': 'us-west-2'},
+        'c': {'name': 'c'},
+    }
+    results = {
+        'https://a.endpoint': [{'key': 'a1', 'time': '3', 'score': 1.0}, {'key': 'a2', 'time': '1', 'score': 3.0}],
+        'https://b.endpoint': [{'key': 'b1', 'time': '2', 'score': 2.0}],
+    }
+
+    def search_mock(query, search_endpoint, limit, aws_region, sort, **kwargs):
+        return sorted((dict(result) for result in results[search_endpoint]),
+                      key=lambda result: result['score' if sort is search_util.SCORE_SORT else 'time'],
+                      reverse=True)
+
+    with patch('t4.api.get_bucket_configs', return_value=configs) as get_configs_mock, \
+            patch('t4.search_util.search', side_effect=search_mock) as search_mock:
+        found = t4.search('foo', ['a', 's3://b'], config_url='https://test.com/config.json')
+        get_configs_mock.assert_called_once_with('https://test.com/config.json')
+        assert [(result['bucket'], result['key']) for result in found] == [('a', 'a1'), ('b', 'b1'), ('a', 'a2')]
+        assert search_mock.call_args_list[1][1]['aws_region'] == 'us-west-2'
+
+        found = t4.search('foo', ['a', 'b'], limit=2, order_by='score', config_url='https://test.com/config.json')
+        assert [result['key'] for result in found] == ['a2', 'b1']
+
+        with pytest.raises(util.QuiltException):
+            t4.search('foo', ['c'], config_url='https://test.com/config.json')
+        with pytest.raises(util.QuiltException):
+            t4.search('foo', ['d'], config_url='https://test.com/config.json')
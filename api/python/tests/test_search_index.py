@@ -0,0 +1,153 @@
+""" Testing for search_index.py """
+import datetime
+import pathlib
+import sqlite3
+from unittest.mock import patch
+
+import pytest
+
+from t4 import Package
+from t4.search_index import SearchIndex, _match_expression
+from t4.util import QuiltException
+
+from .utils import QuiltTestCase
+
+
+LAST_MODIFIED = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class TestSearchIndex(QuiltTestCase):
+    def test_query_translation(self):
+        assert _match_expression('*') is None
+        assert _match_expression('foo') == '{key user_meta text} : "foo"'
+        assert _match_expression('key:foo bar') == '( key : "foo" OR {key user_meta text} : "bar" )'
+        assert _match_expression('key:a AND -key:b') == 'key : "a" NOT key : "b"'
+        # Optional clauses don't matter once there's a required one.
+        assert _match_expression('key:"a b.csv" +key:ba*') == 'key : "ba" *'
+        assert _match_expression('key:a OR key:b AND key:c') == '( key : "b" AND key : "c" )'
+        assert _match_expression('user_meta.a.b:"c d"') == 'user_meta : "p612e62 c p612e62 d"'
+        assert _match_expression('user_meta.a:*') == 'user_meta : "p61"'
+        assert _match_expression('(key:a || key:b) NOT key:c') == '( key : "a" OR key : "b" ) NOT key : "c"'
+        assert _match_expression('key:a key:b -key:c -key:d') == \
+            '( key : "a" OR key : "b" ) NOT ( key : "c" OR key : "d" )'
+        assert _match_expression('+key:a -(key:b key:c -key:d)') == \
+            'key : "a" NOT ( ( key : "b" OR key : "c" ) NOT key : "d" )'
+        # Excluding terms on their own matches everything else.
+        assert _match_expression('-key:a') == 'NOT key : "a"'
+        assert _match_expression('NOT key:a') == 'NOT key : "a"'
+        assert _match_expression('* -key:a') == 'NOT key : "a"'
+        for query in ['size:1', 'a*b', 'AND a', 'a OR', 'a NOT', '(a', 'a)', '-*', '(-a) b']:
+            with pytest.raises(QuiltException):
+                _match_expression(query)
+
+    def test_query_semantics(self):
+        registry = pathlib.Path('test_registry').resolve().as_uri()
+        pathlib.Path('data.csv').write_text('a,b')
+        pkg = Package()
+        for key in ['red.csv', 'green.csv', 'red-blue.csv', 'green-blue.csv']:
+            pkg.set(key, 'data.csv')
+        pkg.build('Quilt/Colors', registry=registry, message='palette')
+        index = SearchIndex('index.sqlite')
+        index.add_registry(registry)
+
+        def search(query):
+            return sorted(r['key'] for r in index.search(query, limit=100))
+
+        # Exclusions apply to all the optional terms, not just the one before them.
+        assert search('red OR green -blue') == ['green.csv', 'red.csv']
+        assert search('red green NOT blue') == ['green.csv', 'red.csv']
+        assert search('+red green') == ['red-blue.csv', 'red.csv']
+        assert search('red AND blue') == ['red-blue.csv']
+        assert search('-blue') == ['Quilt/Colors', 'green.csv', 'red.csv']
+        assert search('NOT (red OR blue)') == ['Quilt/Colors', 'green.csv']
+        assert search('+palette -red') == ['Quilt/Colors']
+        assert search('(red -blue) OR (green -blue)') == ['green.csv', 'red.csv']
+
+    def test_index_registry(self):
+        registry = pathlib.Path('test_registry').resolve().as_uri()
+        pathlib.Path('data.csv').write_text('a,b')
+        (Package()
+         .set('data/results.csv', 'data.csv', meta={'experiment': {'id': 'x-12'}})
+         .set('README.md', 'data.csv')
+         .set_meta({'owner': 'alice'})
+         .build('Quilt/Results', registry=registry, message='Final results'))
+        Package().set('notes.txt', 'data.csv').build('Quilt/Notes', registry=registry, message='draft')
+
+        index = SearchIndex('index.sqlite')
+        index.add_registry(registry)
+
+        results = index.search('results')
+        assert [(r['key'], r['source']['package']) for r in results] == [
+            ('Quilt/Results', 'Quilt/Results'), ('data/results.csv', 'Quilt/Results')
+        ]
+        assert results[0]['text'] == 'Final results'
+        assert results[0]['time'] is not None
+
+        assert [r['key'] for r in index.search('user_meta.experiment.id:"x-12"')] == ['data/results.csv']
+        assert [r['key'] for r in index.search('user_meta.owner:alice')] == ['Quilt/Results']
+        # Fields match whole paths, not their ends.
+        assert not index.search('user_meta.id:"x-12"')
+        assert [r['key'] for r in index.search('package:notes')] == ['Quilt/Notes', 'notes.txt']
+        assert [r['key'] for r in index.search({'query': {'term': {'key': 'README.md'}}})] == ['README.md']
+        assert len(index.search('*', limit=100)) == 5
+        scored = index.search('results OR draft', order_by='score')
+        assert all(r['score'] is not None for r in scored)
+
+        # Packages with new latest versions are indexed again.
+        Package().set('final.txt', 'data.csv').build('Quilt/Notes', registry=registry, message='done')
+        index.add_registry(registry)
+        assert [r['key'] for r in index.search('package:notes')] == ['Quilt/Notes', 'final.txt']
+        assert not index.search('draft')
+
+    def test_index_bucket(self):
+        listing = dict(
+            IsTruncated=False,
+            Contents=[dict(Key=key, Size=1, ETag='"%s"' % key, LastModified=LAST_MODIFIED)
+                      for key in ('a.csv', 'b/c.csv')],
+        )
+        self.s3_stubber.add_response(
+            'list_objects_v2', listing, {'Bucket': 'test-bucket', 'Prefix': ''}
+        )
+        for key, meta in (('a.csv', '{"user_meta": {"kind": "raw", "tags": ["x", "y"]}}'), ('b/c.csv', '{}')):
+            self.s3_stubber.add_response(
+                'head_object', {'ContentLength': 1, 'Metadata': {'helium': meta}},
+                {'Bucket': 'test-bucket', 'Key': key}
+            )
+        index = SearchIndex('index.sqlite')
+        with patch('t4.data_transfer.s3_threads', 1):
+            index.add_bucket('test-bucket')
+        self.s3_stubber.assert_no_pending_responses()
+
+        assert [r['key'] for r in index.search('csv')] == ['a.csv', 'b/c.csv']
+        assert [r['key'] for r in index.search('user_meta.kind:raw')] == ['a.csv']
+        assert [r['key'] for r in index.search('user_meta.tags:y')] == ['a.csv']
+        # Phrases don't run from one value into the next.
+        assert not index.search('user_meta.tags:"x y"')
+        assert index.search('c')[0]['time'] == '2019-01-01T00:00:00+00:00'
+
+        # Unchanged objects aren't read again, and deleted ones are removed.
+        listing['Contents'] = listing['Contents'][1:]
+        self.s3_stubber.add_response(
+            'list_objects_v2', listing, {'Bucket': 'test-bucket', 'Prefix': ''}
+        )
+        index.add_bucket('test-bucket')
+        assert [r['key'] for r in index.search('csv')] == ['b/c.csv']
+
+        # Metadata edits keep the ETag, but change the modification time.
+        listing['Contents'][0]['LastModified'] = LAST_MODIFIED + datetime.timedelta(days=1)
+        self.s3_stubber.add_response(
+            'list_objects_v2', listing, {'Bucket': 'test-bucket', 'Prefix': ''}
+        )
+        self.s3_stubber.add_response(
+            'head_object', {'ContentLength': 1, 'Metadata': {'helium': '{"user_meta": {"kind": "clean"}}'}},
+            {'Bucket': 'test-bucket', 'Key': 'b/c.csv'}
+        )
+        index.add_bucket('test-bucket')
+        assert [r['key'] for r in index.search('user_meta.kind:clean')] == ['b/c.csv']
+
+    def test_no_fts5(self):
+        with patch('sqlite3.connect') as connect_mock:
+            connect_mock.return_value.executescript.side_effect = \
+                sqlite3.OperationalError('no such module: fts5')
+            with pytest.raises(QuiltException, match='FTS5'):
+                SearchIndex('index.sqlite')
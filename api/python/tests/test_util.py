@@ -78,4 +78,45 @@ def test_validate_url():
         util.validate_url('http://foo:bar')
 
     with pytest.raises(util.QuiltException, match='Requires at least scheme and host'):
-        util.validate_url('blah')
\ No newline at end of file
+        util.validate_url('blah')
+
+def test_quiltignore():
+    ignore = util.QuiltIgnore([
+        '# comment',
+        '',
+        '*.log',
+        '!keep.log',
+        'build/',
+        '/top.txt',
+        'docs/*.md',
+        'data/**/tmp',
+        '\\#hash',
+    ])
+    assert ignore.match('a.log') and ignore.match('x/y/a.log')
+    assert not ignore.match('keep.log') and not ignore.match('x/keep.log')
+    assert ignore.match('build', is_dir=True) and ignore.match('x/build', is_dir=True)
+    assert not ignore.match('build')
+    assert ignore.match('top.txt') and not ignore.match('x/top.txt')
+    assert ignore.match('docs/a.md') and not ignore.match('docs/x/a.md') and not ignore.match('x/docs/a.md')
+    assert ignore.match('data/tmp') and ignore.match('data/x/y/tmp') and not ignore.match('x/data/tmp')
+    assert ignore.match('#hash')
+    assert not ignore.match('# comment')
+
+    # Contents of ignored directories are ignored, and can't be re-included.
+    assert ignore.is_ignored('x/build/keep.log')
+    assert not ignore.is_ignored('x/keep.log')
+    assert not util.QuiltIgnore([]).is_ignored('anything')
+
+
+def test_quiltignore_filter(tmpdir):
+    root = pathlib.Path(str(tmpdir))
+    for rel_path in ['a.txt', 'b.log', 'dir/c.txt', 'dir/d.log', 'build/e.txt']:
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(rel_path)
+    ignore = root / '.quiltignore'
+    ignore.write_text('*.log\nbuild/\n')
+
+    kept = util.quiltignore_filter(root.rglob('*'), ignore, 'file')
+    assert sorted(p.relative_to(root).as_posix() for p in kept) == \
+        ['.quiltignore', 'a.txt', 'dir', 'dir/c.txt']
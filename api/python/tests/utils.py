@@ -1,11 +1,14 @@
 """
 Unittest setup
 """
-from unittest import TestCase
+import pathlib
+from tempfile import TemporaryDirectory
+from unittest import mock, TestCase
 
 from botocore.stub import Stubber
 import responses
 
+from t4 import packages, util
 from t4.data_transfer import s3_client
 
 
@@ -18,6 +21,17 @@ class QuiltTestCase(TestCase):
     def setUp(self):
         self.requests_mock = responses.RequestsMock(assert_all_requests_are_fired=False)
         self.requests_mock.start()
+        # Configs fetched from mocked URLs shouldn't outlive the test.
+        util._config_cache.clear()
+        # Neither should manifests and `latest` pointers cached from stubbed S3 calls.
+        self.cache_dir = TemporaryDirectory()
+        cache_path = pathlib.Path(self.cache_dir.name)
+        self.cache_patchers = [
+            mock.patch.object(packages, 'MANIFEST_CACHE_PATH', cache_path / 'manifests'),
+            mock.patch.object(packages, 'LATEST_CACHE_PATH', cache_path / 'latest'),
+        ]
+        for patcher in self.cache_patchers:
+            patcher.start()
 
         self.s3_stubber = Stubber(s3_client)
         self.s3_stubber.activate()
@@ -26,3 +40,6 @@ class QuiltTestCase(TestCase):
         self.s3_stubber.assert_no_pending_responses()
         self.s3_stubber.deactivate()
         self.requests_mock.stop()
+        for patcher in self.cache_patchers:
+            patcher.stop()
+        self.cache_dir.cleanup()
@@ -0,0 +1,168 @@
+"""
+backfill (or reindex) the objects already in a bucket into elastic, e.g. for a new
+bucket or after a mapping change, with the indexer's extraction logic
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from threading import Lock
+import time
+
+import botocore
+from elasticsearch import Elasticsearch
+
+try:
+    from . import index
+except ImportError:
+    # run as a script
+    import index
+
+WORKERS = 16 # objects fetched and extracted at once
+PAGE_SIZE = 1000 # objects listed, indexed and checkpointed at a time
+# errors for objects deleted since they were listed, which are skipped
+NOT_FOUND_CODES = ['404', 'NoSuchKey', 'NoSuchVersion']
+
+class RateLimiter:
+    """spread work out to at most `rate` units per second (no limit if rate is None),
+    across threads"""
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_time = time.time()
+        self.lock = Lock()
+
+    def wait(self, count):
+        """wait until count more units can be done"""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + count / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+def read_checkpoint(path, bucket, prefix):
+    """return the last key indexed by a previous run, or None"""
+    try:
+        with open(path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except FileNotFoundError:
+        return None
+    if (checkpoint['bucket'], checkpoint['prefix']) != (bucket, prefix):
+        raise ValueError("Checkpoint {} is for s3://{}/{}".format(
+            path, checkpoint['bucket'], checkpoint['prefix']))
+    return checkpoint['last_key']
+
+def write_checkpoint(path, bucket, prefix, last_key):
+    """record that everything up to last_key is indexed"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump({'bucket': bucket, 'prefix': prefix, 'last_key': last_key}, checkpoint_file)
+    # so an interrupted write doesn't lose the checkpoint
+    os.replace(tmp_path, path)
+
+def list_pages(bucket, prefix='', start_after=None):
+    """generator over (objects, last key) for each page of a bucket listing"""
+    paginator = index.S3_CLIENT.get_paginator('list_objects_v2')
+    params = dict(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': PAGE_SIZE})
+    if start_after:
+        params.update(StartAfter=start_after)
+    for page in paginator.paginate(**params):
+        contents = page.get('Contents', [])
+        if contents:
+            # skip "directories"
+            yield [obj for obj in contents if not obj['Key'].endswith('/')], contents[-1]['Key']
+
+def backfill(bucket, es, prefix='', checkpoint=None, workers=WORKERS, rate=None, skip_errors=None):
+    """index the latest versions of the objects in bucket whose keys start with prefix
+    Docs have deterministic _ids (see index.doc_id), so indexing an object again, e.g.
+    when resuming after a crash or reindexing, replaces its doc.
+    Args:
+        * es - Elasticsearch client
+        * checkpoint - path of a file to record progress in and, if it exists, to
+        resume from
+        * workers - number of objects to fetch and extract at once
+        * rate - most objects to fetch per second (and so docs to send to elastic,
+        as there's at most one per object)
+        * skip_errors - path of a file to append the keys of objects that can't be
+        extracted to (a JSON object with the key and error per line), instead of
+        stopping at them; they don't hold back the checkpoint
+    Returns:
+        * number of docs sent
+    Raises:
+        * if any object on a page can't be extracted (other than because it's been
+        deleted, or with skip_errors), or ES rejects any of its docs: the page's
+        other docs are sent, but the checkpoint isn't moved past it, so running
+        again retries it
+    """
+    start_after = read_checkpoint(checkpoint, bucket, prefix) if checkpoint else None
+    limiter = RateLimiter(rate)
+    count = 0
+
+    def extract(obj):
+        """return (extracted, exception)"""
+        limiter.wait(1)
+        try:
+            return index.extract_object(bucket, obj['Key'], retry=False), None
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in NOT_FOUND_CODES:
+                print("Skipping {}, deleted since it was listed".format(obj['Key']))
+                return None, None
+            return None, e
+        except Exception as e: # pylint: disable=broad-except
+            # do our best to process each object
+            return None, e
+
+    with ThreadPoolExecutor(workers) as executor:
+        for objects, last_key in list_pages(bucket, prefix, start_after):
+            batch = index.DocumentQueue(get_id=index.doc_id)
+            failed = []
+            for obj, (extracted, error) in zip(objects, executor.map(extract, objects)):
+                if error is not None:
+                    print("Exception while extracting {}: {}".format(obj['Key'], error))
+                    failed.append((obj['Key'], error))
+                elif extracted is not None:
+                    size, text, meta = extracted
+                    batch.append('Create', size, text, obj['Key'], meta,
+                                 updated=obj['LastModified'].isoformat())
+            count += len(batch)
+            batch.send_all(es)
+            if failed and skip_errors:
+                with open(skip_errors, 'a') as errors_file:
+                    for key, error in failed:
+                        errors_file.write(json.dumps({'key': key, 'error': str(error)}) + '\n')
+                print("Skipped {} objects that failed, listed in {}".format(len(failed), skip_errors))
+            elif failed:
+                raise Exception("Failed to extract {} objects on the page ending at {}, e.g. {}: {}; "
+                                "run again to retry the page".format(len(failed), last_key, *failed[0]))
+            if checkpoint:
+                write_checkpoint(checkpoint, bucket, prefix, last_key)
+            print("Indexed {} objects, up to {}".format(count, last_key))
+    return count
+
+def main():
+    """command line interface"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('bucket')
+    parser.add_argument('--prefix', default='', help="only index keys that start with this")
+    parser.add_argument('--checkpoint', help="file to record progress in, and resume from")
+    parser.add_argument('--workers', type=int, default=WORKERS, help="objects to fetch at once")
+    parser.add_argument('--rate', type=float, help="most objects to fetch (and index) per second")
+    parser.add_argument(
+        '--skip-errors', metavar='FILE',
+        help="skip objects that can't be extracted, and list them in FILE, instead of "
+        "stopping at the first page with any"
+    )
+    parser.add_argument(
+        '--es-url',
+        help="URL of an Elasticsearch to use without AWS auth, e.g. a local one; "
+        "defaults to the indexer's (ES_HOST)"
+    )
+    args = parser.parse_args()
+
+    es = Elasticsearch([args.es_url]) if args.es_url else index.get_es_client()
+    backfill(args.bucket, es, args.prefix, args.checkpoint, args.workers, args.rate, args.skip_errors)
+
+if __name__ == '__main__':
+    main()
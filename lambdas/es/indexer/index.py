@@ -1,17 +1,20 @@
 """
 phone data into elastic for supported file extensions
 """
+import codecs
+from collections import OrderedDict
 from datetime import datetime
+import hashlib
 import json
 import os
+import re
+import time
 from urllib.parse import unquote
 
 from aws_requests_auth.aws_auth import AWSRequestsAuth
 import botocore
 import boto3
 from elasticsearch import Elasticsearch, RequestsHttpConnection
-from elasticsearch.exceptions import RequestError
-import nbformat
 import tenacity
 
 DEFAULT_CONFIG = {
@@ -22,18 +25,34 @@ DEFAULT_CONFIG = {
     ]
 }
 
-NB_VERSION = 4 # default notebook version for nbformat
+# extensions we can extract text from; other objects only need a HEAD
+CONTENT_EXTENSIONS = ['.ipynb', '.md', '.rmd']
+# most bytes of a markdown file to download, and most characters of text to index;
+# notebooks are streamed up to MAX_NOTEBOOK_BYTES, as their outputs can be huge
+MAX_CONTENT_BYTES = int(os.environ.get('MAX_CONTENT_BYTES', 1_000_000))
+MAX_NOTEBOOK_BYTES = int(os.environ.get('MAX_NOTEBOOK_BYTES', 100_000_000))
+READ_CHUNK_BYTES = 1_000_000
+CONFIG_TTL = 60 # seconds a bucket's config is reused for
+ES_INDEX = 'drive'
+BULK_CHUNK_SIZE = 500 # most docs per _bulk request
+BULK_CHUNK_BYTES = 5_000_000 # most bytes per _bulk request (ES limits request size)
 
 S3_CLIENT = boto3.client("s3")
+ES_CLIENT = None # see get_es_client
+CONFIG_CACHE = {} # bucket -> (time fetched, config)
 
 def get_config(bucket):
-    """return a dict of DEFAULT_CONFIG merged the user's config (if available)"""
+    """return a dict of DEFAULT_CONFIG merged the user's config (if available);
+    configs are cached for CONFIG_TTL seconds per warm container"""
+    cached = CONFIG_CACHE.get(bucket)
+    if cached is not None and time.time() - cached[0] < CONFIG_TTL:
+        return cached[1]
     try:
         loaded_object = S3_CLIENT.get_object(Bucket=bucket, Key='.quilt/config.json')
         loaded_config = json.load(loaded_object['Body'])
-        return {**DEFAULT_CONFIG, **loaded_config}
+        config = {**DEFAULT_CONFIG, **loaded_config}
     except botocore.exceptions.ClientError:
-        return DEFAULT_CONFIG
+        config = DEFAULT_CONFIG
     except Exception as e:
         print('Exception when getting config')
         print(e)
@@ -41,6 +60,8 @@ def get_config(bucket):
         traceback.print_tb(e.__traceback__)
 
         return DEFAULT_CONFIG
+    CONFIG_CACHE[bucket] = (time.time(), config)
+    return config
 
 def transform_meta(meta):
     ''' Reshapes metadata for indexing in ES '''
@@ -69,193 +90,508 @@ def transform_meta(meta):
     }
     return result
 
-def extract_text(notebook_str):
-    """ Extract code and markdown
+class NotebookStream:
+    """a minimal streaming JSON reader, just enough to pick the sources out of a notebook
+    Values it skips (outputs, attachments, metadata) are scanned but never kept,
+    so memory doesn't grow with the size of the notebook.
+    """
+    _NON_SPACE = re.compile(r'\S')
+    _STRING_SPECIAL = re.compile(r'["\\]')
+    _CONTAINER_SPECIAL = re.compile(r'["{}\[\]]')
+    _SCALAR_END = re.compile(r'[\s,}\]]')
+
+    def __init__(self, chunks):
+        """chunks: iterable of str"""
+        self._chunks = iter(chunks)
+        self._buf = ''
+        self._pos = 0
+
+    def _fill(self):
+        """append the next chunk to the buffer, dropping what's been consumed"""
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            raise EOFError("Notebook ended unexpectedly")
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+
+    def _search(self, pattern):
+        """search for pattern from the current position, reading more as needed"""
+        while True:
+            match = pattern.search(self._buf, self._pos)
+            if match:
+                return match
+            self._pos = len(self._buf)
+            self._fill()
+
+    def peek(self):
+        """return the next non-whitespace character without consuming it"""
+        self._pos = self._search(self._NON_SPACE).start()
+        return self._buf[self._pos]
+
+    def expect(self, char):
+        """consume char, or raise ValueError"""
+        if self.peek() != char:
+            raise ValueError("Invalid JSON: expected {!r}, got {!r}".format(char, self._buf[self._pos]))
+        self._pos += 1
+
+    def string(self, keep=True):
+        """consume a string; return it if keep, otherwise just skip over it"""
+        self.expect('"')
+        parts = []
+        while True:
+            match = self._STRING_SPECIAL.search(self._buf, self._pos)
+            if not match:
+                if keep:
+                    parts.append(self._buf[self._pos:])
+                self._pos = len(self._buf)
+                self._fill()
+                continue
+            if keep:
+                parts.append(self._buf[self._pos:match.start()])
+            if match.group() == '"':
+                self._pos = match.end()
+                break
+            # keep an escape sequence's backslash and next character together
+            self._pos = match.start()
+            while len(self._buf) < self._pos + 2:
+                self._fill()
+            if keep:
+                parts.append(self._buf[self._pos:self._pos + 2])
+            self._pos += 2
+        return json.loads('"' + ''.join(parts) + '"') if keep else None
+
+    def skip(self):
+        """consume any value without keeping it"""
+        char = self.peek()
+        if char == '"':
+            self.string(keep=False)
+        elif char in '{[':
+            depth = 0
+            while True:
+                match = self._search(self._CONTAINER_SPECIAL)
+                if match.group() == '"':
+                    self._pos = match.start()
+                    self.string(keep=False)
+                    continue
+                self._pos = match.end()
+                depth += 1 if match.group() in '{[' else -1
+                if not depth:
+                    break
+        else:
+            # number, true, false or null
+            self._pos = self._search(self._SCALAR_END).start()
+
+    def items(self):
+        """generator over an object's keys; the caller consumes each value"""
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.string()
+            self.expect(':')
+            yield key
+            if self.peek() != ',':
+                self.expect('}')
+                return
+            self._pos += 1
+
+    def elements(self):
+        """generator over an array's elements; the caller consumes each one"""
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield
+            if self.peek() != ',':
+                self.expect(']')
+                return
+            self._pos += 1
+
+def extract_notebook_text(chunks, limit):
+    """ Extract code and markdown sources from a notebook, as a stream
     Args:
-        * nb - notebook as a string
+        * chunks - iterable of the notebook's bytes
+        * limit - most characters of text to return
     Returns:
-        * str - select code and markdown source (and outputs)
-    Pre:
-        * notebook is well-formed per notebook version 4
-        * 'cell_type' is defined for all cells
-        * 'source' defined for all 'code' and 'markdown' cells
+        * str - code and markdown sources; if the notebook is cut off (e.g. by a
+        ranged GET), those of the cells before the cut
     Throws:
-        * Anything nbformat.reads() can throw :( which is diverse and poorly
-        documented, hence the `except Exception` in handler()
+        * ValueError (incl. json.JSONDecodeError) if it isn't a notebook
+        * UnicodeDecodeError
     Notes:
-        * Deliberately decided not to index output streams and display strings
-        because they were noisy and low value
-        * Tested this code against ~6400 Jupyter notebooks in
-        s3://alpha-quilt-storage/tree/notebook-search/
-        * Might be useful to index "cell_type" : "raw" in the future
-    See also:
-        * Format reference https://nbformat.readthedocs.io/en/latest/format_description.html
+        * Handles notebook versions 4 (cells) and 3 (worksheets of cells, where
+        heading cells count as markdown)
+        * Reading stops once there's `limit` text
     """
-    formatted = nbformat.reads(notebook_str, as_version=NB_VERSION)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    stream = NotebookStream(decoder.decode(chunk) for chunk in chunks)
     text = []
-    for cell in formatted.get('cells', []):
-        if 'source' in cell and 'cell_type' in cell:
-            if cell['cell_type'] == 'code' or cell['cell_type'] == 'markdown':
-                text.append(cell['source'])
+    length = 0
+
+    def read_source():
+        if stream.peek() == '[':
+            return ''.join(stream.string() for _ in stream.elements())
+        return stream.string()
+
+    def read_cells(text_types):
+        nonlocal length
+        for _ in stream.elements():
+            cell_type = source = None
+            for key in stream.items():
+                if key == 'cell_type':
+                    cell_type = stream.string()
+                elif key in ('source', 'input'):
+                    source = read_source()
+                else:
+                    stream.skip()
+            if cell_type in text_types and source is not None:
+                text.append(source)
+                length += len(source) + 1
+                if length >= limit:
+                    return False
+        return True
+
+    def read_notebook():
+        for key in stream.items():
+            if key == 'cells':
+                if not read_cells(('code', 'markdown')):
+                    return
+            elif key == 'worksheets':
+                for _ in stream.elements():
+                    for worksheet_key in stream.items():
+                        if worksheet_key != 'cells':
+                            stream.skip()
+                        # version 3 has heading cells as well as markdown
+                        elif not read_cells(('code', 'markdown', 'heading')):
+                            return
+            else:
+                stream.skip()
 
-    return '\n'.join(text)
+    try:
+        read_notebook()
+    except EOFError:
+        # keep what we have
+        pass
+    return '\n'.join(text)[:limit]
+
+def extract_markdown_text(chunks, limit):
+    """ Decode markdown (or any UTF-8 text) from a stream, up to `limit` characters
+    Notes:
+        * A character cut off at the end of the stream (e.g. by a ranged GET) is dropped
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    text = []
+    length = 0
+    for chunk in chunks:
+        text.append(decoder.decode(chunk))
+        length += len(text[-1])
+        if length >= limit:
+            break
+    return ''.join(text)[:limit]
 
-def post_to_es(event_type, size, text, key, meta, version_id=''):
-    """structure and send data to ElasticSearch"""
+# Retry with back-off for eventual consistency reasons
+@tenacity.retry(wait=tenacity.wait_exponential(multiplier=2, min=4, max=30))
+def get_from_s3(bucket, key, version_id=None, etag=None, head=False, limit=None):
+    """HEAD the object from an S3 event, or GET up to `limit` bytes of it
+    (if the event has no version, the object's ETag must match the event's)"""
+    params = dict(Bucket=bucket, Key=key)
+    if version_id:
+        params.update(VersionId=version_id)
+    if head:
+        response = S3_CLIENT.head_object(**params)
+    else:
+        try:
+            response = S3_CLIENT.get_object(Range=f'bytes=0-{limit - 1}', **params)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidRange':
+                raise
+            # empty objects don't have any bytes to get
+            response = S3_CLIENT.get_object(**params)
+    if not version_id and etag is not None and response['ETag'] != etag:
+        # assert etag match, otherwise raise exception and let retry handle a new
+        # request.
+        raise Exception("Failed to retrieve most recent object matching eTag in "
+                        "bucket notification.")
+    return response
 
-    ES_HOST = os.environ['ES_HOST']
-    ES_INDEX = 'drive'
+def get_object_size(response):
+    """size of the whole object, even if the response only has part of it"""
+    content_range = response.get('ContentRange')
+    if content_range:
+        # bytes <first>-<last>/<size>
+        return int(content_range.rsplit('/', 1)[1])
+    return response['ContentLength']
 
+def make_doc(event_type, size, text, key, meta, version_id='', updated=None):
+    """structure the ElasticSearch document for an S3 event (updated defaults to now)"""
     data = {
         'type': event_type,
         'size': size,
         'text': text,
         'key': key,
-        'updated': datetime.utcnow().isoformat(),
+        'updated': updated or datetime.utcnow().isoformat(),
         'version_id': version_id
     }
     data = {**data, **transform_meta(meta)}
     data['meta_text'] = ' '.join([data['meta_text'], key])
-    try:
+    return data
+
+def get_es_client():
+    """return an ElasticSearch client, created once per warm container"""
+    global ES_CLIENT # pylint: disable=global-statement
+    if ES_CLIENT is None:
+        es_host = os.environ['ES_HOST']
         session = boto3.session.Session()
         awsauth = AWSRequestsAuth(
             aws_access_key=os.environ['AWS_ACCESS_KEY_ID'],
             aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
             aws_token=os.environ['AWS_SESSION_TOKEN'],
-            aws_host=ES_HOST,
+            aws_host=es_host,
             aws_region=session.region_name,
             aws_service='es'
         )
 
-        es = Elasticsearch(
-            hosts=[{'host': ES_HOST, 'port': 443}],
+        ES_CLIENT = Elasticsearch(
+            hosts=[{'host': es_host, 'port': 443}],
             http_auth=awsauth,
             use_ssl=True,
             verify_certs=True,
             connection_class=RequestsHttpConnection
         )
+    return ES_CLIENT
 
-        res = es.index(index=ES_INDEX, doc_type='_doc', body=data)
-        print(res)
-    except RequestError as e:
-        if e.error == 'mapper_parsing_exception':
-            # retry with just plaintext stuff
-            print('Mapping exception. Retrying without user_meta and system_meta')
-            data['user_meta'] = {}
-            data['system_meta'] = {}
-            try:
-                res = es.index(index=ES_INDEX, doc_type='_doc', body=data)
-                print(res)
-            except Exception as e:
-                print('Failover failed. data: ' + json.dumps(data))
-                print(e)
-                import traceback
-                traceback.print_tb(e.__traceback__)
-        else:
-            print("Exception encountered when POSTing to ES")
-            print(e)
-            import traceback
-            traceback.print_tb(e.__traceback__)
+def bulk_chunks(docs):
+    """split docs into chunks of at most BULK_CHUNK_SIZE docs and (unless a single
+    doc is bigger) BULK_CHUNK_BYTES of JSON"""
+    chunk = []
+    chunk_bytes = 0
+    for doc in docs:
+        doc_bytes = len(json.dumps(doc))
+        if chunk and (len(chunk) >= BULK_CHUNK_SIZE or chunk_bytes + doc_bytes > BULK_CHUNK_BYTES):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(doc)
+        chunk_bytes += doc_bytes
+    if chunk:
+        yield chunk
 
-    except Exception as e:
-        print("Exception encountered when POSTing to ES")
+def doc_id(doc):
+    """a deterministic _id for the doc of an object (version), so indexing it again
+    replaces its doc instead of adding another (hashed, as keys can be longer than
+    ES allows _ids to be)"""
+    return hashlib.sha256(json.dumps([doc['key'], doc['version_id']]).encode()).hexdigest()
+
+def event_id(bucket, key, version_id, sequencer):
+    """a deterministic _id for the doc of an S3 event, from its sequencer (which S3
+    gives each event for a key), so a redelivered event replaces its doc instead of
+    adding another, while other events for the same object still add theirs"""
+    return hashlib.sha256(json.dumps([bucket, key, version_id, sequencer]).encode()).hexdigest()
+
+def bulk_index(es, docs, ids=None):
+    """send docs to ElasticSearch with the _bulk API, a chunk at a time
+    Args:
+        * ids - the docs' _ids, in the same order; ES generates them by default,
+          and for docs whose _id is None
+    Returns:
+        * list of (doc, _id, error) for the docs that failed
+    """
+    if ids is None:
+        ids = [None] * len(docs)
+    failed = []
+    start = 0
+    for chunk in bulk_chunks(docs):
+        chunk_ids = ids[start:start + len(chunk)]
+        start += len(chunk)
+        body = []
+        for doc, _id in zip(chunk, chunk_ids):
+            action = {'_index': ES_INDEX, '_type': '_doc'}
+            if _id is not None:
+                action['_id'] = _id
+            body.append({'index': action})
+            body.append(doc)
+        res = es.bulk(body=body)
+        if res.get('errors'):
+            # items are in the same order as the docs
+            for doc, _id, item in zip(chunk, chunk_ids, res['items']):
+                error = item['index'].get('error')
+                if error:
+                    failed.append((doc, _id, error))
+    return failed
+
+class DocumentQueue:
+    """collect the docs for a batch of S3 events and send them to ElasticSearch in bulk
+    (with _ids from get_id, e.g. doc_id, if given, or as appended)"""
+    def __init__(self, get_id=None):
+        # repeated events for the same object (version) are coalesced: the last one wins
+        self.docs = OrderedDict()
+        self.get_id = get_id
+
+    def append(self, event_type, size, text, key, meta, version_id='', updated=None, bucket=None, _id=None):
+        """add a doc to the queue, with _id if given"""
+        doc_key = (bucket, key, version_id or None)
+        doc = make_doc(event_type, size, text, key, meta, version_id, updated)
+        if _id is None and self.get_id is not None:
+            _id = self.get_id(doc)
+        self.docs.pop(doc_key, None)
+        self.docs[doc_key] = (doc, _id)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def send_all(self, es=None):
+        """send all queued docs (with es, or the container's client), then empty the queue"""
+        if not self.docs:
+            return
+        docs, ids = zip(*self.docs.values())
+        self.docs.clear()
+        if es is None:
+            es = get_es_client()
+
+        retry = []
+        retry_ids = []
+        failed = []
+        for doc, _id, error in bulk_index(es, list(docs), list(ids)):
+            if error.get('type') == 'mapper_parsing_exception':
+                # retry with just plaintext stuff
+                print('Mapping exception for {}. Retrying without user_meta and system_meta'.format(doc['key']))
+                retry.append({**doc, 'user_meta': {}, 'system_meta': {}})
+                retry_ids.append(_id)
+            else:
+                print('Exception encountered when indexing {}: {}'.format(doc['key'], error))
+                failed.append((doc, error))
+
+        for doc, _, error in bulk_index(es, retry, retry_ids):
+            print('Failover failed. data: ' + json.dumps(doc))
+            print(error)
+            if error.get('type') != 'mapper_parsing_exception':
+                failed.append((doc, error))
+
+        if failed:
+            # e.g. es_rejected_execution_exception (429) when ES is overloaded;
+            # raise so the batch is redelivered rather than lost (docs have _ids,
+            # so the ones that were indexed are replaced rather than duplicated)
+            doc, error = failed[0]
+            raise Exception("Failed to index {} docs, e.g. {}: {}".format(len(failed), doc['key'], error))
+
+def extract_object(bucket, key, version_id=None, etag=None, retry=True):
+    """fetch an object (just its metadata, unless there's text to extract) and
+    extract what to index from it
+    Args:
+        * retry - whether to retry until the object matches the event; objects from
+        a listing can't be newer than it, but can have been deleted since
+    Returns:
+        * (size, text, meta)
+    """
+    to_index = get_config(bucket).get('to_index', [])
+    to_index = [x.lower() for x in to_index]
+    _, ext = os.path.splitext(key)
+    ext = ext.lower()
+    # only download the object if we can index text from it
+    head = ext not in to_index or ext not in CONTENT_EXTENSIONS
+    if ext in to_index and head:
+        # TODO: phone this into mixpanel
+        print(f"no logic to index {ext}")
+    limit = MAX_NOTEBOOK_BYTES if ext == '.ipynb' else MAX_CONTENT_BYTES
+    try:
+        # (tenacity 5.0 ignores reraise unless after is given too)
+        fetch = get_from_s3 if retry else get_from_s3.retry_with(
+            stop=tenacity.stop_after_attempt(1), reraise=True, after=tenacity.after_nothing)
+        response = fetch(bucket, key, version_id, etag, head=head, limit=limit)
+    except botocore.exceptions.ClientError as e:
+        print("Exception while getting object")
         print(e)
-        import traceback
-        traceback.print_tb(e.__traceback__)
+        print(bucket)
+        print(key)
+        raise
+
+    size = get_object_size(response)
+    meta = response['Metadata']
+    text = ''
+
+    if not head:
+        # try to index data from the object itself, a chunk at a time
+        body = response['Body']
+        chunks = iter(lambda: body.read(READ_CHUNK_BYTES), b'')
+        if ext in ['.md', '.rmd']:
+            try:
+                text = extract_markdown_text(chunks, MAX_CONTENT_BYTES)
+            except UnicodeDecodeError:
+                print("Unicode decode error in .md file")
+        elif ext == '.ipynb':
+            try:
+                text = extract_notebook_text(chunks, MAX_CONTENT_BYTES)
+            except UnicodeDecodeError as uni:
+                print("Unicode decode error in {}: {} ".format(key, uni))
+            except ValueError:
+                print("Invalid JSON in {}.".format(key))
+            # better not to fail altogether
+            except Exception as exc:#pylint: disable=broad-except
+                print("Exception in file {}: {}".format(key, exc))
+        body.close()
+
+    # decode helium metadata
+    try:
+        meta['helium'] = json.loads(meta['helium'])
+    except (KeyError, json.JSONDecodeError):
+        print('decoding helium metadata failed')
+
+    return size, text, meta
 
 def handler(event, _):
     """fetch the S3 object from event, extract relevant data and metadata,
-    dispatch post_to_es
+    queue the docs for ElasticSearch, and send them all at the end of the batch
     """
+    batch = DocumentQueue()
     try:
+        # coalesce repeated events for the same object (version) before fetching anything:
+        # the last one wins, and an earlier one's ETag may no longer match the object
+        records = OrderedDict()
         for msg in event['Records']:
             for record in json.loads(json.loads(msg['body'])['Message'])['Records']:
                 try:
-                    eventname = record['eventName']
-                    bucket = unquote(record['s3']['bucket']['name'])
-                    key = unquote(record['s3']['object']['key'])
                     version_id = record['s3']['object'].get('versionId')
-                    version_id = unquote(version_id) if version_id else None
-                    etag = unquote(record['s3']['object']['eTag'])
-
-                    if eventname == 'ObjectRemoved:Delete':
-                        event_type = 'Delete'
-                        post_to_es(event_type, 0, '', key, {})
-                        continue
-                    elif eventname == 'ObjectCreated:Put':
-                        event_type = 'Create'
-                    else:
-                        event_type = eventname
-                    try:
-                        # Retry with back-off for eventual consistency reasons
-                        @tenacity.retry(wait=tenacity.wait_exponential(multiplier=2, min=4, max=30))
-                        def get_obj_from_s3(bucket, key, version_id=None, etag=None):
-                            if version_id:
-                                response = S3_CLIENT.get_object(Bucket=bucket, Key=key, VersionId=version_id)
-                            else:
-                                response = S3_CLIENT.get_object(Bucket=bucket, Key=key)
-                                # assert etag match, otherwise raise exception and let retry handle a new
-                                # request.
-                                if response['ETag'] != etag:
-                                    raise Exception("Failed to retrieve most recent object matching eTag in "
-                                                    "bucket notification.")
-                            return response
-                        response = get_obj_from_s3(bucket, key, version_id, etag)
-
-                    except botocore.exceptions.ClientError as e:
-                        print("Exception while getting object")
-                        print(e)
-                        print(bucket)
-                        print(key)
-                        raise
-
-                    size = response['ContentLength']
-                    meta = response['Metadata']
-                    text = ''
-
-                    to_index = get_config(bucket).get('to_index', [])
-                    to_index = [x.lower() for x in to_index]
-                    _, ext = os.path.splitext(key)
-                    ext = ext.lower()
-                    if ext in to_index:
-                        # try to index data from the object itself
-                        if ext in ['.md', '.rmd']:
-                            try:
-                                text = response['Body'].read().decode('utf-8')
-                            except UnicodeDecodeError:
-                                print("Unicode decode error in .md file")
-                        elif ext == '.ipynb':
-                            try:
-                                notebook = response['Body'].read().decode('utf-8')
-                                text = extract_text(notebook)
-                            except UnicodeDecodeError as uni:
-                                print("Unicode decode error in {}: {} ".format(key, uni))
-                            except (json.JSONDecodeError, nbformat.reader.NotJSONError):
-                                print("Invalid JSON in {}.".format(key))
-                            except (KeyError, AttributeError)  as err:
-                                print("Missing key in {}: {}".format(key, err))
-                            # there might be more errors than covered by test_read_notebook
-                            # better not to fail altogether
-                            except Exception as exc:#pylint: disable=broad-except
-                                print("Exception in file {}: {}".format(key, exc))
-                        else:
-                            # TODO: phone this into mixpanel
-                            print(f"no logic to index {ext}")
-
-                    # decode helium metadata
-                    try:
-                        meta['helium'] = json.loads(meta['helium'])
-                    except (KeyError, json.JSONDecodeError):
-                        print('decoding helium metadata failed')
-
-                    post_to_es(event_type, size, text, key, meta, version_id)
+                    record_key = (
+                        unquote(record['s3']['bucket']['name']),
+                        unquote(record['s3']['object']['key']),
+                        unquote(version_id) if version_id else None,
+                    )
                 except Exception as e:
-                    # do our best to process each result
                     print("Exception encountered for record")
                     print(e)
-                    import traceback
-                    traceback.print_tb(e.__traceback__)
                     print(msg)
+                    continue
+                records.pop(record_key, None)
+                records[record_key] = (msg, record)
+
+        for (bucket, key, version_id), (msg, record) in records.items():
+            try:
+                eventname = record['eventName']
+                etag = unquote(record['s3']['object']['eTag'])
+
+                sequencer = record['s3']['object'].get('sequencer')
+                _id = event_id(bucket, key, version_id, sequencer) if sequencer else None
+
+                if eventname == 'ObjectRemoved:Delete':
+                    event_type = 'Delete'
+                    batch.append(event_type, 0, '', key, {}, bucket=bucket, _id=_id)
+                    continue
+                elif eventname == 'ObjectCreated:Put':
+                    event_type = 'Create'
+                else:
+                    event_type = eventname
+                size, text, meta = extract_object(bucket, key, version_id, etag)
+                batch.append(event_type, size, text, key, meta, version_id, bucket=bucket, _id=_id)
+            except Exception as e:
+                # do our best to process each result
+                print("Exception encountered for record")
+                print(e)
+                import traceback
+                traceback.print_tb(e.__traceback__)
+                print(msg)
+        batch.send_all()
     except Exception as e:
         # do our best to process each result
         print("Exception encountered for whole Event")
@@ -3,5 +3,5 @@ from setuptools import setup
 setup(
     name='es_indexer',
     version='0.0.1',
-    py_modules=['index'],
+    py_modules=['backfill', 'index'],
 )
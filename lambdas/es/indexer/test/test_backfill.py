@@ -0,0 +1,164 @@
+"""
+Test backfilling a bucket
+"""
+from datetime import datetime, timezone
+import io
+import json
+import os
+from unittest.mock import patch
+
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+import pytest
+
+from .. import backfill, index
+
+
+LAST_MODIFIED = datetime(2019, 1, 1, tzinfo=timezone.utc)
+
+class LocalES:
+    """stands in for Elasticsearch's _bulk API"""
+    def __init__(self):
+        self.docs = {} # _id -> doc
+
+    def bulk(self, body):
+        """index the docs in a _bulk request body"""
+        items = []
+        for action, doc in zip(body[::2], body[1::2]):
+            assert action == {'index': {'_index': index.ES_INDEX, '_type': '_doc', '_id': index.doc_id(doc)}}
+            self.docs[action['index']['_id']] = doc
+            items.append({'index': {'status': 201}})
+        return {'errors': False, 'items': items}
+
+def stub_get(stubber, key, body):
+    """a markdown object's contents"""
+    stubber.add_response(
+        'get_object',
+        {
+            'Body': StreamingBody(io.BytesIO(body), len(body)),
+            'ContentLength': len(body),
+            'ETag': '"123"',
+            'Metadata': {},
+        },
+        {'Bucket': 'test-bucket', 'Key': key, 'Range': 'bytes=0-999999'}
+    )
+
+def stub_head(stubber, key, meta='{}'):
+    """an object without text to extract"""
+    stubber.add_response(
+        'head_object',
+        {'ContentLength': 1, 'ETag': '"123"', 'Metadata': {'helium': meta}},
+        {'Bucket': 'test-bucket', 'Key': key}
+    )
+
+def stub_listing(stubber, keys, **params):
+    """a single page listing of test-bucket"""
+    contents = [dict(Key=key, Size=1, ETag='"123"', LastModified=LAST_MODIFIED) for key in keys]
+    stubber.add_response(
+        'list_objects_v2',
+        dict(IsTruncated=False, Contents=contents),
+        dict(Bucket='test-bucket', Prefix='', MaxKeys=backfill.PAGE_SIZE, **params)
+    )
+
+def test_backfill(tmpdir):
+    """objects are indexed, and a second run resumes from the checkpoint"""
+    index.CONFIG_CACHE.clear()
+    stubber = Stubber(index.S3_CLIENT)
+    stub_listing(stubber, ['a.md', 'b.csv', 'c.csv', 'dir/'])
+    stubber.add_client_error('get_object', 'NoSuchKey', expected_params={
+        'Bucket': 'test-bucket', 'Key': '.quilt/config.json'
+    })
+    stub_get(stubber, 'a.md', b'# A')
+    stub_head(stubber, 'b.csv', '{"user_meta": {"foo": "bar"}}')
+    # deleted since the listing: skipped, without waiting for it
+    stubber.add_client_error('head_object', 'NoSuchKey', expected_params={
+        'Bucket': 'test-bucket', 'Key': 'c.csv'
+    })
+
+    es = LocalES()
+    checkpoint = str(tmpdir / 'checkpoint.json')
+    with stubber:
+        assert backfill.backfill('test-bucket', es, checkpoint=checkpoint, workers=1) == 2
+        stubber.assert_no_pending_responses()
+
+    docs = list(es.docs.values())
+    assert [(doc['key'], doc['text'], doc['user_meta']) for doc in docs] == [
+        ('a.md', '# A', {}), ('b.csv', '', {'foo': 'bar'})
+    ]
+    assert docs[0]['updated'] == LAST_MODIFIED.isoformat()
+    with open(checkpoint) as checkpoint_file:
+        assert json.load(checkpoint_file)['last_key'] == 'dir/'
+
+    stub_listing(stubber, [], StartAfter='dir/')
+    with stubber:
+        assert backfill.backfill('test-bucket', es, checkpoint=checkpoint) == 0
+        stubber.assert_no_pending_responses()
+
+def test_backfill_failures(tmpdir):
+    """a page with objects that fail isn't checkpointed, and running again replaces its docs"""
+    index.CONFIG_CACHE.clear()
+    stubber = Stubber(index.S3_CLIENT)
+    stub_listing(stubber, ['a.md', 'b.csv'])
+    stubber.add_client_error('get_object', 'NoSuchKey', expected_params={
+        'Bucket': 'test-bucket', 'Key': '.quilt/config.json'
+    })
+    stubber.add_client_error('get_object', 'AccessDenied', http_status_code=403, expected_params={
+        'Bucket': 'test-bucket', 'Key': 'a.md', 'Range': 'bytes=0-999999'
+    })
+    stub_head(stubber, 'b.csv')
+
+    es = LocalES()
+    checkpoint = str(tmpdir / 'checkpoint.json')
+    with stubber:
+        with pytest.raises(Exception, match='a.md'):
+            backfill.backfill('test-bucket', es, checkpoint=checkpoint, workers=1)
+        stubber.assert_no_pending_responses()
+    # the objects that didn't fail are indexed anyway
+    assert [doc['key'] for doc in es.docs.values()] == ['b.csv']
+    assert not os.path.exists(checkpoint)
+
+    stub_listing(stubber, ['a.md', 'b.csv'])
+    stub_get(stubber, 'a.md', b'# A')
+    stub_head(stubber, 'b.csv')
+    with stubber:
+        assert backfill.backfill('test-bucket', es, checkpoint=checkpoint, workers=1) == 2
+        stubber.assert_no_pending_responses()
+    assert sorted(doc['key'] for doc in es.docs.values()) == ['a.md', 'b.csv']
+
+def test_backfill_skip_errors(tmpdir):
+    """with skip_errors, objects that fail are listed and the checkpoint moves past them"""
+    index.CONFIG_CACHE.clear()
+    stubber = Stubber(index.S3_CLIENT)
+    stub_listing(stubber, ['a.md', 'b.csv'])
+    stubber.add_client_error('get_object', 'NoSuchKey', expected_params={
+        'Bucket': 'test-bucket', 'Key': '.quilt/config.json'
+    })
+    stubber.add_client_error('get_object', 'AccessDenied', http_status_code=403, expected_params={
+        'Bucket': 'test-bucket', 'Key': 'a.md', 'Range': 'bytes=0-999999'
+    })
+    stub_head(stubber, 'b.csv')
+
+    es = LocalES()
+    checkpoint = str(tmpdir / 'checkpoint.json')
+    errors = str(tmpdir / 'errors.jsonl')
+    with stubber:
+        assert backfill.backfill('test-bucket', es, checkpoint=checkpoint, workers=1, skip_errors=errors) == 1
+        stubber.assert_no_pending_responses()
+    assert [doc['key'] for doc in es.docs.values()] == ['b.csv']
+    with open(checkpoint) as checkpoint_file:
+        assert json.load(checkpoint_file)['last_key'] == 'b.csv'
+    with open(errors) as errors_file:
+        error, = [json.loads(line) for line in errors_file]
+    assert error['key'] == 'a.md' and 'AccessDenied' in error['error']
+
+def test_rate_limiter():
+    """work is spread out to the rate"""
+    with patch('time.time') as time_mock, patch('time.sleep') as sleep_mock:
+        time_mock.return_value = 100
+        limiter = backfill.RateLimiter(10)
+        limiter.wait(20)
+        assert not sleep_mock.called
+        time_mock.return_value = 101
+        limiter.wait(5)
+        sleep_mock.assert_called_once_with(1)
+        assert limiter.next_time == 102.5
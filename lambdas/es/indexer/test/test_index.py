@@ -0,0 +1,193 @@
+"""
+Test the indexing handler
+"""
+import io
+import json
+from unittest.mock import MagicMock, patch
+
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+import pytest
+
+from .. import index
+
+
+def make_event(*records):
+    """wrap S3 event records like SNS -> SQS does"""
+    message = json.dumps({'Records': list(records)})
+    return {'Records': [{'body': json.dumps({'Message': message})}]}
+
+def make_record(event_name, key, etag='123', sequencer='0055AED6DCD90281E5'):
+    """an S3 event record for test-bucket"""
+    return {
+        'eventName': event_name,
+        's3': {
+            'bucket': {'name': 'test-bucket'},
+            'object': {'key': key, 'eTag': etag, 'sequencer': sequencer},
+        },
+    }
+
+def bulk_response(*errors):
+    """a _bulk response with an item per error (None for success)"""
+    items = [{'index': {'status': 400, 'error': error} if error else {'status': 201}} for error in errors]
+    return {'errors': any(errors), 'items': items}
+
+def stub_config(stubber):
+    """no .quilt/config.json, so DEFAULT_CONFIG applies"""
+    index.CONFIG_CACHE.clear()
+    stubber.add_client_error('get_object', 'NoSuchKey', expected_params={
+        'Bucket': 'test-bucket', 'Key': '.quilt/config.json'
+    })
+
+def index_event(stubber, *records):
+    """run the handler and return the docs it sent to ES"""
+    es_mock = MagicMock()
+    es_mock.bulk.return_value = bulk_response(None)
+    with stubber, patch.object(index, 'get_es_client', return_value=es_mock):
+        index.handler(make_event(*records), None)
+        stubber.assert_no_pending_responses()
+    return es_mock.bulk.call_args[1]['body'][1::2]
+
+def test_bulk_indexing():
+    """docs for a batch are coalesced and sent in one _bulk request"""
+    stubber = Stubber(index.S3_CLIENT)
+    stub_config(stubber)
+    # repeated events for a.md are coalesced before it's fetched, so it's only fetched once
+    body = b'# New'
+    stubber.add_response(
+        'get_object',
+        {
+            'Body': StreamingBody(io.BytesIO(body), len(body)),
+            'ContentLength': len(body),
+            'ETag': '456',
+            'Metadata': {'helium': '{"user_meta": {"bad": 1}}'},
+        },
+        {'Bucket': 'test-bucket', 'Key': 'a.md', 'Range': 'bytes=0-999999'}
+    )
+
+    es_mock = MagicMock()
+    es_mock.bulk.side_effect = [
+        bulk_response(None, {'type': 'mapper_parsing_exception'}),
+        bulk_response(None),
+    ]
+    event = make_event(
+        make_record('ObjectRemoved:Delete', 'b.md'),
+        make_record('ObjectCreated:Put', 'a.md'),
+        make_record('ObjectCreated:Put', 'a.md', etag='456', sequencer='0055AED6DCD90281E6'),
+    )
+    with stubber, patch.object(index, 'get_es_client', return_value=es_mock):
+        index.handler(event, None)
+        stubber.assert_no_pending_responses()
+
+    assert es_mock.bulk.call_count == 2
+    body = es_mock.bulk.call_args_list[0][1]['body']
+    # docs have _ids from their events, so a redelivered batch replaces them
+    a_id = index.event_id('test-bucket', 'a.md', None, '0055AED6DCD90281E6')
+    assert body[0] == {'index': {
+        '_index': index.ES_INDEX, '_type': '_doc',
+        '_id': index.event_id('test-bucket', 'b.md', None, '0055AED6DCD90281E5'),
+    }}
+    assert body[2] == {'index': {'_index': index.ES_INDEX, '_type': '_doc', '_id': a_id}}
+    docs = body[1::2]
+    # only the last event for a.md is indexed
+    assert [(doc['key'], doc['type']) for doc in docs] == [('b.md', 'Delete'), ('a.md', 'Create')]
+    assert docs[1]['text'] == '# New'
+    assert docs[1]['user_meta'] == {'bad': 1}
+
+    # the doc that didn't fit the mappings is retried without metadata
+    retried = es_mock.bulk.call_args_list[1][1]['body']
+    assert len(retried) == 2
+    assert retried[0]['index']['_id'] == a_id
+    assert retried[1]['key'] == 'a.md' and retried[1]['user_meta'] == {}
+
+def test_coalesce_by_bucket():
+    """events for the same key in different buckets aren't coalesced"""
+    batch = index.DocumentQueue()
+    batch.append('Delete', 0, '', 'a.md', {}, bucket='bucket-1')
+    batch.append('Delete', 0, '', 'a.md', {}, bucket='bucket-2')
+    batch.append('Delete', 0, '', 'a.md', {}, bucket='bucket-1')
+    assert len(batch) == 2
+
+def test_bulk_errors():
+    """docs that fail for other reasons than the mappings fail the batch, so it's redelivered"""
+    es_mock = MagicMock()
+    es_mock.bulk.return_value = bulk_response({'type': 'es_rejected_execution_exception'})
+    batch = index.DocumentQueue()
+    batch.append('Delete', 0, '', 'a.md', {})
+    with pytest.raises(Exception, match='es_rejected_execution_exception'):
+        batch.send_all(es_mock)
+
+def test_bulk_chunks():
+    """docs are sent BULK_CHUNK_SIZE at a time"""
+    es_mock = MagicMock()
+    es_mock.bulk.side_effect = [bulk_response(None, None), bulk_response({'type': 'other'})]
+    docs = [index.make_doc('Create', 0, '', key, {}) for key in 'abc']
+    with patch.object(index, 'BULK_CHUNK_SIZE', 2):
+        failed = index.bulk_index(es_mock, docs)
+    assert es_mock.bulk.call_count == 2
+    assert failed == [(docs[2], None, {'type': 'other'})]
+
+def test_bulk_chunk_bytes():
+    """big docs get _bulk requests of their own"""
+    docs = [index.make_doc('Create', 0, text, 'key', {}) for text in ['a', 'b' * 100, 'c']]
+    with patch.object(index, 'BULK_CHUNK_BYTES', 100):
+        chunks = list(index.bulk_chunks(docs))
+    assert chunks == [[docs[0]], [docs[1]], [docs[2]]]
+
+def test_metadata_only():
+    """objects without text to extract are only HEADed"""
+    stubber = Stubber(index.S3_CLIENT)
+    stub_config(stubber)
+    stubber.add_response(
+        'head_object',
+        {'ContentLength': 123, 'ETag': '123', 'Metadata': {}, 'VersionId': 'v1'},
+        {'Bucket': 'test-bucket', 'Key': 'data.csv', 'VersionId': 'v1'}
+    )
+    record = make_record('ObjectCreated:Put', 'data.csv')
+    record['s3']['object']['versionId'] = 'v1'
+    doc, = index_event(stubber, record)
+    assert doc['key'] == 'data.csv' and doc['size'] == 123 and doc['version_id'] == 'v1'
+
+def test_content_limit():
+    """only the first MAX_CONTENT_BYTES of an object are downloaded"""
+    stubber = Stubber(index.S3_CLIENT)
+    stub_config(stubber)
+    for key, body in [('big.md', 'ab\u00e9'.encode()), ('big.ipynb', b'{"cells": [')]:
+        stubber.add_response(
+            'get_object',
+            {
+                'Body': StreamingBody(io.BytesIO(body[:3]), 3),
+                'ContentLength': 3,
+                'ContentRange': 'bytes 0-2/1000',
+                'ETag': '123',
+                'Metadata': {},
+            },
+            {'Bucket': 'test-bucket', 'Key': key, 'Range': 'bytes=0-2'}
+        )
+    with patch.object(index, 'MAX_CONTENT_BYTES', 3), patch.object(index, 'MAX_NOTEBOOK_BYTES', 3):
+        docs = index_event(
+            stubber,
+            make_record('ObjectCreated:Put', 'big.md'),
+            make_record('ObjectCreated:Put', 'big.ipynb'),
+        )
+    # a truncated character is dropped, and a truncated notebook has no complete cells
+    assert [(doc['text'], doc['size']) for doc in docs] == [('ab', 1000), ('', 1000)]
+
+def test_config_cache():
+    """bucket configs are reused for CONFIG_TTL seconds"""
+    stubber = Stubber(index.S3_CLIENT)
+    stub_config(stubber)
+    body = b'{"to_index": [".txt"]}'
+    stubber.add_response(
+        'get_object',
+        {'Body': StreamingBody(io.BytesIO(body), len(body))},
+        {'Bucket': 'test-bucket', 'Key': '.quilt/config.json'}
+    )
+    with stubber, patch('time.time') as time_mock:
+        time_mock.return_value = 1000
+        assert index.get_config('test-bucket') == index.DEFAULT_CONFIG
+        time_mock.return_value = 1000 + index.CONFIG_TTL - 1
+        assert index.get_config('test-bucket') == index.DEFAULT_CONFIG
+        time_mock.return_value = 1000 + index.CONFIG_TTL
+        assert index.get_config('test-bucket')['to_index'] == ['.txt']
+        stubber.assert_no_pending_responses()
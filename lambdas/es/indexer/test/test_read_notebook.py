@@ -1,43 +1,91 @@
 """
 Test functions for text extraction from Jupyter notebooks
 """
+import json
 import os
 
 import pytest
-from nbformat.reader import NotJSONError
 
-from ..index import extract_text
+from ..index import extract_notebook_text
 from .constants import NORMAL_EXTRACT
 
 NB_RAISES = {
-    '404.ipynb': NotJSONError,
-    'attribute-error.ipynb': AttributeError,
-    'empty.ipynb': NotJSONError,
-    'malformed-json.ipynb': NotJSONError,
+    '404.ipynb': ValueError,
+    'malformed-json.ipynb': ValueError,
 }
 
 NB_EXTRACTS = {
     'raw.ipynb': '',
     'normal.ipynb': NORMAL_EXTRACT,
+    # read like a notebook cut off before its first cell
+    'empty.ipynb': '',
 }
 
 def test_extract_text():
-    """ test extraction of code + markdown with format_notebook
-    this code was developed after running format_notebook on ~6400 notebooks
+    """ test extraction of code + markdown
+    the cases are from running the original (nbformat) extraction on ~6400 notebooks
     found here s3://alpha-quilt-storage/tree/notebook-search/
     """
     parent = os.path.dirname(__file__)
     basedir = os.path.join(parent, 'data')
     for name in NB_RAISES:
         path = os.path.join(basedir, name)
-        with open(path) as notebook:
+        with open(path, 'rb') as notebook:
             contents = notebook.read()
             with pytest.raises(NB_RAISES[name]):
-                extract_text(contents)
+                extract_notebook_text([contents], 10**6)
 
     for name in NB_EXTRACTS:
         path = os.path.join(basedir, name)
-        with open(path) as notebook:
+        with open(path, 'rb') as notebook:
             contents = notebook.read()
-            extracted = extract_text(contents)
+            extracted = extract_notebook_text([contents], 10**6)
             assert extracted == NB_EXTRACTS[name]
+
+    # nbformat couldn't read this one, but its cells are fine
+    with open(os.path.join(basedir, 'attribute-error.ipynb'), 'rb') as notebook:
+        extracted = extract_notebook_text([notebook.read()], 10**6)
+    assert extracted.startswith('%matplotlib inline\nimport datetime\n')
+
+def chunked(data, size):
+    """split bytes into chunks"""
+    return [data[start:start + size] for start in range(0, len(data), max(size, 1))]
+
+def test_extract_notebook_text():
+    """ test streaming extraction of code + markdown from chunks """
+    parent = os.path.dirname(__file__)
+    basedir = os.path.join(parent, 'data')
+    for name in NB_EXTRACTS:
+        with open(os.path.join(basedir, name), 'rb') as notebook:
+            contents = notebook.read()
+        # chunk boundaries fall everywhere, incl. inside strings and escapes
+        for size in [7, 1000, len(contents)]:
+            assert extract_notebook_text(chunked(contents, size), 10**6) == NB_EXTRACTS[name]
+
+    # text is limited, and a cut-off notebook has the text of its complete cells
+    with open(os.path.join(basedir, 'normal.ipynb'), 'rb') as notebook:
+        contents = notebook.read()
+    assert extract_notebook_text([contents], 10) == NORMAL_EXTRACT[:10]
+    cut = extract_notebook_text([contents[:len(contents) // 2]], 10**6)
+    assert cut and NORMAL_EXTRACT.startswith(cut)
+
+    with open(os.path.join(basedir, '404.ipynb'), 'rb') as notebook:
+        with pytest.raises(ValueError):
+            extract_notebook_text([notebook.read()], 10**6)
+
+def test_extract_notebook_text_skips_outputs():
+    """ outputs, escapes and version 3 notebooks """
+    notebook = {
+        'worksheets': [{
+            'cells': [
+                {'cell_type': 'code', 'input': ['x = "\\u00e9\\"\n', 'y'],
+                 'outputs': [{'data': {'image/png': 'A' * 10000}}, [1, 2.5e3, True, None]]},
+                {'cell_type': 'raw', 'source': 'skipped'},
+                {'cell_type': 'heading', 'level': 1, 'source': ['Title']},
+                {'cell_type': 'markdown', 'metadata': {'tags': ['[{']}, 'source': '\u00e9 {'},
+            ],
+        }],
+        'nbformat': 3,
+    }
+    data = json.dumps(notebook).encode()
+    assert extract_notebook_text(chunked(data, 3), 10**6) == 'x = "\\u00e9\\"\ny\nTitle\n\u00e9 {'